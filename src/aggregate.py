@@ -0,0 +1,101 @@
+import os
+import sys
+import glob
+import argparse
+from indicators import *
+from writers import result_formats
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Compute long-term indicators (Lday, Levening, Lnight, Lden, Leq) from processed snapshots.")
+    parser.add_argument('-i', '--input',       required=True,  help="Directory or glob pattern of processed snapshots.")
+    parser.add_argument('-o', '--output',      required=True,  help="Name of output CSV file with the indicators per receiver.")
+    parser.add_argument('-d', '--daily',       required=False, help="CSV file where the daily indicators are appended.", default=None)
+    parser.add_argument('-c', '--checkpoint',  required=False, help="Checkpoint file (npz) to resume from and to update.", default=None)
+    parser.add_argument('-p', '--percentiles', required=False, help="Also compute L10 and L90.", action='store_true')
+    parser.add_argument('-f', '--force' ,      required=False, help="Force rewrite output file.", action='store_true')
+    return parser.parse_args()
+
+def list_snapshots(pattern: str) -> list[str]:
+    """
+    Return the snapshots in the directory `pattern` (in any format of
+    `writers.py`), or matching the glob `pattern`, sorted by the timestamp in
+    their name. Files without one are skipped.
+
+    Raises:
+        ValueError: When the directory has snapshots in several formats.
+    """
+    if os.path.isdir(pattern):
+        filenames = {ext: glob.glob(os.path.join(pattern, f'*{ext}')) for ext in result_formats}
+        formats = [ext for ext, found in filenames.items() if found]
+        if len(formats) > 1:
+            raise ValueError(f"{pattern} has snapshots in several formats: {', '.join(formats)}")
+        filenames = filenames[formats[0]] if formats else []
+    else:
+        filenames = glob.glob(pattern)
+    snapshots = []
+    for filename in filenames:
+        try:
+            snapshots.append((parse_filename_timestamp(filename), filename))
+        except ValueError:
+            logging.warning(f"Skipping {filename}: no snapshot timestamp in its name")
+    return [filename for _, filename in sorted(snapshots)]
+
+@timer
+def aggregate(indicators: LongTermIndicators, filenames: list[str], daily_filename: str = None) -> int:
+    """
+    Fold the snapshots `filenames` not already covered by `indicators` and
+    append the finished days to `daily_filename`.
+
+    Returns:
+        int: The number of snapshots added.
+    """
+    added = 0
+    for filename in filenames:
+        timestamp = parse_filename_timestamp(filename)
+        if indicators.last_timestamp is not None and timestamp <= indicators.last_timestamp:
+            continue
+
+        daily_df = indicators.add(read_file(filename), timestamp)
+        if daily_df is not None and daily_filename:
+            write_csv_file(daily_df, daily_filename, append=os.path.isfile(daily_filename))
+        added += 1
+    return added
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("aggregate", now)
+
+    args = parse_args()
+
+    if os.path.isfile(args.output) and not args.force:
+        logging.error(f"The file {args.output} already exists! Use `--force` to overwrite it.")
+        sys.exit(3)
+
+    if args.checkpoint and os.path.isfile(args.checkpoint):
+        indicators = LongTermIndicators.load(args.checkpoint)
+        logging.info(f"Resumed from {args.checkpoint}: {indicators.snapshots} snapshots up to {indicators.last_timestamp}")
+    else:
+        indicators = LongTermIndicators(percentiles=args.percentiles)
+
+    try:
+        filenames = list_snapshots(args.input)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+    added = aggregate(indicators, filenames, args.daily)
+    logging.info(f"Added {added} snapshots, {indicators.snapshots} in total")
+
+    if args.checkpoint:
+        indicators.save(args.checkpoint)
+    elif args.daily:
+        # Nothing will resume the current date: publish it as it is
+        daily_df = indicators.flush_day()
+        if daily_df is not None:
+            write_csv_file(daily_df, args.daily, append=os.path.isfile(args.daily))
+    with atomic_output(args.output) as tmp_filename:
+        write_csv_file(indicators.results(), tmp_filename)
@@ -0,0 +1,276 @@
+from process_functions import *
+from typing import NamedTuple
+
+
+#------------------------------------------------------------------------------
+#
+# Sparse attenuation operator
+#
+# In the power domain, `noise_attenuation` + `energetic_sum` map the emission of
+# every (source, vehicle_type) pair to the receivers through a fixed set of
+# attenuation factors. The operator stores them once as a CSR matrix
+# (receiver x source, one value per frequency band) so that each snapshot only
+# costs a gather and a segmented sum over the non-zeros, without merging the
+# emission table with the whole attenuation matrix.
+#
+#------------------------------------------------------------------------------
+
+class AttenuationOperator(NamedTuple):
+    receivers: np.ndarray   # [n_receivers] receiver ids, sorted
+    coords: np.ndarray      # [n_receivers, 2] 'X/m' and 'Y/m' of each receiver
+    sources: pd.MultiIndex  # [n_sources] (ID_JOIN, 'vehicle_type') pairs
+    indptr: np.ndarray      # [n_receivers + 1] CSR row pointers
+    cols: np.ndarray        # [nnz] source index of each non-zero
+    factors: np.ndarray     # [nnz, n_freqs] linear attenuation factors
+
+
+@timer
+def build_attenuation_operator(
+    df: pd.DataFrame
+) -> AttenuationOperator:
+    """
+    Builds the sparse attenuation operator from a preprocessed noise
+    attenuation matrix.
+
+    - Attenuations (dB) are converted to linear factors, missing values
+      count as 0 dB like in `noise_attenuation`.
+    - Non-zeros are sorted by receiver, so each receiver is a contiguous
+      segment of `cols`/`factors`.
+
+    Args:
+        df (pd.DataFrame): Output of `preproces_attenuation_matrix`.
+
+    Returns:
+        AttenuationOperator: The operator.
+    """
+    receiver_codes, receivers = pd.factorize(df['receiver'], sort=True)
+    source_codes, sources = pd.factorize(pd.MultiIndex.from_arrays(
+        [df[ID_JOIN], df['vehicle_type'].astype(str)], names=[ID_JOIN, 'vehicle_type']))
+
+    order = np.argsort(receiver_codes, kind='stable')
+    receiver_codes = receiver_codes[order]
+
+    counts = np.bincount(receiver_codes, minlength=len(receivers))
+    indptr = np.zeros(len(receivers) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    attenuations = np.nan_to_num(df[freqs].to_numpy(dtype=float)[order], nan=0.0)
+    coords = df[['X/m', 'Y/m']].to_numpy(dtype=float)[order][indptr[:-1]]
+
+    return AttenuationOperator(
+        receivers=np.asarray(receivers),
+        coords=coords,
+        sources=sources,
+        indptr=indptr,
+        cols=source_codes[order],
+        factors=10.0 ** (attenuations / 10.0),
+    )
+
+
+def source_powers(
+    op: AttenuationOperator,
+    df: pd.DataFrame
+) -> list[np.ndarray]:
+    """
+    Converts the SPLs of `df` (output of `sound_pressure_levels`) into
+    per-source power vectors aligned with `op.sources`.
+
+    Sources without an SPL row are NaN. When a (source, vehicle_type) pair
+    appears more than once in `df`, every repetition goes in a separate layer
+    so that each one contributes on its own, like in the merge.
+
+    Returns:
+        list[np.ndarray]: One [n_sources, n_freqs] power array per layer.
+    """
+    idx = op.sources.get_indexer(pd.MultiIndex.from_arrays(
+        [df[ID_JOIN], df['vehicle_type'].astype(str)]))
+    mask = idx >= 0
+
+    spl = df[freqs].to_numpy(dtype=float)[mask]
+    power = 10.0 ** (np.where(np.isnan(spl), 0.0, spl) / 10.0)
+    idx = idx[mask]
+
+    layer = pd.Series(idx).groupby(idx).cumcount().to_numpy()
+    layers = []
+    for k in range(layer.max() + 1 if len(layer) else 1):
+        P = np.full((len(op.sources), len(freqs)), np.nan)
+        P[idx[layer == k]] = power[layer == k]
+        layers.append(P)
+    return layers
+
+
+def attenuate(
+    op: AttenuationOperator,
+    powers: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Applies the operator to per-source powers.
+
+    `powers` is [n_sources, n_freqs], or [n_sources, n_freqs, n_snapshots] to
+    evaluate several snapshots at once. NaN marks a missing source. As in
+    `energetic_sum`, every attenuated contribution is clipped at 0 dB
+    (power 1) before being summed.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The summed power per receiver (shaped
+        like `powers` with receivers in place of sources) and a boolean array
+        telling which receivers got at least one contribution.
+    """
+    gathered = powers[op.cols]
+    factors = op.factors.reshape(op.factors.shape + (1,) * (powers.ndim - 2))
+    present = ~np.isnan(gathered)
+
+    contrib = np.where(present, np.maximum(gathered * factors, 1.0), 0.0)
+
+    # Segmented sum over the CSR rows (every receiver has at least one non-zero)
+    starts = op.indptr[:-1]
+    power = np.add.reduceat(contrib, starts, axis=0)
+    received = np.add.reduceat(present[:, 0], starts, axis=0) > 0
+    return power, received
+
+
+@timer
+def apply_attenuation_operator(
+    op: AttenuationOperator,
+    df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Computes the energetic sum per receiver of the SPLs in `df` through the
+    sparse attenuation operator. Equivalent to
+    `energetic_sum(noise_attenuation(df, matrix))`.
+
+    Args:
+        op (AttenuationOperator): Operator built from the attenuation matrix.
+        df (pd.DataFrame): Output of `sound_pressure_levels`.
+
+    Returns:
+        pd.DataFrame: Aggregated SPL per receiver with total dB and per-frequency dB values.
+    """
+    power = np.zeros((len(op.receivers), len(freqs)))
+    received = np.zeros(len(op.receivers), dtype=bool)
+    for P in source_powers(op, df):
+        layer_power, layer_received = attenuate(op, P)
+        power += layer_power
+        received |= layer_received
+
+    return receiver_levels(op, power[received], received)
+
+
+def receiver_levels(
+    op: AttenuationOperator,
+    power: np.ndarray,
+    mask: np.ndarray
+) -> pd.DataFrame:
+    """
+    Builds the `energetic_sum` output from the summed power ([n, n_freqs]) of
+    the receivers selected by `mask`.
+    """
+    with np.errstate(divide='ignore'):
+        agg = pd.DataFrame(10.0 * np.log10(power), columns=freqs)
+        agg.insert(0, 'receiver', op.receivers[mask])
+        agg.insert(1, 'X/m', op.coords[mask, 0])
+        agg.insert(2, 'Y/m', op.coords[mask, 1])
+        agg['total_db'] = 10.0 * np.log10(power.sum(axis=1))
+    return agg
+
+
+#------------------------------------------------------------------------------
+#
+# Incremental energetic sum
+#
+#------------------------------------------------------------------------------
+
+class IncrementalEnergeticSum:
+    """
+    Stateful version of `apply_attenuation_operator` for consecutive snapshots.
+
+    The per-receiver power accumulators of the previous snapshot are kept, and
+    only the contributions of the sources whose emission changed are
+    subtracted and added again, using the non-zeros of those sources only.
+    A full recompute is done every `full_every` updates to bound the
+    floating-point drift, or when more than `max_changed_fraction` of the
+    sources changed.
+    """
+    def __init__(self, op: AttenuationOperator,
+                 full_every: int = FULL_RECOMPUTE_EVERY,
+                 max_changed_fraction: float = 0.5):
+        self.op = op
+        self.full_every = full_every
+        self.max_changed_fraction = max_changed_fraction
+
+        # Receiver of every non-zero, and the non-zeros grouped by source (CSC view)
+        self.rows = np.repeat(np.arange(len(op.receivers)), np.diff(op.indptr))
+        self.nnz_by_source = np.argsort(op.cols, kind='stable')
+        self.source_indptr = np.zeros(len(op.sources) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(op.cols, minlength=len(op.sources)), out=self.source_indptr[1:])
+
+        self.powers = None  # [n_sources, n_freqs] source powers of the last snapshot
+        self.power = None   # [n_receivers, n_freqs] summed power per receiver
+        self.count = None   # [n_receivers] number of contributions per receiver
+        self.updates = 0
+
+    def contributions(self, powers: np.ndarray, nnz: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        gathered = powers[self.op.cols[nnz]]
+        present = ~np.isnan(gathered[:, 0])
+        contrib = np.where(present[:, None], np.maximum(gathered * self.op.factors[nnz], 1.0), 0.0)
+        return contrib, present
+
+    def recompute(self, powers: np.ndarray):
+        contrib, present = self.contributions(powers, np.arange(len(self.op.cols)))
+        starts = self.op.indptr[:-1]
+        self.power = np.add.reduceat(contrib, starts, axis=0)
+        self.count = np.add.reduceat(present.astype(np.int64), starts)
+        self.updates = 0
+
+    def changed_sources(self, powers: np.ndarray) -> np.ndarray:
+        same = (powers == self.powers) | (np.isnan(powers) & np.isnan(self.powers))
+        return np.flatnonzero(~same.all(axis=1))
+
+    def add_changes(self, powers: np.ndarray, changed: np.ndarray, power: np.ndarray, count: np.ndarray):
+        """
+        Updates the summed `power` and `count` per receiver of the source
+        powers of the last snapshot to `powers`, for the `changed` sources,
+        using their non-zeros only.
+        """
+        starts = self.source_indptr[changed]
+        lengths = self.source_indptr[changed + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        nnz = self.nnz_by_source[np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())]
+
+        new_contrib, new_present = self.contributions(powers, nnz)
+        old_contrib, old_present = self.contributions(self.powers, nnz)
+        rows = self.rows[nnz]
+        np.add.at(power, rows, new_contrib - old_contrib)
+        np.add.at(count, rows, new_present.astype(np.int64) - old_present)
+        power[count == 0] = 0.0
+
+    @timer
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Computes the energetic sum per receiver of the SPLs in `df` (output of
+        `sound_pressure_levels`), updating the state of the previous call.
+
+        Returns:
+            pd.DataFrame: Aggregated SPL per receiver with total dB and per-frequency dB values.
+        """
+        layers = source_powers(self.op, df)
+        if len(layers) > 1:
+            # Repeated sources cannot be tracked one by one
+            self.powers = None
+            return apply_attenuation_operator(self.op, df)
+        powers = layers[0]
+
+        if self.powers is None or self.updates >= self.full_every:
+            self.recompute(powers)
+        else:
+            changed = self.changed_sources(powers)
+            if len(changed) > self.max_changed_fraction * len(self.op.sources):
+                self.recompute(powers)
+            elif len(changed):
+                self.add_changes(powers, changed, self.power, self.count)
+                self.updates += 1
+            logging.debug(f"Incremental update: {len(changed)} of {len(self.op.sources)} sources changed")
+
+        self.powers = powers
+        received = self.count > 0
+        return receiver_levels(self.op, self.power[received], received)
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import argparse
+import cProfile
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from process_functions import *
+from attenuation_operator import *
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument('-s', '--segments',  required=False, help="Number of street segments.", type=int, default=1000)
+    parser.add_argument('-r', '--receivers', required=False, help="Number of receivers.", type=int, default=10000)
+    parser.add_argument('-k', '--sources',   required=False, help="Number of sources per receiver.", type=int, default=20)
+    parser.add_argument('-n', '--repeat',    required=False, help="Repetitions of every stage.", type=int, default=3)
+    parser.add_argument('-o', '--output',    required=False, help="JSON file where the results are written.", default=None)
+    parser.add_argument('-c', '--compare',   required=False, help="JSON results of a previous run to compare with.", default=None)
+    parser.add_argument('-t', '--tolerance', required=False, help="Slowdown ratio reported as a regression.", type=float, default=1.2)
+    parser.add_argument('-p', '--profile',   required=False, help="Directory where a cProfile dump of every stage is written.", default=None)
+    parser.add_argument('-w', '--write-dir', required=False, help="Only write the synthetic input and matrix (csv) to this directory.", default=None)
+    parser.add_argument('--seed',            required=False, help="Random seed.", type=int, default=0)
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Synthetic data
+#
+#------------------------------------------------------------------------------
+
+def synthetic_input(num_segments: int, street_params_df: pd.DataFrame,
+                    rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Generate a snapshot with the same columns as the output of `collect_data`.
+    """
+    highways = street_params_df['highway'].unique()
+    distance = rng.integers(30, 1500, num_segments)
+    speed = rng.integers(5, 70, num_segments)
+    lat, lon = rng.uniform(43.70, 43.73, (2, num_segments)), rng.uniform(10.38, 10.42, (2, num_segments))
+    return pd.DataFrame({
+        'id': np.arange(num_segments),
+        ID_JOIN: np.arange(1, num_segments + 1),
+        'name': [f'Street {i}' for i in range(num_segments)],
+        'highway': rng.choice(highways, num_segments),
+        'z_order': 0,
+        'xy_start': [f'{a:.7f},{b:.7f}' for a, b in zip(lat[0], lon[0])],
+        'xy_end': [f'{a:.7f},{b:.7f}' for a, b in zip(lat[1], lon[1])],
+        'length': distance + rng.uniform(0, 1, num_segments),
+        'distance': distance,
+        'speed': speed,
+        'travel_time': np.maximum(1, np.round(distance / (speed / 3.6))).astype(int),
+        'daytime': rng.choice(['day', 'evening', 'night'], num_segments),
+    })
+
+def synthetic_attenuation_matrix(num_segments: int, num_receivers: int, sources_per_receiver: int,
+                                 rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Generate a raw noise attenuation matrix (same columns as the files read by
+    `preproces_attenuation_matrix`) where every receiver hears
+    `sources_per_receiver` segments for the 4 vehicle types.
+    """
+    k = min(sources_per_receiver, num_segments)
+    # Every receiver hears a block of k consecutive segments, so pairs are unique
+    sources = (rng.integers(0, num_segments, (num_receivers, 1)) + np.arange(k)) % num_segments + 1
+    labels = np.array(['Ld', 'Le', 'Lx', 'Ln'])
+    n = num_receivers * k * len(labels)
+
+    receivers = np.repeat(np.arange(1, num_receivers + 1), k * len(labels))
+    coords = rng.uniform(0, 5000, (num_receivers, 2))
+    df = pd.DataFrame({
+        'Ricevitore': receivers,
+        'Sorgente': np.repeat(sources.ravel(), len(labels)),
+        'ora intervallo': np.tile(labels, num_receivers * k),
+        'X/m': coords[receivers - 1, 0],
+        'Y/m': coords[receivers - 1, 1],
+    })
+    for f in freqs:
+        df[f'{f}Hz dB(A)'] = -rng.uniform(5, 60, n)
+    return df
+
+
+#------------------------------------------------------------------------------
+#
+# Measurements
+#
+#------------------------------------------------------------------------------
+
+LOAD_MAX_COPY_RATIO = 0.1  # share of the compiled matrix `load_compiled_attenuation_matrix` may allocate
+
+
+def measure(name: str, setup, func, rows: int, repeat: int, profile_dir: str = None) -> dict:
+    """
+    Run `func(*setup())` `repeat` times, plus one run traced with tracemalloc
+    for the peak memory and, optionally, one run under cProfile. `setup` is
+    excluded from the measurements and provides fresh arguments every time,
+    since stages modify their inputs.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start_time = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start_time)
+
+    args = setup()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    if profile_dir:
+        args = setup()
+        profiler = cProfile.Profile()
+        profiler.runcall(func, *args)
+        profiler.dump_stats(os.path.join(profile_dir, f'{name}.prof'))
+
+    best = min(times)
+    result = {
+        'stage': name,
+        'rows': rows,
+        'min_ms': round(best * 1000, 3),
+        'mean_ms': round(float(np.mean(times)) * 1000, 3),
+        'rows_per_s': round(rows / best, 1) if best > 0 else None,
+        'peak_mem_mb': round(peak / 2**20, 3),
+    }
+    print(f"{name:<32} {result['min_ms']:>12.3f} ms {result['peak_mem_mb']:>10.1f} MB {rows:>12} rows")
+    return result
+
+@timer
+def run_benchmark(num_segments: int, num_receivers: int, sources_per_receiver: int,
+                  repeat: int = 3, seed: int = 0, profile_dir: str = None) -> dict:
+    """
+    Time every pipeline stage, the sparse operator and the file I/O functions
+    on synthetic data of the given scale.
+    """
+    rng = np.random.default_rng(seed)
+    street_params_raw = read_file(street_params_filename, PARAMS_DIR)
+    freq_coeffs_raw   = read_file(freq_coeffs_filename, PARAMS_DIR)
+    curve_A_df        = read_file(curve_A_filename, PARAMS_DIR)
+    data_df           = synthetic_input(num_segments, street_params_raw, rng)
+    matrix_raw        = synthetic_attenuation_matrix(num_segments, num_receivers, sources_per_receiver, rng)
+    if USE_SCHEMAS:
+        # Same dtypes as when the files are read by `process.py`
+        data_df    = apply_schema(data_df, input_schema)
+        matrix_raw = apply_schema(matrix_raw, attenuation_matrix_schema)
+
+    # Inputs of every stage, computed once
+    street_params_df = preprocess_street_params(street_params_raw.copy())
+    freq_coeffs_df   = preprocess_freq_coeffs(freq_coeffs_raw.copy())
+    emission_table   = build_emission_table(freq_coeffs_df, curve_A_df)
+    matrix_df        = preproces_attenuation_matrix(matrix_raw.copy())
+    flows_df         = equivalent_flows(data_df, street_params_df)
+    spl_df           = sound_pressure_levels(flows_df, freq_coeffs_df, curve_A_df, emission_table)
+    attenuated_df    = noise_attenuation(spl_df, matrix_df)
+    op               = build_attenuation_operator(matrix_df)
+
+    stages = [
+        ('preprocess_street_params', lambda: (street_params_raw.copy(),), preprocess_street_params, len(street_params_raw)),
+        ('preprocess_freq_coeffs', lambda: (freq_coeffs_raw.copy(),), preprocess_freq_coeffs, len(freq_coeffs_raw)),
+        ('preproces_attenuation_matrix', lambda: (matrix_raw.copy(),), preproces_attenuation_matrix, len(matrix_raw)),
+        ('equivalent_flows', lambda: (data_df.copy(), street_params_df), equivalent_flows, len(data_df)),
+        ('build_emission_table', lambda: (freq_coeffs_df, curve_A_df), build_emission_table, len(freq_coeffs_df)),
+        ('sound_pressure_levels', lambda: (flows_df.copy(), freq_coeffs_df, curve_A_df, emission_table), sound_pressure_levels, len(flows_df)),
+        ('noise_attenuation', lambda: (spl_df.copy(), matrix_df), noise_attenuation, len(matrix_df)),
+        ('energetic_sum', lambda: (attenuated_df.copy(),), energetic_sum, len(attenuated_df)),
+        ('build_attenuation_operator', lambda: (matrix_df,), build_attenuation_operator, len(matrix_df)),
+        ('apply_attenuation_operator', lambda: (op, spl_df), apply_attenuation_operator, len(matrix_df)),
+    ]
+
+    results = [measure(name, setup, func, rows, repeat, profile_dir) for name, setup, func, rows in stages]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base = os.path.join(tmp_dir, 'matrix')
+        write_csv_file(matrix_raw, f'{base}.csv')
+        write_parquet_file(matrix_raw, f'{base}.parquet')
+        write_json_file(matrix_raw, f'{base}.json')
+        write_npy_file(compile_attenuation_matrix(matrix_df), f'{base}.npy')
+
+        io_stages = [
+            ('write_csv_file', lambda: (matrix_raw, f'{base}.w.csv'), write_csv_file),
+            ('write_parquet_file', lambda: (matrix_raw, f'{base}.w.parquet'), write_parquet_file),
+            ('write_json_file', lambda: (matrix_raw, f'{base}.w.json'), write_json_file),
+            ('read_csv_file', lambda: (f'{base}.csv',), read_csv_file),
+            ('read_parquet_file', lambda: (f'{base}.parquet',), read_parquet_file),
+            ('read_json_file', lambda: (f'{base}.json',), read_json_file),
+            ('load_compiled_attenuation_matrix', lambda: (read_npy_file(f'{base}.npy'),), load_compiled_attenuation_matrix),
+        ]
+        results += [measure(name, setup, func, len(matrix_raw), repeat, profile_dir) for name, setup, func in io_stages]
+
+        # Loading the memory-mapped matrix must not copy it
+        compiled_mb = os.path.getsize(f'{base}.npy') / 2**20
+        load_mb = results[-1]['peak_mem_mb']
+        checks = {'compiled_matrix_mb': round(compiled_mb, 3),
+                  'load_copies_matrix': load_mb > LOAD_MAX_COPY_RATIO * compiled_mb}
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'scale': {
+            'segments': num_segments,
+            'receivers': num_receivers,
+            'sources_per_receiver': sources_per_receiver,
+            'matrix_rows': len(matrix_raw),
+        },
+        'repeat': repeat,
+        'results': results,
+        'checks': checks,
+    }
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Return the stages of `current` slower than `tolerance` times the same
+    stage of `baseline`.
+    """
+    if current['scale'] != baseline['scale']:
+        logging.warning(f"Comparing different scales: {current['scale']} vs {baseline['scale']}")
+
+    previous = {r['stage']: r for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        if r['stage'] not in previous:
+            continue
+        ratio = r['min_ms'] / previous[r['stage']]['min_ms'] if previous[r['stage']]['min_ms'] else float('inf')
+        print(f"{r['stage']:<32} {ratio:>8.2f}x")
+        if ratio > tolerance:
+            regressions.append(r['stage'])
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.write_dir:
+        if not os.path.isdir(args.write_dir):
+            print(f"The output directory does not exist: {args.write_dir}")
+            sys.exit(3)
+        rng = np.random.default_rng(args.seed)
+        data_df = synthetic_input(args.segments, read_file(street_params_filename, PARAMS_DIR), rng)
+        matrix_df = synthetic_attenuation_matrix(args.segments, args.receivers, args.sources, rng)
+        data_df.to_csv(os.path.join(args.write_dir, 'synthetic-input.csv'), index=False)
+        matrix_df.to_csv(os.path.join(args.write_dir, 'synthetic-matrix.csv'), index=False)
+        sys.exit(0)
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+
+    report = run_benchmark(args.segments, args.receivers, args.sources, args.repeat, args.seed, args.profile)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if report['checks']['load_copies_matrix']:
+        print(f"load_compiled_attenuation_matrix copies the matrix ({report['checks']['compiled_matrix_mb']:.1f} MB)")
+        sys.exit(4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(4)
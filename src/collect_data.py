@@ -6,9 +6,17 @@ Date: 2025-07-25
 
 import os
 import sys
+import glob
+import time
+import signal
 import argparse
-from datetime import datetime
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from dotenv import load_dotenv
 from utils import *
@@ -21,6 +29,15 @@ def parse_args():
     parser.add_argument('-i', '--input',  required=True,  help="Path to input CSV file.")
     parser.add_argument('-d', '--dir',    required=False, help="Specify the directory to store the output CSV file.", default="")
     parser.add_argument('-p', '--prefix', required=True,  help="Prefix name of output CSV file.")
+    parser.add_argument('-w', '--workers', required=False, help="Maximum number of concurrent requests.", type=int, default=MAX_WORKERS)
+    parser.add_argument('-q', '--qps',     required=False, help="Maximum requests per second (0 = unlimited).", type=float, default=MAX_QPS)
+    parser.add_argument('-r', '--retries', required=False, help="Maximum retries per request.", type=int, default=MAX_RETRIES)
+    parser.add_argument('-u', '--url',     required=False, help="Directions API endpoint.", default=DIRECTIONS_URL)
+    parser.add_argument('-b', '--batched', required=False, help="Group segments sharing an origin into Distance Matrix requests.", action='store_true')
+    parser.add_argument('--matrix-url',    required=False, help="Distance Matrix API endpoint.", default=DISTANCE_MATRIX_URL)
+    parser.add_argument('-s', '--schedule', required=False, help="Keep running and collect a snapshot every `--interval` minutes, spreading the requests over the interval.", action='store_true')
+    parser.add_argument('--interval',      required=False, help="Minutes between two snapshots with `--schedule`, and between two polling cycles with `--plan`.", type=float, default=COLLECT_INTERVAL)
+    parser.add_argument('--plan',          required=False, help="Polling plan (see `polling_plan.py`): only poll the segments due in the current cycle, and carry the others forward from the last snapshot.", default=None)
     return parser.parse_args()
 
 def load_api_key() -> str:
@@ -33,11 +50,166 @@ def load_api_key() -> str:
         raise ValueError("Google API key not found. Make sure .env contains GOOGLE_API_KEY.")
     return api_key
 
-def call_directions_api(origin: str, destination: str, api_key: str) -> tuple[int, int, int]:
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces requests at least 1/`qps` seconds apart.
+    """
+    def __init__(self, qps: float):
+        self.interval = 1.0 / qps if qps > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class DirectionsStats:
+    """
+    Thread-safe counters of request outcomes and latencies.
+    """
+    def __init__(self):
+        self.outcomes = Counter()
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def record(self, outcome: str, latency: float):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            self.latencies.append(latency)
+
+    def summary(self) -> dict:
+        with self.lock:
+            latencies_ms = np.array(self.latencies) * 1000
+            summary = {'requests': len(latencies_ms), **self.outcomes}
+        if len(latencies_ms):
+            summary.update({
+                'latency_mean_ms': round(float(latencies_ms.mean()), 3),
+                'latency_p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+                'latency_p95_ms': round(float(np.percentile(latencies_ms, 95)), 3),
+                'latency_max_ms': round(float(latencies_ms.max()), 3),
+            })
+        return summary
+
+
+def create_session(max_workers: int = MAX_WORKERS) -> requests.Session:
+    """
+    Create an HTTP session whose connection pool can serve `max_workers`
+    concurrent requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Response statuses of throttled requests, worth retrying. Any other status
+# but OK (e.g. ZERO_RESULTS, NOT_FOUND, REQUEST_DENIED) is permanent.
+RETRYABLE_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+
+class ApiStatusError(ValueError):
+    """
+    A response (HTTP 200) whose JSON `status` is not OK.
+    """
+    def __init__(self, status: str, message: str = None):
+        super().__init__(f"status {status}" + (f": {message}" if message else ""))
+        self.status = status
+        self.retryable = status in RETRYABLE_STATUSES
+
+def check_status(data: dict):
+    status = data.get('status', 'OK')
+    if status != 'OK':
+        raise ApiStatusError(status, data.get('error_message'))
+
+
+def parse_directions(data: dict) -> tuple[int, int, int]:
+    """
+    Extract distance (m), duration (s), and speed (km/h) from a Directions
+    API response.
+
+    Raises:
+        ApiStatusError: When the status of the response is not OK.
+    """
+    check_status(data)
+    leg = data['routes'][0]['legs'][0]
+    distance = leg['distance']['value']
+    duration = leg['duration_in_traffic']['value']
+    if duration == 0:
+        duration = 1
+    speed = round((distance / duration) * 3.6)
+    return distance, duration, speed
+
+
+def request_json(url: str, params: dict,
+                 session: requests.Session = None,
+                 rate_limiter: RateLimiter = None,
+                 stats: DirectionsStats = None,
+                 max_retries: int = 0,
+                 parse=lambda data: data):
+    """
+    GET `url` and return `parse` applied to the JSON response.
+
+    Network errors, HTTP 429 and 5xx responses, and responses whose status is
+    one of `RETRYABLE_STATUSES` (raised by `parse` as `ApiStatusError`) are
+    retried up to `max_retries` times with exponential backoff. The last
+    error is raised on failure.
+    """
+    get = session.get if session is not None else requests.get
+
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        start_time = time.perf_counter()
+        outcome = 'ok'
+        try:
+            response = get(url, params=params, timeout=DIRECTIONS_TIMEOUT)
+            response.raise_for_status()
+            return parse(response.json())
+        except requests.HTTPError as e:
+            retryable = e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+            outcome = 'http_error'
+            error = e
+        except requests.RequestException as e:
+            retryable = True
+            outcome = 'network_error'
+            error = e
+        except ApiStatusError as e:
+            retryable = e.retryable
+            outcome = 'throttled' if e.retryable else 'api_error'
+            error = e
+        except (ValueError, KeyError, IndexError) as e:
+            retryable = False
+            outcome = 'invalid_response'
+            error = e
+        finally:
+            if stats is not None:
+                stats.record(outcome, time.perf_counter() - start_time)
+
+        if not retryable or attempt == max_retries:
+            raise error
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+def call_directions_api(origin: str, destination: str, api_key: str,
+                        session: requests.Session = None,
+                        base_url: str = DIRECTIONS_URL,
+                        rate_limiter: RateLimiter = None,
+                        stats: DirectionsStats = None,
+                        max_retries: int = 0) -> tuple[int, int, int]:
     """
     Call the Google Directions API and return distance (m), duration (s), and speed (km/h).
+
+    On failure (1, 1, 1) is returned.
     """
-    base_url = "https://maps.googleapis.com/maps/api/directions/json"
     params = {
         "origin": origin,
         "destination": destination,
@@ -46,56 +218,360 @@ def call_directions_api(origin: str, destination: str, api_key: str) -> tuple[in
     }
 
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
-        data = response.json()
-
-        leg = data['routes'][0]['legs'][0]
-        distance = leg['distance']['value']
-        duration = leg['duration_in_traffic']['value']
-        if duration == 0:
-            duration = 1
-        speed = round((distance / duration) * 3.6)
-
-        return distance, duration, speed
-    except (requests.RequestException, KeyError, IndexError) as e:
+        return request_json(base_url, params, session, rate_limiter, stats, max_retries, parse_directions)
+    except (requests.RequestException, ValueError, KeyError, IndexError) as e:
         logging.warning(f"Failed to retrieve directions: {origin} -> {destination} | {e}")
         return 1, 1, 1
 
 
-def enrich_with_directions(df: pd.DataFrame, now: datetime) -> pd.DataFrame:
+def parse_distance_matrix(data: dict) -> list[tuple[int, int, int] | None]:
+    """
+    Extract distance (m), duration (s), and speed (km/h) of every destination
+    from a single-origin Distance Matrix API response. Destinations without a
+    route are None.
+
+    Raises:
+        ApiStatusError: When the status of the response is not OK.
+    """
+    check_status(data)
+    results = []
+    for element in data['rows'][0]['elements']:
+        if element.get('status', 'OK') != 'OK':
+            results.append(None)
+            continue
+        distance = element['distance']['value']
+        duration = element['duration_in_traffic']['value'] or 1
+        results.append((distance, duration, round((distance / duration) * 3.6)))
+    return results
+
+
+def call_distance_matrix_api(origin: str, destinations: list[str], api_key: str,
+                             session: requests.Session = None,
+                             base_url: str = DISTANCE_MATRIX_URL,
+                             rate_limiter: RateLimiter = None,
+                             stats: DirectionsStats = None,
+                             max_retries: int = 0) -> list[tuple[int, int, int]]:
+    """
+    Call the Google Distance Matrix API once for `origin` and all `destinations`
+    and return distance (m), duration (s), and speed (km/h) for each of them.
+
+    On failure (1, 1, 1) is returned for the failed destinations.
+    """
+    params = {
+        "origins": origin,
+        "destinations": '|'.join(destinations),
+        "key": api_key,
+        "departure_time": "now"
+    }
+
+    try:
+        results = request_json(base_url, params, session, rate_limiter, stats, max_retries, parse_distance_matrix)
+        if len(results) != len(destinations):
+            raise ValueError(f"expected {len(destinations)} elements, got {len(results)}")
+    except (requests.RequestException, ValueError, KeyError, IndexError) as e:
+        logging.warning(f"Failed to retrieve distance matrix: {origin} -> {len(destinations)} destinations | {e}")
+        return [(1, 1, 1)] * len(destinations)
+
+    for destination, result in zip(destinations, results):
+        if result is None:
+            logging.warning(f"Failed to retrieve directions: {origin} -> {destination} | no route")
+    return [result or (1, 1, 1) for result in results]
+
+
+def timed(func, *args):
+    """
+    Call `func` and return the time its result was received with the result.
+    """
+    result = func(*args)
+    return datetime.now(), result
+
+
+def enrich_with_directions(df: pd.DataFrame, now: datetime,
+                           max_workers: int = MAX_WORKERS,
+                           qps: float = MAX_QPS,
+                           max_retries: int = MAX_RETRIES,
+                           base_url: str = DIRECTIONS_URL,
+                           batched: bool = False,
+                           matrix_url: str = DISTANCE_MATRIX_URL,
+                           spread: float = 0,
+                           session: requests.Session = None,
+                           api_key: str = None) -> pd.DataFrame:
     """
     Enrich the DataFrame `df` with distance (m), duration (s), and speed (km/h).
+
+    Identical (origin, destination) pairs are requested only once and the
+    result is copied to every row sharing them. With `batched`, pairs sharing
+    an origin are grouped into Distance Matrix requests of up to
+    `MATRIX_MAX_DESTINATIONS` destinations.
+
+    Requests are issued by `max_workers` threads sharing a pooled session,
+    limited to `qps` requests per second. With `spread` (seconds), they are
+    also spaced evenly over that time instead of being sent in a burst. The
+    'datetime' column of every row is the time its response was received.
     """
     if 'xy_start' not in df.columns or 'xy_end' not in df.columns:
         raise ValueError("`df` must contain 'xy_start' and 'xy_end' columns.")
 
-    api_key = load_api_key()
+    if api_key is None:
+        api_key = load_api_key()
     
     hour = int(now.strftime('%H'))
     # Initialize new columns
     df['datetime'] = now
-    df['daytime'] = ('day' if 6 <= hour < 20 else 'evening' if 20 <= hour < 22 else 'night')
+    df['daytime'] = daytime_label(hour)
     df['distance'] = 1
     df['travel_time'] = 1
     df['speed'] = 1
 
-    for idx, row in df.iterrows():
-        origin = str(row['xy_start'])
-        destination = str(row['xy_end'])
+    missing = df['xy_start'].isna() | df['xy_end'].isna()
+    for _, row in df[missing].iterrows():
+        logging.warning(f"Skipping [{row['id']}, {row['name']}] with missing coordinates.")
 
-        if pd.isna([origin, destination]).any():
-            logging.warning(f"Skipping [{row['id']}, {row['name']}] with missing coordinates.")
-            continue
+    rows = df.index[~missing]
+    pairs = list(zip(df.loc[rows, 'xy_start'].astype(str), df.loc[rows, 'xy_end'].astype(str)))
+    unique_pairs = list(dict.fromkeys(pairs))
 
-        distance, duration, speed = call_directions_api(origin, destination, api_key)
-        df.at[idx, 'distance'] = distance
-        df.at[idx, 'travel_time'] = duration
-        df.at[idx, 'speed'] = speed
+    if batched:
+        by_origin = {}
+        for origin, destination in unique_pairs:
+            by_origin.setdefault(origin, []).append(destination)
+        batches = [(origin, destinations[i:i + MATRIX_MAX_DESTINATIONS])
+                   for origin, destinations in by_origin.items()
+                   for i in range(0, len(destinations), MATRIX_MAX_DESTINATIONS)]
+    num_requests = len(batches) if batched else len(unique_pairs)
+
+    if spread > 0 and num_requests:
+        # Evenly spaced requests, unless `qps` is even lower
+        qps = min(qps, num_requests / spread) if qps > 0 else num_requests / spread
+    rate_limiter = RateLimiter(qps)
+    stats = DirectionsStats()
+    own_session = session is None
+    if own_session:
+        session = create_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            if batched:
+                results = pool.map(
+                    lambda batch: timed(call_distance_matrix_api, batch[0], batch[1], api_key, session, matrix_url,
+                                        rate_limiter, stats, max_retries),
+                    batches)
+                directions = {(origin, destination): (received, result)
+                              for (origin, destinations), (received, batch_results) in zip(batches, results)
+                              for destination, result in zip(destinations, batch_results)}
+            else:
+                results = pool.map(
+                    lambda pair: timed(call_directions_api, pair[0], pair[1], api_key, session, base_url,
+                                       rate_limiter, stats, max_retries),
+                    unique_pairs)
+                directions = dict(zip(unique_pairs, results))
+    finally:
+        if own_session:
+            session.close()
+
+    if pairs:
+        df.loc[rows, ['distance', 'travel_time', 'speed']] = [directions[pair][1] for pair in pairs]
+        df.loc[rows, 'datetime'] = [directions[pair][0] for pair in pairs]
+    logging.info(f"Directions: {len(pairs)} rows, {len(unique_pairs)} unique pairs")
+    logging.info(f"Directions requests: {stats.summary()}")
 
     return df
 
 
+#------------------------------------------------------------------------------
+#
+# Planned polling
+#
+# With a polling plan (see `polling_plan.py`), a segment is polled in the
+# cycles c (snapshot slots since the epoch) with c % period == phase. The
+# other segments keep the distance, travel time, speed and time of their
+# last observation, read from the previous snapshot, so the snapshot has the
+# same rows and columns as a full one. A previous snapshot older than
+# `POLL_MAX_PERIOD` intervals, or that cannot be read, is ignored: all the
+# segments are polled.
+#
+#------------------------------------------------------------------------------
+
+measured_columns = ['datetime', 'distance', 'travel_time', 'speed']
+
+
+def polling_cycle(moment: datetime, interval: timedelta) -> int:
+    return int(moment.timestamp() // interval.total_seconds())
+
+def due_segments(df: pd.DataFrame, plan_df: pd.DataFrame, cycle: int) -> np.ndarray:
+    """
+    Whether every row of `df` is due in `cycle`. Segments missing from the
+    plan are always due.
+    """
+    plan = plan_df.drop_duplicates(ID_JOIN).set_index(ID_JOIN)
+    period = df[ID_JOIN].map(plan['period']).fillna(1).to_numpy(dtype=np.int64)
+    phase = df[ID_JOIN].map(plan['phase']).fillna(0).to_numpy(dtype=np.int64)
+    return cycle % period == phase
+
+def previous_snapshot(output_dir: str, prefix: str, moment: datetime, interval: timedelta,
+                      max_age: int = POLL_MAX_PERIOD) -> pd.DataFrame | None:
+    """
+    Latest snapshot `prefix` in `output_dir`, if it was taken less than
+    `max_age` intervals before `moment` and can be read.
+    """
+    last = last_snapshot_time(output_dir, prefix)
+    if last is None:
+        return None
+    if moment - last > max_age * interval:
+        logging.warning(f"The previous snapshot {last} is older than {max_age} intervals, polling all the segments")
+        return None
+    try:
+        return read_file(generate_output_filename(output_dir, prefix, last))
+    except Exception as e:
+        logging.warning(f"Cannot read the previous snapshot {last}, polling all the segments: {e}")
+        return None
+
+def enrich_with_plan(df: pd.DataFrame, now: datetime, plan_df: pd.DataFrame, cycle: int,
+                     previous_df: pd.DataFrame = None, *args, **kwargs) -> pd.DataFrame:
+    """
+    `enrich_with_directions` for the rows of `df` due in `cycle`, and the last
+    observation in `previous_df` for the others. Rows without a previous
+    observation are always polled, and all of them are when `previous_df`
+    has no measurements. Only the `measured_columns` that `previous_df` has
+    are carried forward. Extra arguments are passed to
+    `enrich_with_directions`.
+    """
+    due = due_segments(df, plan_df, cycle)
+    if previous_df is not None and not {'distance', 'travel_time', 'speed'} <= set(previous_df.columns):
+        logging.warning("The previous snapshot has no measurements, polling all the segments")
+        previous_df = None
+    if previous_df is None:
+        due[:] = True
+    else:
+        previous = previous_df.drop_duplicates(ID_JOIN).set_index(ID_JOIN)
+        due |= ~df[ID_JOIN].isin(previous.index).to_numpy()
+
+    polled = enrich_with_directions(df[due].copy(), now, *args, **kwargs)
+    carried = df[~due].copy()
+    if len(carried):
+        # Column by column, so that every column keeps its dtype
+        ids = carried[ID_JOIN].to_numpy()
+        for c in measured_columns:
+            if c in previous.columns:
+                carried[c] = previous.loc[ids, c].to_numpy()
+        if 'datetime' in carried:
+            carried['datetime'] = pd.to_datetime(carried['datetime'])
+    carried['daytime'] = daytime_label(now.hour)
+    carried = carried.reindex(columns=polled.columns)
+    if len(polled) and len(carried):
+        carried = carried.astype({c: polled[c].dtype for c in measured_columns
+                                  if c in polled.columns and carried[c].notna().all()})
+
+    logging.info(f"Polled {due.sum()} of {len(df)} segments (cycle {cycle}), carried {(~due).sum()} forward")
+    return pd.concat([polled, carried]).loc[df.index]
+
+
+#------------------------------------------------------------------------------
+#
+# Resident collection
+#
+# Snapshots are taken in slots of `interval` aligned on the wall clock (e.g.
+# 12:00, 12:10, ... for 10 minutes), named after the start of their slot.
+# The requests of a slot are spread evenly over the first `COLLECT_SPREAD` of
+# it, leaving the rest for retries and writing. A slot whose snapshot is
+# missing when it starts late (startup, downtime, or an overrun of the
+# previous sweep) is collected at once, over what remains of it; the slots
+# skipped entirely are reported.
+#
+#------------------------------------------------------------------------------
+
+def slot_start(moment: datetime, interval: timedelta) -> datetime:
+    """
+    Start of the slot of `interval` containing `moment`.
+    """
+    midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight + ((moment - midnight) // interval) * interval
+
+def last_snapshot_time(output_dir: str, prefix: str) -> datetime | None:
+    """
+    Timestamp of the latest snapshot `prefix` in `output_dir`, if any.
+    """
+    times = []
+    for filename in glob.glob(os.path.join(output_dir, f"{prefix}-*.csv")):
+        try:
+            times.append(parse_filename_timestamp(filename))
+        except ValueError:
+            continue
+    return max(times, default=None)
+
+def run_schedule(input_filename: str, output_dir: str, prefix: str,
+                 interval: float = COLLECT_INTERVAL,
+                 max_workers: int = MAX_WORKERS,
+                 qps: float = MAX_QPS,
+                 max_retries: int = MAX_RETRIES,
+                 base_url: str = DIRECTIONS_URL,
+                 batched: bool = False,
+                 matrix_url: str = DISTANCE_MATRIX_URL,
+                 plan_df: pd.DataFrame = None):
+    """
+    Keep the API key, the session and the input loaded, and write a snapshot
+    of `input_filename` enriched with directions to `output_dir` every
+    `interval` minutes. The input is read again when it is modified.
+    With `plan_df`, only the segments due are polled (see `enrich_with_plan`).
+    Runs until SIGINT or SIGTERM.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    interval = timedelta(minutes=interval)
+    api_key = load_api_key()
+    input_df, input_mtime = None, None
+    last = last_snapshot_time(output_dir, prefix)
+    previous_df, previous_time = None, None
+    if plan_df is not None:
+        previous_df = previous_snapshot(output_dir, prefix, datetime.now(), interval)
+        previous_time = last if previous_df is not None else None
+
+    logging.info(f"Collecting {input_filename} every {interval}, publishing to {output_dir}")
+    with create_session(max_workers) as session:
+        while not stop.is_set():
+            now = datetime.now()
+            slot = slot_start(now, interval)
+            output_filename = generate_output_filename(output_dir, prefix, slot)
+
+            if last is not None and slot - last > interval:
+                logging.warning(f"Missed {(slot - last) // interval - 1} snapshots between {last} and {slot}")
+
+            if not os.path.isfile(output_filename):
+                remaining = (slot + interval - now).total_seconds()
+                spread = min(interval.total_seconds() * COLLECT_SPREAD, remaining * COLLECT_SPREAD)
+                if now > slot + timedelta(seconds=1):
+                    logging.warning(f"Snapshot {slot} started late, spreading over {spread:.0f}s")
+                try:
+                    if os.path.getmtime(input_filename) != input_mtime:
+                        input_mtime = os.path.getmtime(input_filename)
+                        input_df = read_file(input_filename)
+                    if plan_df is not None:
+                        if previous_time is not None and slot - previous_time > POLL_MAX_PERIOD * interval:
+                            logging.warning(f"The previous snapshot {previous_time} is older than {POLL_MAX_PERIOD} "
+                                            f"intervals, polling all the segments")
+                            previous_df, previous_time = None, None
+                        output_df = enrich_with_plan(input_df.copy(), slot, plan_df, polling_cycle(slot, interval),
+                                                     previous_df, max_workers, qps, max_retries, base_url, batched,
+                                                     matrix_url, spread, session, api_key)
+                        previous_df, previous_time = output_df, slot
+                    else:
+                        output_df = enrich_with_directions(input_df.copy(), slot, max_workers, qps, max_retries,
+                                                           base_url, batched, matrix_url, spread, session, api_key)
+                    with atomic_output(output_filename) as tmp_filename:
+                        write_csv_file(output_df, tmp_filename)
+                    logging.info(f"Snapshot {output_filename} written in {(datetime.now() - now).total_seconds():.1f}s")
+                except Exception as e:
+                    logging.error(f"Failed to collect snapshot {slot}: {e}")
+                    # The next snapshot polls all the segments
+                    previous_df, previous_time = None, None
+            last = slot
+
+            stop.wait(max(0, (slot + interval - datetime.now()).total_seconds()))
+
+    logging.info("Collection stopped")
+
+
 if __name__ == "__main__":
     now = datetime.now()
     setup_logging('collect', now)
@@ -114,14 +590,37 @@ if __name__ == "__main__":
         logging.error(f"The output directory does not exist: {args.dir}")
         sys.exit(3)
 
+    if (args.schedule or args.plan) and args.interval < 1:
+        logging.error(f"The interval must be of at least one minute: {args.interval}")
+        sys.exit(4)
+
+    if args.plan and not os.path.isfile(args.plan):
+        logging.error(f"The polling plan does not exist: {args.plan}")
+        sys.exit(1)
+    plan_df = read_file(args.plan) if args.plan else None
+
+    if args.schedule:
+        run_schedule(args.input, args.dir, args.prefix, args.interval, args.workers, args.qps, args.retries,
+                     args.url, args.batched, args.matrix_url, plan_df)
+        sys.exit(0)
+
     try:
         input_filename = args.input
         output_filename = generate_output_filename(args.dir, args.prefix, now)
 
         logging.info(f"Processing started: input={input_filename}, output={output_filename}")
         input_df = read_file(input_filename)
-        output_df = enrich_with_directions(input_df, now)
-        write_csv_file(output_df, output_filename)
+        if plan_df is not None:
+            interval = timedelta(minutes=args.interval)
+            previous_df = previous_snapshot(args.dir, args.prefix, now, interval)
+            output_df = enrich_with_plan(input_df, now, plan_df, polling_cycle(now, interval),
+                                         previous_df, args.workers, args.qps, args.retries, args.url,
+                                         args.batched, args.matrix_url)
+        else:
+            output_df = enrich_with_directions(input_df, now, args.workers, args.qps, args.retries, args.url,
+                                               args.batched, args.matrix_url)
+        with atomic_output(output_filename) as tmp_filename:
+            write_csv_file(output_df, tmp_filename)
 
     except Exception as e:
         logging.error("Fatal error occurred: {e}")
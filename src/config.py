@@ -1,8 +1,59 @@
+import os
+
 PARAMS_DIR = 'params'
 street_params_filename      = "street_params.csv"
 freq_coeffs_filename        = "freq_coeffs.csv"
 curve_A_filename            = "curve_A.csv"
 
+ID_JOIN = 'osm_id' # osm_id per Pisa, id per Brindisi?
+
 USE_PYARROW = False
 PRINT_INFO = False
-DUMP_RESULTS = False
\ No newline at end of file
+DUMP_RESULTS = False
+RESULT_FORMAT = 'csv'   # results written to a directory: csv, parquet or arrow (see `writers.py`)
+PROFILE_DIR = 'profiles'
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache')  # preprocessed parameters, see `parameters_cache.py`
+USE_CACHE = False       # enabled by `--cache`
+USE_SCHEMAS = True      # read only the needed columns, with compact dtypes (see `process_functions`)
+USE_FLOAT32 = False     # store attenuation and SPL bands as float32 (sums are still done in float64)
+
+DIRECTIONS_URL          = "https://maps.googleapis.com/maps/api/directions/json"
+DISTANCE_MATRIX_URL     = "https://maps.googleapis.com/maps/api/distancematrix/json"
+MATRIX_MAX_DESTINATIONS = 25     # destinations per Distance Matrix request
+DIRECTIONS_TIMEOUT      = 10     # seconds per request
+MAX_WORKERS             = 8      # concurrent requests
+MAX_QPS                 = 10.0   # requests per second, 0 disables the limit
+MAX_RETRIES             = 3      # retries after the first attempt
+RETRY_BACKOFF           = 0.5    # seconds, doubled at every retry
+COLLECT_INTERVAL        = 10     # minutes between two snapshots with `collect_data.py --schedule`
+COLLECT_SPREAD          = 0.8    # fraction of the interval the requests of a snapshot are spread over
+
+EMISSION_MAX_SPEED      = 200    # km/h, highest speed in the emission lookup table
+
+FULL_RECOMPUTE_EVERY    = 144    # incremental updates between full recomputes (one day of snapshots)
+
+PRUNE_FRACTION          = 0.01   # power of the pruned pairs, relative to the receiver's minimum total (see `prune_matrix.py`)
+PRUNE_MAX_FLOW_RATIO    = 3.0    # highest plausible volume/capacity ratio of a street, for the worst-case emissions
+
+POLL_INFLUENCE_DB       = 1.0    # dB, segments that can move a receiver level by more are polled every cycle (see `polling_plan.py`)
+POLL_VOLATILITY         = 0.25   # coefficient of variation of the speed of segments polled every cycle
+POLL_MAX_PERIOD         = 6      # cycles, longest interval between two polls of a segment
+
+QUERY_CELL_SIZE         = 100    # m, cell of the spatial index of the receivers (see `spatial_query.py`)
+
+SCENARIO_BATCH_MB       = 1024   # memory budget of the scenarios attenuated together (see `scenarios.py`)
+
+WATCH_INTERVAL          = 5      # seconds between two scans of the watched directory
+WATCH_SETTLE            = 2      # seconds a new file must be left unmodified before processing
+
+DAYTIME_HOURS           = {'day': 14, 'evening': 2, 'night': 8}   # see `daytime_label`
+DAYTIME_PENALTY         = {'day': 0, 'evening': 5, 'night': 10}   # dB, for Lden
+PERCENTILE_BIN_DB       = 0.5    # resolution of the L10/L90 histograms
+PERCENTILE_MAX_DB       = 130    # upper bound of the L10/L90 histograms
+
+DATASET_PARTITIONING    = ['city', 'date', 'daytime']   # hive partitions of the snapshot dataset
+INGEST_BATCH_FILES      = 144    # snapshots compacted into the same files (one day of snapshots)
+INGEST_MANIFEST         = "_ingested.json"   # snapshots already in the dataset
+
+TILE_SIZE               = 500    # m, side of the square output tiles (in the 'X/m'/'Y/m' coordinates)
+TILE_THRESHOLD_DB       = 0.1    # dB, change of any receiver level that triggers the republishing of its tile
@@ -1,6 +1,10 @@
+import os
+import glob
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from utils import *
+import pyarrow.csv as pa_csv
+from process_functions import *
 
 
 def parse_args():
@@ -12,6 +16,9 @@ def parse_args():
     parser.add_argument('-c', '--csv', action='store_true', help='Convert to csv')
     parser.add_argument('-j', '--json', action='store_true', help='Convert to json')
     parser.add_argument('-p', '--parquet', action='store_true', help='Convert to parquet')
+    parser.add_argument('-n', '--npy', action='store_true', help='Compile a Noise Attenuation Matrix to memory-mappable npy')
+    parser.add_argument('-d', '--dataset', type=str, help='Ingest the snapshots of the input directory (or glob pattern) into this partitioned Parquet dataset')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of snapshots read in parallel by --dataset')
     return parser.parse_args()
 
 def convert_to_parquet(input):
@@ -32,15 +39,135 @@ def convert_to_csv(input):
     df.to_csv(output, index=False)
     print(f"File {input} converted to {output}")
 
+def compile_matrix(input):
+    output = replace_extension(input, '.npy')
+    df = preproces_attenuation_matrix(read_file(input, schema=(attenuation_matrix_schema if USE_SCHEMAS else None)))
+    write_npy_file(compile_attenuation_matrix(df), output)
+    print(f"File {input} compiled to {output}")
+
+
+#------------------------------------------------------------------------------
+#
+# Snapshot dataset
+#
+#------------------------------------------------------------------------------
+
+def list_input_files(pattern):
+    """
+    Return the sorted csv and parquet snapshots in the directory `pattern`, or
+    matching the glob `pattern`.
+    """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '*.csv')) + glob.glob(os.path.join(pattern, '*.parquet')))
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+# Columns of the snapshot dataset. The measured columns have the dtypes of
+# `input_schema`; free-text columns are strings, whatever their content in a
+# given snapshot (e.g. 'length' holds coordinates in some of them).
+dataset_text_columns = ['name', 'xy_start', 'xy_end', 'length']
+
+def snapshot_dataset_schema():
+    """
+    Schema every snapshot is cast to before being added to the dataset.
+    """
+    arrow_types = {'int32': pa.int32(), 'float64': pa.float64(), 'category': pa.string()}
+    fields = {'id': pa.int64(), 'z_order': pa.int64()}
+    fields |= {c: pa.string() for c in dataset_text_columns}
+    fields |= {c: arrow_types[dtype] for c, dtype in input_schema.items()}
+    fields |= {'datetime': pa.timestamp('s'), 'city': pa.string(), 'date': pa.string()}
+    return pa.schema(list(fields.items()))
+
+def read_snapshot_table(filename, schema):
+    """
+    Read a snapshot into an Arrow table with the columns of `schema` (missing
+    ones are null, others are dropped), and the 'datetime' of the snapshot and
+    the 'city' and 'date' partition columns, taken from its filename (e.g.
+    "pisa-20241107-1200-Thursday.csv").
+
+    Raises:
+        ValueError: When the filename has no timestamp, or a column cannot
+                    be cast to `schema` (pa.ArrowInvalid).
+    """
+    timestamp = parse_filename_timestamp(filename)
+    table = pa_csv.read_csv(filename) if filename.endswith('.csv') else pq.read_table(filename)
+    table = table.drop_columns([c for c in ('datetime', 'city', 'date') if c in table.column_names])
+
+    n = table.num_rows
+    if 'daytime' not in table.column_names:
+        table = table.append_column('daytime', pa.array([daytime_label(timestamp.hour)] * n, pa.string()))
+    table = table.append_column('datetime', pa.array([timestamp] * n, pa.timestamp('s')))
+    table = table.append_column('city', pa.array([os.path.basename(filename).rsplit('-', 3)[0]] * n, pa.string()))
+    table = table.append_column('date', pa.array([timestamp.strftime('%Y-%m-%d')] * n, pa.string()))
+
+    columns = [table[f.name] if f.name in table.column_names else pa.nulls(n, f.type) for f in schema]
+    return pa.table(columns, names=schema.names).cast(schema)
+
+def ingest_snapshots(filenames, dataset_dir, workers=os.cpu_count(), batch_files=INGEST_BATCH_FILES):
+    """
+    Append the snapshots `filenames` to the dataset `dataset_dir`, partitioned
+    by `DATASET_PARTITIONING`, with the schema `snapshot_dataset_schema`.
+    Snapshots that cannot be read or cast are skipped. Snapshots listed in the dataset manifest are
+    skipped, so the same directory can be ingested again as new snapshots
+    arrive. Every `batch_files` snapshots are read in parallel and compacted
+    into one file per partition; the manifest is updated after every batch.
+
+    Returns:
+        int: Number of snapshots ingested.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest_filename = os.path.join(dataset_dir, INGEST_MANIFEST)
+    manifest = {}
+    if os.path.isfile(manifest_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+
+    new = [f for f in filenames if os.path.basename(f) not in manifest]
+    if not new:
+        return 0
+
+    schema = snapshot_dataset_schema()
+    def read(filename):
+        try:
+            return read_snapshot_table(filename, schema)
+        except (pa.ArrowException, ValueError, OSError) as e:
+            # Not added to the manifest: retried by the next ingest
+            logging.warning(f"Skipping snapshot {filename}: {e}")
+            return None
+
+    ingested = 0
+    run = f"{generate_filename_timestamp(datetime.now())}-{os.getpid()}"
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for b, start in enumerate(range(0, len(new), batch_files)):
+            batch = new[start:start + batch_files]
+            tables = dict(zip(batch, pool.map(read, batch)))
+            batch = [f for f in batch if tables[f] is not None]
+            if not batch:
+                continue
+            table = pa.concat_tables([tables[f] for f in batch])
+            table = table.sort_by([('datetime', 'ascending'), (ID_JOIN, 'ascending')])
+            write_dataset(table, dataset_dir, f"part-{run}-{b}-{{i}}.parquet")
+
+            manifest.update({os.path.basename(f): os.path.getmtime(f) for f in batch})
+            with atomic_output(manifest_filename) as tmp_filename:
+                with open(tmp_filename, 'w') as f:
+                    json.dump(manifest, f, indent=1)
+            ingested += len(batch)
+            print(f"Ingested {ingested}/{len(new)} snapshots into {dataset_dir}")
+    return ingested
+
 
 if __name__ == '__main__':
     args = parse_args()
 
-    if args.parquet:
-        convert_to_parquet(args.filename)
+    if args.dataset:
+        ingest_snapshots(list_input_files(args.input), args.dataset, args.workers)
+    elif args.parquet:
+        convert_to_parquet(args.input)
     elif args.json:
-        convert_to_json(args.filename)
+        convert_to_json(args.input)
     elif args.csv:
-        convert_to_csv(args.filename)
+        convert_to_csv(args.input)
+    elif args.npy:
+        compile_matrix(args.input)
     else:
         print('Please specify the format!')
\ No newline at end of file
@@ -0,0 +1,223 @@
+from process_functions import *
+
+
+#------------------------------------------------------------------------------
+#
+# Long-term indicators
+#
+# Every processed snapshot (output of `energetic_sum`) is folded into running
+# power-domain accumulators per receiver and period, so that Lday, Levening,
+# Lnight, Lden and hourly Leq can be computed over any number of snapshots
+# with O(receivers) memory. Snapshots are assumed to be equally spaced in time.
+#
+#------------------------------------------------------------------------------
+
+daytimes = list(DAYTIME_HOURS)
+hours = [f'{h:02d}' for h in range(24)]
+
+
+def equivalent_level(power: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """
+    Leq (dB) from the summed power and the number of snapshots; NaN when
+    there are no snapshots.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 0, power_to_db(power / count), np.nan)
+
+def day_evening_night_level(Lday, Levening, Lnight):
+    """
+    Lden (dB) from the day, evening and night levels, weighted by the hours
+    of each period and with the evening and night penalties.
+    """
+    levels = {'day': Lday, 'evening': Levening, 'night': Lnight}
+    weighted = sum(DAYTIME_HOURS[p] * db_to_power(levels[p] + DAYTIME_PENALTY[p]) for p in daytimes)
+    return power_to_db(weighted / sum(DAYTIME_HOURS.values()))
+
+
+class LongTermIndicators:
+    """
+    Running accumulators of the A-weighted total level ('total_db') per
+    receiver:
+
+    - power and snapshot count per daytime period and per hour of the day;
+    - the same per daytime period for the current date, returned as daily
+      indicators when a snapshot of a later date arrives;
+    - optionally, a histogram of levels per receiver with `bin_width` dB bins
+      for the L10/L90 percentiles.
+    """
+    def __init__(self, percentiles: bool = False,
+                 bin_width: float = PERCENTILE_BIN_DB,
+                 max_db: float = PERCENTILE_MAX_DB):
+        self.receivers = pd.Index([], dtype=np.int64)
+        self.coords = np.empty((0, 2))
+        self.power = np.empty((len(daytimes) + len(hours), 0))
+        self.count = np.empty((len(daytimes) + len(hours), 0), dtype=np.int64)
+        self.day_power = np.empty((len(daytimes), 0))
+        self.day_count = np.empty((len(daytimes), 0), dtype=np.int64)
+        self.current_date = None
+        self.last_timestamp = None
+        self.snapshots = 0
+
+        self.bin_width = bin_width
+        self.num_bins = int(np.ceil(max_db / bin_width))
+        self.hist = np.empty((0, self.num_bins), dtype=np.uint32) if percentiles else None
+
+    def grow(self, receivers: np.ndarray, coords: np.ndarray):
+        """
+        Adds the receivers not seen so far to the accumulators.
+        """
+        new = ~pd.Index(receivers).isin(self.receivers)
+        if not new.any():
+            return
+        n = new.sum()
+        self.receivers = self.receivers.append(pd.Index(receivers[new]))
+        self.coords = np.vstack([self.coords, coords[new]])
+        self.power = np.hstack([self.power, np.zeros((self.power.shape[0], n))])
+        self.count = np.hstack([self.count, np.zeros((self.count.shape[0], n), dtype=np.int64)])
+        self.day_power = np.hstack([self.day_power, np.zeros((len(daytimes), n))])
+        self.day_count = np.hstack([self.day_count, np.zeros((len(daytimes), n), dtype=np.int64)])
+        if self.hist is not None:
+            self.hist = np.vstack([self.hist, np.zeros((n, self.num_bins), dtype=np.uint32)])
+
+    @timer
+    def add(self, df: pd.DataFrame, timestamp: datetime) -> pd.DataFrame | None:
+        """
+        Folds the snapshot `df` (output of `energetic_sum`) taken at
+        `timestamp` into the accumulators. Snapshots must be added in
+        chronological order.
+
+        Returns:
+            pd.DataFrame | None: The daily indicators of the previous date, when
+            `timestamp` starts a new date.
+        """
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            raise ValueError(f"Snapshot {timestamp} is not later than the last one ({self.last_timestamp}).")
+
+        finished = None
+        if self.current_date is not None and timestamp.date() != self.current_date:
+            finished = self.flush_day()
+        self.current_date = timestamp.date()
+        self.last_timestamp = timestamp
+        self.snapshots += 1
+
+        receivers = df['receiver'].to_numpy()
+        self.grow(receivers, df[['X/m', 'Y/m']].to_numpy(dtype=float))
+        idx = self.receivers.get_indexer(receivers)
+        level = df['total_db'].to_numpy(dtype=float)
+        power = db_to_power(level)
+
+        d = daytimes.index(daytime_label(timestamp.hour))
+        h = len(daytimes) + timestamp.hour
+        for period in (d, h):
+            self.power[period, idx] += power
+            self.count[period, idx] += 1
+        self.day_power[d, idx] += power
+        self.day_count[d, idx] += 1
+
+        if self.hist is not None:
+            bins = np.clip((level / self.bin_width).astype(int), 0, self.num_bins - 1)
+            np.add.at(self.hist, (idx, bins), 1)
+
+        return finished
+
+    def flush_day(self) -> pd.DataFrame | None:
+        """
+        Returns the daily indicators of the current date and resets them.
+        """
+        if self.current_date is None:
+            return None
+
+        levels = {p: equivalent_level(self.day_power[i], self.day_count[i]) for i, p in enumerate(daytimes)}
+        seen = self.day_count.sum(axis=0) > 0
+        daily = pd.DataFrame({
+            'date': self.current_date,
+            'receiver': self.receivers,
+            'Lday': levels['day'],
+            'Levening': levels['evening'],
+            'Lnight': levels['night'],
+            'Lden': day_evening_night_level(levels['day'], levels['evening'], levels['night']),
+            'Leq': equivalent_level(self.day_power.sum(axis=0), self.day_count.sum(axis=0)),
+        })
+        self.day_power[:] = 0
+        self.day_count[:] = 0
+        return daily[seen].reset_index(drop=True)
+
+    def percentile_level(self, exceeded: float) -> np.ndarray:
+        """
+        Level (dB) exceeded during `exceeded` percent of the snapshots, e.g. 10
+        for L10, from the histograms (bin centers).
+        """
+        total = self.hist.sum(axis=1)
+        cumulative = self.hist.cumsum(axis=1)
+        idx = (cumulative < total[:, None] * (1 - exceeded / 100)).sum(axis=1)
+        return np.where(total > 0, (idx + 0.5) * self.bin_width, np.nan)
+
+    @timer
+    def results(self) -> pd.DataFrame:
+        """
+        Returns the long-term indicators per receiver: Lday, Levening, Lnight,
+        Lden, overall Leq, Leq per hour of the day and, if enabled, L10/L90.
+        """
+        levels = {p: equivalent_level(self.power[i], self.count[i]) for i, p in enumerate(daytimes)}
+        agg = pd.DataFrame({
+            'receiver': self.receivers,
+            'X/m': self.coords[:, 0],
+            'Y/m': self.coords[:, 1],
+            'snapshots': self.count[:len(daytimes)].sum(axis=0),
+            'Lday': levels['day'],
+            'Levening': levels['evening'],
+            'Lnight': levels['night'],
+            'Lden': day_evening_night_level(levels['day'], levels['evening'], levels['night']),
+            'Leq': equivalent_level(self.power[:len(daytimes)].sum(axis=0), self.count[:len(daytimes)].sum(axis=0)),
+        })
+        for i, h in enumerate(hours):
+            agg[f'Leq_{h}'] = equivalent_level(self.power[len(daytimes) + i], self.count[len(daytimes) + i])
+        if self.hist is not None:
+            agg['L10'] = self.percentile_level(10)
+            agg['L90'] = self.percentile_level(90)
+        return agg
+
+    def save(self, filename: str):
+        """
+        Checkpoints the accumulators to the npz file `filename`.
+        """
+        state = {
+            'receivers': self.receivers.to_numpy(),
+            'coords': self.coords,
+            'power': self.power,
+            'count': self.count,
+            'day_power': self.day_power,
+            'day_count': self.day_count,
+            'current_date': str(self.current_date or ''),
+            'last_timestamp': str(self.last_timestamp or ''),
+            'snapshots': self.snapshots,
+            'bin_width': self.bin_width,
+        }
+        if self.hist is not None:
+            state['hist'] = self.hist
+        with atomic_output(filename) as tmp_filename:
+            with open(tmp_filename, 'wb') as f:
+                np.savez_compressed(f, **state)
+
+    @classmethod
+    def load(cls, filename: str) -> 'LongTermIndicators':
+        """
+        Resumes the accumulators from a checkpoint written by `save`.
+        """
+        with np.load(filename) as state:
+            indicators = cls(percentiles='hist' in state, bin_width=float(state['bin_width']))
+            indicators.receivers = pd.Index(state['receivers'])
+            indicators.coords = state['coords']
+            indicators.power = state['power']
+            indicators.count = state['count']
+            indicators.day_power = state['day_power']
+            indicators.day_count = state['day_count']
+            indicators.snapshots = int(state['snapshots'])
+            if str(state['current_date']):
+                indicators.current_date = datetime.fromisoformat(str(state['current_date'])).date()
+            if str(state['last_timestamp']):
+                indicators.last_timestamp = datetime.fromisoformat(str(state['last_timestamp']))
+            if 'hist' in state:
+                indicators.hist = state['hist']
+                indicators.num_bins = indicators.hist.shape[1]
+        return indicators
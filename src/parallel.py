@@ -0,0 +1,154 @@
+from attenuation_operator import *
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+#------------------------------------------------------------------------------
+#
+# Multi-core attenuation stage
+#
+# The preprocessed attenuation matrix (compiled, see
+# `compile_attenuation_matrix`) or the arrays of the sparse operator are
+# copied once into shared memory blocks. Worker processes attach to them at
+# startup and build zero-copy views of every partition once, so the matrix
+# is neither copied per worker nor per snapshot. For every snapshot, the receivers are split into one contiguous range per
+# worker, balanced by number of matrix rows, and the per-receiver results are
+# concatenated in receiver order.
+#
+#------------------------------------------------------------------------------
+
+shared_blocks = []   # SharedMemory blocks attached by this process
+shared_arrays = {}   # name -> array view on a shared block
+shared_partitions = {}   # (start, stop) -> matrix frame or operator of a partition, on the shared blocks
+
+
+def share_array(array: np.ndarray) -> tuple[shared_memory.SharedMemory, tuple]:
+    """
+    Copies `array` into a new shared memory block.
+
+    Returns:
+        tuple: The block, and the (block name, dtype, shape) descriptor
+        workers pass to `attach_array`.
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    view[...] = array
+    return block, (block.name, array.dtype, array.shape)
+
+def attach_array(descriptor: tuple) -> np.ndarray:
+    name, dtype, shape = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    shared_blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def partition_operator(start: int, stop: int) -> AttenuationOperator:
+    """
+    Operator of the receivers [`start`, `stop`) of the shared operator.
+    """
+    indptr = shared_arrays['indptr'][start:stop + 1]
+    return AttenuationOperator(
+        receivers=shared_arrays['receivers'][start:stop],
+        coords=shared_arrays['coords'][start:stop],
+        sources=None,
+        indptr=indptr - indptr[0],
+        cols=shared_arrays['cols'][indptr[0]:indptr[-1]],
+        factors=shared_arrays['factors'][indptr[0]:indptr[-1]],
+    )
+
+def init_shared_worker(descriptors: dict, partitions: list[tuple[int, int]]):
+    for name, descriptor in descriptors.items():
+        shared_arrays[name] = attach_array(descriptor)
+    for start, stop in partitions:
+        if 'records' in shared_arrays:
+            shared_partitions[start, stop] = load_compiled_attenuation_matrix(shared_arrays['records'], start, stop)
+        else:
+            shared_partitions[start, stop] = partition_operator(start, stop)
+
+def matrix_partition_sum(start: int, stop: int, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    `energetic_sum(noise_attenuation(df, matrix))` over the rows [`start`,
+    `stop`) of the shared compiled matrix.
+    """
+    return energetic_sum(noise_attenuation(df, shared_partitions[start, stop]))
+
+def operator_partition_sum(start: int, stop: int, layers: list[np.ndarray]) -> pd.DataFrame:
+    """
+    `apply_attenuation_operator` over the receivers [`start`, `stop`) of the
+    shared operator, from the per-source powers of `source_powers`.
+    """
+    op = shared_partitions[start, stop]
+    power = np.zeros((len(op.receivers), len(freqs)))
+    received = np.zeros(len(op.receivers), dtype=bool)
+    for P in layers:
+        layer_power, layer_received = attenuate(op, P)
+        power += layer_power
+        received |= layer_received
+    return receiver_levels(op, power[received], received)
+
+
+class ParallelEnergeticSum:
+    """
+    Computes the attenuation stage of a snapshot (`noise_attenuation` +
+    `energetic_sum`, or `apply_attenuation_operator` when `op` is given) over
+    `num_workers` processes sharing the matrix.
+
+    The shared blocks live until `close`.
+    """
+    def __init__(self, num_workers: int, matrix_df: pd.DataFrame = None, op: AttenuationOperator = None):
+        self.num_workers = num_workers
+        self.sources = None
+        self.blocks = []
+        descriptors = {}
+
+        if op is not None:
+            self.sources = op.sources
+            for name in ('receivers', 'coords', 'indptr', 'cols', 'factors'):
+                block, descriptors[name] = share_array(np.ascontiguousarray(getattr(op, name)))
+                self.blocks.append(block)
+            # Receiver ranges with about the same number of non-zeros
+            targets = np.linspace(0, op.indptr[-1], num_workers + 1)
+            bounds = np.searchsorted(op.indptr, targets, side='left')
+            bounds[-1] = len(op.receivers)
+        else:
+            records = compile_attenuation_matrix(matrix_df)
+            block, descriptors['records'] = share_array(records)
+            self.blocks.append(block)
+            # Row ranges with about the same number of rows, cut between receivers
+            receivers = compiled_matrix_columns(records)['receiver']
+            targets = np.linspace(0, len(receivers), num_workers + 1).astype(np.int64)[1:-1]
+            bounds = np.concatenate([[0], np.searchsorted(receivers, receivers[targets], side='left'), [len(receivers)]])
+            del records, receivers
+
+        self.partitions = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+        self.pool = ProcessPoolExecutor(max_workers=num_workers, initializer=init_shared_worker,
+                                        initargs=(descriptors, self.partitions))
+        logging.info(f"Shared the attenuation matrix ({sum(b.size for b in self.blocks) / 2**20:.1f} MB) "
+                     f"with {num_workers} workers")
+
+    @timer
+    def energetic_sum(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Computes the energetic sum per receiver of the SPLs in `df` (output of
+        `sound_pressure_levels`).
+
+        Returns:
+            pd.DataFrame: Aggregated SPL per receiver with total dB and per-frequency dB values.
+        """
+        if self.sources is not None:
+            layers = source_powers(AttenuationOperator(None, None, self.sources, None, None, None), df)
+            futures = [self.pool.submit(operator_partition_sum, a, b, layers) for a, b in self.partitions]
+        else:
+            keys = [ID_JOIN, 'vehicle_type']
+            futures = [self.pool.submit(matrix_partition_sum, a, b, df[keys + freqs]) for a, b in self.partitions]
+
+        results = [f.result() for f in futures]
+        if not results:
+            return pd.DataFrame(columns=['receiver', 'X/m', 'Y/m', *freqs, 'total_db'])
+        return pd.concat(results, ignore_index=True)
+
+    def close(self):
+        self.pool.shutdown()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
@@ -0,0 +1,228 @@
+import os
+import sys
+import glob
+import hashlib
+import argparse
+from attenuation_operator import *
+
+
+CACHE_VERSION = 2  # increase when the preprocessing functions change their output
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Warm or clear the cache of preprocessed parameters.")
+    parser.add_argument('-m', '--matrix', required=False, help="Noise Attenuation Matrix to preprocess (csv, json, parquet or compiled npy).", default=None)
+    parser.add_argument('-s', '--sparse', required=False, help="Also cache the sparse attenuation operator.", action='store_true')
+    parser.add_argument('-w', '--warm',   required=False, help="Preprocess the parameters and the matrix if they are not cached yet.", action='store_true')
+    parser.add_argument('-c', '--clear',  required=False, help="Remove every cached file.", action='store_true')
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Cache keys
+#
+# Every artifact is stored under the hash of the content of its source files
+# and of the settings the preprocessing depends on, so that it is invalidated
+# as soon as any of them changes. Digests of large files are memoized by size
+# and modification time to avoid hashing them at every startup, in one file
+# per source file, so that concurrent processes never rewrite each other's.
+# Only the cache keys memoize digests, and memos of files that are gone or
+# changed are pruned when the cache is stored or warmed.
+#
+#------------------------------------------------------------------------------
+
+def digest_filename(path: str) -> str:
+    return cache_filename('digest', hashlib.sha256(path.encode()).hexdigest()[:16], '.json')
+
+def read_digest(filename: str) -> dict | None:
+    """
+    Memo `filename`, if it is readable and still matches its file.
+    """
+    try:
+        with open(filename) as f:
+            entry = json.load(f)
+        stat = os.stat(entry['path'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return entry if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns else None
+
+def file_digest(filename: str, memoize: bool = False) -> str:
+    """
+    SHA-256 of the content of `filename`. With `memoize`, it is stored in
+    the cache and only computed again when the file changes.
+    """
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    if memoize:
+        entry = read_digest(digest_filename(path))
+        if entry is not None and entry['path'] == path:
+            return entry['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha256.update(block)
+    entry = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+    if not memoize:
+        return entry['sha256']
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with atomic_output(digest_filename(path)) as tmp_filename:
+        with open(tmp_filename, 'w') as f:
+            json.dump(entry, f, indent=1)
+    return entry['sha256']
+
+def prune_digests() -> int:
+    """
+    Removes the memos of files that are gone or changed.
+
+    Returns:
+        int: Number of removed memos.
+    """
+    stale = [f for f in glob.glob(os.path.join(CACHE_DIR, 'digest-*.json')) if read_digest(f) is None]
+    for filename in stale:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+    return len(stale)
+
+def cache_key(filenames: list[str], settings: dict) -> str:
+    content = [CACHE_VERSION, [file_digest(f, memoize=True) for f in filenames], sorted((k, repr(v)) for k, v in settings.items())]
+    return hashlib.sha256(repr(content).encode()).hexdigest()[:16]
+
+def parameters_key() -> str:
+    filenames = [os.path.join(PARAMS_DIR, f) for f in (street_params_filename, freq_coeffs_filename, curve_A_filename)]
+    return cache_key(filenames, {
+        'coeffs': (f1_coeff, f2_coeff, f3_coeff, f4_coeff),
+        'freqs': freqs,
+        'vehicle_types': vehicle_types,
+        'max_speed': EMISSION_MAX_SPEED,
+    })
+
+def matrix_key(matrix_filename: str) -> str:
+    return cache_key([matrix_filename], {
+        'id_join': ID_JOIN,
+        'freqs': freqs,
+        'vehicle_types': vehicle_types,
+        'schema': attenuation_matrix_schema if USE_SCHEMAS else None,
+    })
+
+def cache_filename(kind: str, key: str, ext: str) -> str:
+    return os.path.join(CACHE_DIR, f"{kind}-{key}{ext}")
+
+
+#------------------------------------------------------------------------------
+#
+# Load and store
+#
+#------------------------------------------------------------------------------
+
+def save_operator(op: AttenuationOperator, filename: str):
+    with atomic_output(filename) as tmp_filename:
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, receivers=op.receivers, coords=op.coords,
+                     source_ids=op.sources.get_level_values(0).to_numpy(),
+                     source_types=op.sources.get_level_values(1).to_numpy(dtype=str),
+                     indptr=op.indptr, cols=op.cols, factors=op.factors)
+
+def load_operator(filename: str) -> AttenuationOperator:
+    with np.load(filename) as data:
+        return AttenuationOperator(
+            receivers=data['receivers'],
+            coords=data['coords'],
+            sources=pd.MultiIndex.from_arrays([data['source_ids'], data['source_types']], names=[ID_JOIN, 'vehicle_type']),
+            indptr=data['indptr'],
+            cols=data['cols'],
+            factors=data['factors'],
+        )
+
+@timer
+def load_cached_parameters(matrix_filename: str, matrix: bool = True, operator: bool = False):
+    """
+    Loads the preprocessed parameters, matrix (if `matrix`) and sparse
+    operator (if `operator`) stored by `store_cached_parameters` for the
+    current content of their source files.
+
+    Returns:
+        tuple | None: (street_params_df, freq_coeffs_df, curve_A_df,
+        emission_table, attenuation_matrix_df, attenuation_operator), or None
+        when any of the requested artifacts is not cached. The matrix is an
+        empty DataFrame and the operator None when not requested.
+    """
+    params_filename = cache_filename('params', parameters_key(), '.pkl')
+    key = matrix_key(matrix_filename)
+    # Compiled matrices are loaded directly
+    compiled_filename = matrix_filename if matrix_filename.endswith('.npy') else cache_filename('matrix', key, '.npy')
+    operator_filename = cache_filename('operator', key, '.npz')
+
+    needed = [params_filename] + ([compiled_filename] if matrix else []) + ([operator_filename] if operator else [])
+    if not all(os.path.isfile(f) for f in needed):
+        return None
+
+    street_params_df, freq_coeffs_df, curve_A_df, emission_table = pd.read_pickle(params_filename)
+    attenuation_matrix_df = load_compiled_attenuation_matrix(read_npy_file(compiled_filename)) if matrix else pd.DataFrame()
+    attenuation_operator = load_operator(operator_filename) if operator else None
+    return street_params_df, freq_coeffs_df, curve_A_df, emission_table, attenuation_matrix_df, attenuation_operator
+
+@timer
+def store_cached_parameters(matrix_filename: str, street_params_df: pd.DataFrame, freq_coeffs_df: pd.DataFrame,
+                            curve_A_df: pd.DataFrame, emission_table: EmissionTable,
+                            attenuation_matrix_df: pd.DataFrame = None,
+                            attenuation_operator: AttenuationOperator = None):
+    """
+    Stores the preprocessed parameters and, when given, the preprocessed
+    matrix (compiled, see `compile_attenuation_matrix`) and the sparse
+    operator, keyed by the content of their source files.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with atomic_output(cache_filename('params', parameters_key(), '.pkl')) as tmp_filename:
+        pd.to_pickle((street_params_df, freq_coeffs_df, curve_A_df, emission_table), tmp_filename, compression=None)
+
+    prune_digests()
+    key = matrix_key(matrix_filename)
+    if attenuation_matrix_df is not None and not attenuation_matrix_df.empty and not matrix_filename.endswith('.npy'):
+        with atomic_output(cache_filename('matrix', key, '.npy')) as tmp_filename:
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, compile_attenuation_matrix(attenuation_matrix_df))
+    if attenuation_operator is not None:
+        save_operator(attenuation_operator, cache_filename('operator', key, '.npz'))
+
+def clear_cache() -> int:
+    """
+    Removes every cached file.
+
+    Returns:
+        int: Number of removed files.
+    """
+    filenames = [f for pattern in ('params-*.pkl', 'matrix-*.npy', 'operator-*.npz', 'digest-*.json')
+                 for f in glob.glob(os.path.join(CACHE_DIR, pattern))]
+    for filename in filenames:
+        os.remove(filename)
+    return len(filenames)
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("cache", now, debug=True)
+
+    args = parse_args()
+
+    if args.clear:
+        logging.info(f"Removed {clear_cache()} files from {CACHE_DIR}")
+
+    if args.warm:
+        if not args.matrix or not os.path.isfile(args.matrix):
+            logging.error(f"The Noise Attenuation matrix does not exists: {args.matrix}")
+            sys.exit(2)
+        logging.info(f"Removed {prune_digests()} stale digests from {CACHE_DIR}")
+
+        import process
+        process.attenuation_matrix_filename = args.matrix
+        process.use_sparse = args.sparse
+        process.use_cache = True
+        process.load_parameters()
@@ -0,0 +1,144 @@
+import os
+import sys
+import glob
+import argparse
+from process_functions import *
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Plan how often `collect_data` polls every street segment, from its influence on the receivers.")
+    parser.add_argument('-m', '--matrix',    required=True,  help="Noise Attenuation Matrix (csv, json, parquet or compiled npy).")
+    parser.add_argument('-i', '--input',     required=True,  help="Input CSV file of `collect_data` (the segments to poll).")
+    parser.add_argument('-o', '--output',    required=True,  help="Polling plan (csv).")
+    parser.add_argument('-H', '--history',   required=False, help="Glob pattern of past snapshots, to measure the volatility of the segments.", default=None)
+    parser.add_argument('-r', '--reference', required=False, help="Snapshot the influence of the segments is measured on (default: the latest of `--history`, or `--input`).", default=None)
+    parser.add_argument('--influence',       required=False, help="Influence (dB) of the segments polled every cycle.", type=float, default=POLL_INFLUENCE_DB)
+    parser.add_argument('--volatility',      required=False, help="Speed coefficient of variation of the segments polled every cycle.", type=float, default=POLL_VOLATILITY)
+    parser.add_argument('--max-period',      required=False, help="Longest interval (cycles) between two polls of a segment.", type=int, default=POLL_MAX_PERIOD)
+    parser.add_argument('-f', '--force',     required=False, help="Force rewrite output file.", action='store_true')
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Polling plan
+#
+# The influence of a segment is the share of the level of the receivers it
+# is responsible for in a reference snapshot: the largest drop, in dB, of
+# any band of any receiver if the segment went silent. Segments with an
+# influence of at least `influence` dB, or whose speed varied by at least
+# `volatility` (coefficient of variation) in the past snapshots, are polled
+# every cycle. The others are polled every `period` cycles, longer for
+# weaker segments, up to `max_period`; their phases are spread so that every
+# cycle polls about as many of them.
+#
+#------------------------------------------------------------------------------
+
+@timer
+def segment_influence(attenuated_df: pd.DataFrame) -> pd.Series:
+    """
+    Influence (dB) of every source of `attenuated_df` (output of
+    `noise_attenuation` for the reference snapshot).
+    """
+    df = attenuated_df[['receiver', ID_JOIN]].copy()
+    df[freqs] = db_to_power(attenuated_df[freqs].clip(lower=0).astype('float64'))
+
+    # All the vehicle types of a segment change together
+    contributions = df.groupby(['receiver', ID_JOIN])[freqs].sum()
+    totals = contributions.groupby(level='receiver').sum()
+    rest = totals.reindex(contributions.index.get_level_values('receiver')).to_numpy() - contributions.to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drop = power_to_db(contributions.to_numpy() + rest) - power_to_db(np.maximum(rest, 0))
+    influence = pd.Series(np.nan_to_num(drop, nan=0.0).max(axis=1), index=contributions.index.get_level_values(ID_JOIN))
+    return influence.groupby(level=0).max()
+
+def segment_volatility(history_filenames: list[str]) -> pd.Series:
+    """
+    Coefficient of variation of the speed of every segment over the
+    snapshots `history_filenames`.
+    """
+    speeds = pd.concat([read_file(f, schema={ID_JOIN: 'int32', 'speed': 'float64'}) for f in history_filenames])
+    stats = speeds.groupby(ID_JOIN)['speed'].agg(['std', 'mean'])
+    return (stats['std'] / stats['mean']).fillna(0)
+
+def polling_plan(
+    segments: pd.Series,
+    influence: pd.Series,
+    volatility: pd.Series = None,
+    min_influence: float = POLL_INFLUENCE_DB,
+    min_volatility: float = POLL_VOLATILITY,
+    max_period: int = POLL_MAX_PERIOD
+) -> pd.DataFrame:
+    """
+    Polling period and phase (in cycles) of every segment of `segments`
+    (ID_JOIN values): a segment is polled in the cycles c with
+    c % period == phase.
+    """
+    plan = pd.DataFrame({ID_JOIN: pd.unique(segments)})
+    plan['influence_db'] = plan[ID_JOIN].map(influence).fillna(0.0)
+    plan['volatility'] = plan[ID_JOIN].map(volatility).fillna(0.0) if volatility is not None else 0.0
+
+    with np.errstate(divide='ignore'):
+        period = np.floor(min_influence / plan['influence_db'].to_numpy())
+    period = np.clip(np.nan_to_num(period, posinf=max_period), 1, max_period).astype(int)
+    period[(plan['influence_db'] >= min_influence) | (plan['volatility'] >= min_volatility)] = 1
+    plan['period'] = period
+
+    # Round-robin phases within every period
+    plan['phase'] = plan.groupby('period').cumcount() % plan['period']
+    return plan
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("plan", now, debug=True)
+
+    args = parse_args()
+
+    if not os.path.isfile(args.input):
+        logging.error(f"The input file does not exist: {args.input}")
+        sys.exit(1)
+
+    if not os.path.isfile(args.matrix):
+        logging.error(f"The Noise Attenuation matrix does not exists: {args.matrix}")
+        sys.exit(2)
+
+    if os.path.exists(args.output) and not args.force:
+        logging.error(f"The output file already exists: {args.output}")
+        sys.exit(3)
+
+    street_params_df = preprocess_street_params(read_file(street_params_filename, PARAMS_DIR))
+    freq_coeffs_df   = preprocess_freq_coeffs(read_file(freq_coeffs_filename, PARAMS_DIR))
+    curve_A_df       = read_file(curve_A_filename, PARAMS_DIR)
+    emission_table   = build_emission_table(freq_coeffs_df, curve_A_df)
+
+    if args.matrix.endswith('.npy'):
+        matrix_df = load_compiled_attenuation_matrix(read_npy_file(args.matrix))
+    else:
+        matrix_df = preproces_attenuation_matrix(read_file(args.matrix,
+                                                           schema=(attenuation_matrix_schema if USE_SCHEMAS else None)))
+
+    input_df = read_file(args.input)
+    history = sorted(glob.glob(args.history)) if args.history else []
+    reference_filename = args.reference or (history[-1] if history else args.input)
+    if not set(input_schema) <= set(read_file(reference_filename).columns):
+        logging.error(f"The reference snapshot has no measurements: {reference_filename}")
+        sys.exit(1)
+
+    reference_df = read_file(reference_filename, schema=(input_schema if USE_SCHEMAS else None))
+    sound_pressure_levels_df = sound_pressure_levels(equivalent_flows(reference_df, street_params_df),
+                                                     freq_coeffs_df, curve_A_df, emission_table)
+    influence = segment_influence(noise_attenuation(sound_pressure_levels_df, matrix_df))
+    volatility = segment_volatility(history) if history else None
+    logging.info(f"Influence relative to the levels of {reference_filename}")
+
+    plan_df = polling_plan(input_df[ID_JOIN], influence, volatility, args.influence, args.volatility, args.max_period)
+    with atomic_output(args.output) as tmp_filename:
+        write_csv_file(plan_df, tmp_filename)
+
+    polls = (1 / plan_df['period']).sum()
+    logging.info(f"Planned {len(plan_df)} segments: {(plan_df['period'] == 1).sum()} every cycle, "
+                 f"{polls:.0f} polls per cycle on average ({polls / max(1, len(plan_df)):.0%})")
@@ -1,7 +1,20 @@
 import os
 import sys
+import glob
+import json
+import time
+import signal
+import atexit
 import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from process_functions import *
+from attenuation_operator import *
+from parameters_cache import *
+from tiles import *
+from parallel import *
+from writers import *
+from shards import *
 from datetime import datetime, timedelta
 
 
@@ -10,17 +23,49 @@ street_params_df      = pd.DataFrame()
 freq_coeffs_df        = pd.DataFrame()
 curve_A_df            = pd.DataFrame()
 attenuation_matrix_df = pd.DataFrame()
+attenuation_operator  = None
+emission_table        = None
+incremental_engine    = None
+use_sparse            = False
+use_incremental       = False
+use_cache             = USE_CACHE
+tile_publisher        = None
+parallel_engine       = None
+memory_budget_mb      = 0
+output_format         = None
+output_float32        = False
+result_dataset        = None
 
 def parse_args():
     """
     Parse command-line arguments.
     """
     parser = argparse.ArgumentParser(description="...") # TODO
-    parser.add_argument('-i', '--input',  required=True,  help="Path to input CSV file.")
-    parser.add_argument('-m', '--matrix', required=True,  help="Path to the Noise Attenuation Matrix.")
-    parser.add_argument('-o', '--output', required=True,  help="Name of output file.")
+    parser.add_argument('-i', '--input',  required=True,  help="Path to input CSV file (directory or glob pattern with `--batch` or `--watch`).")
+    parser.add_argument('-m', '--matrix', required=True,  help="Path to the Noise Attenuation Matrix (csv, json, parquet or compiled npy).")
+    parser.add_argument('-o', '--output', required=True,  help="Name of output file (output directory with `--batch` or `--watch`).")
     parser.add_argument('-f', '--force' , required=False, help="Force rewrite output file.", action='store_true')
-    return parser.parse_args()
+    parser.add_argument('-b', '--batch' , required=False, help="Process every snapshot matching `--input`.", action='store_true')
+    parser.add_argument('-j', '--jobs'  , required=False, help="Number of worker processes in batch mode.", type=int, default=1)
+    parser.add_argument('-w', '--watch' , required=False, help="Keep running and process new snapshots matching `--input` as they arrive.", action='store_true')
+    parser.add_argument('--status'      , required=False, help="JSON file where watch mode publishes health and latency stats.", default=None)
+    parser.add_argument('--metrics'     , required=False, help="JSON lines file where per-stage metrics are appended.", default=None)
+    parser.add_argument('--prometheus'  , required=False, help="Prometheus textfile where per-stage metrics are published.", default=None)
+    parser.add_argument('--profile'     , required=False, help="Comma-separated stages to run under cProfile (dumped to `PROFILE_DIR`).", default='')
+    parser.add_argument('-s', '--sparse', required=False, help="Use the sparse attenuation operator instead of merging the matrix.", action='store_true')
+    parser.add_argument('-n', '--incremental', required=False, help="Update the previous snapshot's levels with the changed sources only (implies `--sparse`).", action='store_true')
+    parser.add_argument('-t', '--tiles' , required=False, help="Publish the changed spatial tiles (Parquet) and a manifest per snapshot to the `--output` directory instead of CSV files.", action='store_true')
+    parser.add_argument('--cache'       , required=False, help="Load the preprocessed parameters from the cache (`CACHE_DIR`), and store them in it.", action='store_true')
+    parser.add_argument('-p', '--parallel', required=False, help="Number of worker processes sharing the attenuation matrix for every snapshot.", type=int, default=1)
+    parser.add_argument('-c', '--chunked', required=False, help="Stream the matrix (sorted by receiver) in chunks within the given memory budget (MB).", type=float, default=0)
+    parser.add_argument('--format'      , required=False, help="Format of the results (default: from the `--output` extension, or `RESULT_FORMAT` for a directory).", choices=['csv', 'parquet', 'arrow'], default=None)
+    parser.add_argument('--float32'     , required=False, help="Store the bands of parquet and arrow results as float32.", action='store_true')
+    parser.add_argument('--shard'       , required=False, help="Process shard 'k/N' of the matrix split by `shards.py` into the `--matrix` directory.", default=None)
+    parser.add_argument('-d', '--dataset', required=False, help="Append the results of every snapshot to the Parquet dataset in the `--output` directory.", action='store_true')
+    args = parser.parse_args()
+    if args.chunked > 0 and not args.shard and os.path.splitext(args.matrix)[1] not in chunked_matrix_formats:
+        parser.error(f"`--chunked` reads the matrix in chunks: it must be one of {', '.join(chunked_matrix_formats)}, not {args.matrix}")
+    return args
 
 @timer
 def read_parameters():
@@ -30,32 +75,332 @@ def read_parameters():
     street_params_df      = read_file(street_params_filename, PARAMS_DIR)
     freq_coeffs_df        = read_file(freq_coeffs_filename, PARAMS_DIR)
     curve_A_df            = read_file(curve_A_filename, PARAMS_DIR)
-    attenuation_matrix_df = read_file(attenuation_matrix_filename)
+    if memory_budget_mb > 0:
+        # The matrix is streamed by `process_data_chunked`
+        return
+    if attenuation_matrix_filename.endswith('.npy'):
+        attenuation_matrix_df = load_compiled_attenuation_matrix(read_npy_file(attenuation_matrix_filename))
+    else:
+        attenuation_matrix_df = read_file(attenuation_matrix_filename,
+                                          schema=(attenuation_matrix_schema if USE_SCHEMAS else None))
 
 @timer
 def preprocess_parameters():
-    global street_params_df, freq_coeffs_df, attenuation_matrix_df
+    global street_params_df, freq_coeffs_df, attenuation_matrix_df, attenuation_operator, incremental_engine, emission_table
 
     logging.info("Preprocessing 'street_params', 'coeff_freq', and 'attenuation_matrix'...")
     street_params_df      = preprocess_street_params(street_params_df)
     freq_coeffs_df        = preprocess_freq_coeffs(freq_coeffs_df)
-    attenuation_matrix_df = preproces_attenuation_matrix(attenuation_matrix_df)
+    emission_table        = build_emission_table(freq_coeffs_df, curve_A_df)
+    if memory_budget_mb > 0:
+        return
+    if not attenuation_matrix_filename.endswith('.npy'):
+        # Compiled matrices are already preprocessed
+        attenuation_matrix_df = preproces_attenuation_matrix(attenuation_matrix_df)
+    if use_sparse or use_incremental:
+        attenuation_operator = build_attenuation_operator(attenuation_matrix_df)
+    if use_incremental:
+        incremental_engine = IncrementalEnergeticSum(attenuation_operator)
+
+@timer
+def load_parameters():
+    """
+    Reads and preprocesses the parameters. With `use_cache`, they are loaded
+    from the cache of preprocessed parameters instead when their source files
+    did not change, and stored in it otherwise.
+    """
+    global street_params_df, freq_coeffs_df, curve_A_df, emission_table
+    global attenuation_matrix_df, attenuation_operator, incremental_engine
+
+    matrix = memory_budget_mb <= 0
+    operator = matrix and (use_sparse or use_incremental)
+    if use_cache:
+        cached = load_cached_parameters(attenuation_matrix_filename, matrix, operator)
+        if cached is not None:
+            logging.info("Loaded the preprocessed parameters from the cache")
+            (street_params_df, freq_coeffs_df, curve_A_df, emission_table,
+             attenuation_matrix_df, attenuation_operator) = cached
+            if use_incremental and matrix:
+                incremental_engine = IncrementalEnergeticSum(attenuation_operator)
+            return
+
+    read_parameters()
+    preprocess_parameters()
+    if use_cache:
+        store_cached_parameters(attenuation_matrix_filename, street_params_df, freq_coeffs_df, curve_A_df,
+                                emission_table, attenuation_matrix_df if matrix else None, attenuation_operator)
+
+def start_parallel(num_workers: int):
+    """
+    Moves the attenuation matrix (or the sparse operator) to the shared memory
+    of `num_workers` processes that compute the attenuation stage of every
+    snapshot (see `ParallelEnergeticSum`).
+    """
+    global parallel_engine, attenuation_matrix_df, attenuation_operator
+
+    if num_workers <= 1:
+        return
+    parallel_engine = ParallelEnergeticSum(num_workers, attenuation_matrix_df, attenuation_operator)
+    atexit.register(parallel_engine.close)
+    # Only the shared copy is used from now on
+    attenuation_matrix_df = pd.DataFrame()
+    attenuation_operator = None
 
 @timer
 def process_data(filename):
     global street_params_df, freq_coeffs_df, curve_A_df, attenuation_matrix_df
 
     logging.info("Reading input data...")
-    data_df = read_file(filename)
+    data_df = read_file(filename, schema=(input_schema if USE_SCHEMAS else None))
 
     logging.info("Starting computation...")
     equivalent_flows_df      = equivalent_flows(data_df, street_params_df)
-    sound_pressure_levels_df = sound_pressure_levels(equivalent_flows_df, freq_coeffs_df, curve_A_df)
-    attenuated_df            = noise_attenuation(sound_pressure_levels_df, attenuation_matrix_df)
-    energetic_sum_df         = energetic_sum(attenuated_df)
+    sound_pressure_levels_df = sound_pressure_levels(equivalent_flows_df, freq_coeffs_df, curve_A_df, emission_table)
+    if incremental_engine is not None:
+        energetic_sum_df     = incremental_engine.update(sound_pressure_levels_df)
+    elif parallel_engine is not None:
+        energetic_sum_df     = parallel_engine.energetic_sum(sound_pressure_levels_df)
+    elif attenuation_operator is not None:
+        energetic_sum_df     = apply_attenuation_operator(attenuation_operator, sound_pressure_levels_df)
+    else:
+        attenuated_df        = noise_attenuation(sound_pressure_levels_df, attenuation_matrix_df)
+        energetic_sum_df     = energetic_sum(attenuated_df)
 
     return energetic_sum_df
 
+def iter_data_chunked(filename):
+    """
+    Like `process_data`, but streams the attenuation matrix in chunks that fit
+    `memory_budget_mb` and yields the finished receivers as soon as they are
+    available.
+    """
+    logging.info("Reading input data...")
+    data_df = read_file(filename, schema=(input_schema if USE_SCHEMAS else None))
+
+    logging.info("Starting chunked computation...")
+    equivalent_flows_df      = equivalent_flows(data_df, street_params_df)
+    sound_pressure_levels_df = sound_pressure_levels(equivalent_flows_df, freq_coeffs_df, curve_A_df, emission_table)
+
+    chunk_rows = chunk_rows_for_budget(memory_budget_mb, len(sound_pressure_levels_df.columns))
+    logging.debug(f"Streaming the attenuation matrix in chunks of {chunk_rows} rows")
+
+    chunks = iter_attenuation_matrix(attenuation_matrix_filename, chunk_rows)
+    yield from stream_energetic_sum(sound_pressure_levels_df, chunks)
+
+@timer
+def process_data_chunked(filename, writer: ResultWriter):
+    """
+    Chunked version of `process_data` (see `iter_data_chunked`), which writes
+    the finished receivers with `writer`.
+    """
+    for energetic_sum_df in iter_data_chunked(filename):
+        writer.write(energetic_sum_df)
+
+
+#------------------------------------------------------------------------------
+#
+# Batch mode
+#
+#------------------------------------------------------------------------------
+
+def list_snapshots(pattern: str) -> list[str]:
+    """
+    Return the sorted list of snapshot files in the directory `pattern`, or
+    matching the glob `pattern`.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+def init_worker(matrix_filename: str, sparse: bool, incremental: bool, memory_budget: float,
+                metrics_filename: str, run: str, stages: list[str], cache: bool,
+                format: str, float32: bool, dataset_root: str):
+    """
+    Load and preprocess the parameters once per worker process. Workers started
+    with `fork` inherit them from the parent and skip this step.
+    """
+    global attenuation_matrix_filename, use_sparse, use_incremental, memory_budget_mb, use_cache
+    global output_format, output_float32, result_dataset
+
+    configure_metrics(metrics_filename, None, run)
+    enable_profiling(stages)
+    output_format, output_float32 = format, float32
+    result_dataset = ResultDataset(dataset_root, float32) if dataset_root else None
+    if street_params_df.empty:
+        attenuation_matrix_filename = matrix_filename
+        use_sparse = sparse
+        use_incremental = incremental
+        memory_budget_mb = memory_budget
+        use_cache = cache
+        load_parameters()
+
+def snapshot_output_filename(input_filename: str, output_dir: str) -> str:
+    """
+    Output of `input_filename` in `output_dir`: its result file in
+    `output_format`, its file in the result dataset, or its tile manifest when
+    publishing tiles.
+    """
+    if tile_publisher is not None:
+        return tile_manifest_filename(output_dir, input_filename)
+    if result_dataset is not None:
+        return result_dataset.filename(input_filename)
+    name = os.path.splitext(os.path.basename(input_filename))[0]
+    return os.path.join(output_dir, name + result_extension(output_format or RESULT_FORMAT))
+
+def result_writer(input_filename: str, output_filename: str, filename: str) -> ResultWriter:
+    """
+    Writer of the results of `input_filename` to `filename`, a temporary
+    file moved to `output_filename` once complete.
+    """
+    if result_dataset is not None:
+        return result_dataset.writer(input_filename, filename)
+    return ResultWriter(filename, output_format or result_format(output_filename), output_float32)
+
+def process_snapshot(input_filename: str, output_filename: str) -> str:
+    set_metrics_labels(snapshot=os.path.basename(input_filename))
+    try:
+        if tile_publisher is not None:
+            if memory_budget_mb > 0:
+                # Receiver levels are small compared to the matrix
+                df = pd.concat(list(iter_data_chunked(input_filename)), ignore_index=True)
+            else:
+                df = process_data(input_filename)
+            tile_publisher.publish(df, output_filename)
+            return output_filename
+        with atomic_output(output_filename) as tmp_filename:
+            with result_writer(input_filename, output_filename, tmp_filename) as writer:
+                if memory_budget_mb > 0:
+                    process_data_chunked(input_filename, writer)
+                else:
+                    writer.write(process_data(input_filename))
+    finally:
+        flush_metrics()
+        set_metrics_labels(snapshot=None)
+    return output_filename
+
+@timer
+def process_batch(jobs: list[tuple[str, str]], num_workers: int = 1) -> int:
+    """
+    Process every (input, output) pair of `jobs`, sequentially or spread over
+    `num_workers` processes. Parameters must already be loaded and preprocessed.
+
+    Returns:
+        int: The number of snapshots that failed.
+    """
+    failed = 0
+
+    if num_workers <= 1:
+        for input_filename, output_filename in jobs:
+            try:
+                process_snapshot(input_filename, output_filename)
+                logging.info(f"Processed {input_filename} -> {output_filename}")
+            except Exception as e:
+                logging.error(f"Failed to process {input_filename}: {e}")
+                failed += 1
+        return failed
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                             initargs=(attenuation_matrix_filename, use_sparse, use_incremental, memory_budget_mb,
+                                       metrics_files['jsonl'], metrics_labels['run'], list(profiled_stages),
+                                       use_cache, output_format, output_float32,
+                                       result_dataset.root if result_dataset else None)) as pool:
+        futures = {pool.submit(process_snapshot, i, o): i for i, o in jobs}
+        for future in as_completed(futures):
+            try:
+                output_filename = future.result()
+                logging.info(f"Processed {futures[future]} -> {output_filename}")
+            except Exception as e:
+                logging.error(f"Failed to process {futures[future]}: {e}")
+                failed += 1
+    return failed
+
+
+#------------------------------------------------------------------------------
+#
+# Watch mode
+#
+#------------------------------------------------------------------------------
+
+def write_status(status: dict, filename: str):
+    with atomic_output(filename) as tmp_filename:
+        with open(tmp_filename, 'w') as f:
+            json.dump(status, f, indent=2, default=str)
+
+def run_watch(pattern: str, output_dir: str, status_filename: str = None,
+              force: bool = False, interval: float = WATCH_INTERVAL,
+              settle: float = WATCH_SETTLE):
+    """
+    Keep the parameters loaded and process every new snapshot matching
+    `pattern` as soon as it has been left unmodified for `settle` seconds.
+    Results are published atomically to `output_dir`. Health and latency
+    stats are logged and, if `status_filename` is given, published there.
+    Runs until SIGINT or SIGTERM.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    seen = {}  # input filename -> mtime of the processed version
+    if not force:
+        # Snapshots published before this run was started
+        for input_filename in list_snapshots(pattern):
+            if os.path.isfile(snapshot_output_filename(input_filename, output_dir)):
+                try:
+                    seen[input_filename] = os.path.getmtime(input_filename)
+                except OSError:
+                    continue
+
+    latencies = []
+    status = {
+        'started': datetime.now(),
+        'pid': os.getpid(),
+        'processed': 0,
+        'failed': 0,
+    }
+
+    logging.info(f"Watching {pattern}, publishing to {output_dir}")
+    while not stop.is_set():
+        status['last_scan'] = datetime.now()
+        for input_filename in list_snapshots(pattern):
+            try:
+                mtime = os.path.getmtime(input_filename)
+            except OSError:
+                # Deleted or renamed since the scan
+                continue
+            if seen.get(input_filename) == mtime or time.time() - mtime < settle:
+                continue
+            seen[input_filename] = mtime
+
+            output_filename = snapshot_output_filename(input_filename, output_dir)
+            start_time = time.perf_counter()
+            try:
+                process_snapshot(input_filename, output_filename)
+            except Exception as e:
+                logging.error(f"Failed to process {input_filename}: {e}")
+                status['failed'] += 1
+                status['last_error'] = f"{input_filename}: {e}"
+                continue
+
+            processing_ms = (time.perf_counter() - start_time) * 1000
+            latency_ms = (time.time() - mtime) * 1000
+            latencies = (latencies + [processing_ms])[-100:]
+            status['processed'] += 1
+            status['last_snapshot'] = input_filename
+            status['last_processing_ms'] = round(processing_ms, 3)
+            status['last_latency_ms'] = round(latency_ms, 3)
+            status['mean_processing_ms'] = round(float(np.mean(latencies)), 3)
+            status['p95_processing_ms'] = round(float(np.percentile(latencies, 95)), 3)
+            logging.info(f"Published {output_filename} ({processing_ms:.1f} ms processing, {latency_ms:.1f} ms since arrival)")
+
+            if stop.is_set():
+                break
+
+        if status_filename:
+            write_status(status, status_filename)
+        stop.wait(interval)
+
+    logging.info(f"Watch stopped: {status['processed']} processed, {status['failed']} failed")
+
 
 if __name__ == "__main__":
     now = datetime.now()
@@ -63,24 +408,110 @@ if __name__ == "__main__":
 
     args = parse_args()
 
-    if not os.path.isfile(args.input):
-        logging.error(f"The input file does not exist: {args.input}")
-        sys.exit(1)
+    if args.shard:
+        if args.batch or args.watch or args.tiles or args.dataset:
+            logging.error("`--shard` processes one snapshot: it cannot be used with `--batch`, `--watch`, `--tiles` or `--dataset`.")
+            sys.exit(3)
+        try:
+            shard, num_shards = parse_shard(args.shard)
+            shards_dir = args.matrix
+            args.matrix = shard_matrix_filename(shards_dir, shard, num_shards)
+        except (ValueError, OSError) as e:
+            logging.error(f"Cannot find shard {args.shard} in {args.matrix}: {e}")
+            sys.exit(2)
 
     if not os.path.isfile(args.matrix):
         logging.error(f"The Noise Attenuation matrix does not exists: {args.matrix}")
         sys.exit(2)
     else:
         attenuation_matrix_filename = str(args.matrix)
+    configure_metrics(args.metrics, args.prometheus, f"{generate_filename_timestamp(now)}-{os.getpid()}")
+    if args.profile:
+        enable_profiling(args.profile.split(','))
+    use_sparse = args.sparse
+    use_incremental = args.incremental
+    memory_budget_mb = args.chunked
+    use_cache = args.cache or USE_CACHE
 
-    if os.path.isfile(args.output):
+    if memory_budget_mb > 0 and (use_sparse or use_incremental):
+        logging.error("`--chunked` streams the matrix: it cannot be used with `--sparse` or `--incremental`.")
+        sys.exit(4)
+
+    if args.parallel > 1 and (use_incremental or memory_budget_mb > 0 or (args.batch and args.jobs > 1)):
+        logging.warning("`--parallel` is ignored with `--incremental`, `--chunked` or `--jobs` > 1.")
+        args.parallel = 1
+
+    output_format = args.format
+    output_float32 = args.float32
+
+    if args.dataset:
+        if not (args.batch or args.watch) or args.tiles:
+            logging.error("`--dataset` requires `--batch` or `--watch`, and no `--tiles`.")
+            sys.exit(3)
+        result_dataset = ResultDataset(args.output, args.float32)
+
+    if args.tiles:
+        if not os.path.isdir(args.output):
+            logging.error(f"The output directory does not exist: {args.output}")
+            sys.exit(3)
+        tile_publisher = TilePublisher(args.output)
+
+    if args.watch:
+        if not os.path.isdir(args.output):
+            logging.error(f"The output directory does not exist: {args.output}")
+            sys.exit(3)
+
+        load_parameters()
+        start_parallel(args.parallel)
+        flush_metrics()
+        run_watch(args.input, args.output, args.status, args.force)
+        sys.exit(0)
+
+    if args.batch:
+        inputs = list_snapshots(args.input)
+        if not inputs:
+            logging.error(f"No input files found: {args.input}")
+            sys.exit(1)
+
+        if not os.path.isdir(args.output):
+            logging.error(f"The output directory does not exist: {args.output}")
+            sys.exit(3)
+
+        jobs = []
+        for input_filename in inputs:
+            output_filename = snapshot_output_filename(input_filename, args.output)
+            if os.path.isfile(output_filename) and not args.force:
+                logging.warning(f"Skipping {input_filename}: {output_filename} already exists. Use `--force` to overwrite it.")
+                continue
+            jobs.append((input_filename, output_filename))
+
+        if args.tiles and args.jobs > 1:
+            logging.warning("Tiles must be published in order by one process: ignoring `--jobs`.")
+            args.jobs = 1
+        if args.prometheus and args.jobs > 1:
+            logging.warning("The Prometheus textfile only covers the main process with `--jobs` > 1.")
+
+        load_parameters()
+        start_parallel(args.parallel)
+        flush_metrics()
+        failed = process_batch(jobs, args.jobs)
+        logging.info(f"Batch completed: {len(jobs) - failed} processed, {failed} failed, {len(inputs) - len(jobs)} skipped")
+        sys.exit(4 if failed else 0)
+
+    if not os.path.isfile(args.input):
+        logging.error(f"The input file does not exist: {args.input}")
+        sys.exit(1)
+
+    output_filename = snapshot_output_filename(args.input, args.output) if args.tiles else args.output
+    if os.path.isfile(output_filename):
         if not args.force:
-            logging.error(f"The file {args.output} already exists! Use `--force` to overwrite it.")
+            logging.error(f"The file {output_filename} already exists! Use `--force` to overwrite it.")
             sys.exit(3)
         else:
-            logging.debug(f"Overwriting file {args.output}")
+            logging.debug(f"Overwriting file {output_filename}")
 
-    read_parameters()
-    preprocess_parameters()
-    df = process_data(args.input)
-    write_csv_file(df, args.output)
\ No newline at end of file
+    load_parameters()
+    start_parallel(args.parallel)
+    process_snapshot(args.input, output_filename)
+    if args.shard:
+        write_shard_record(output_filename, shards_dir, shard, num_shards, args.input)
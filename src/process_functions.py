@@ -1,4 +1,5 @@
 from utils import *
+from typing import NamedTuple
 import numpy as np
 import pandas as pd
 
@@ -9,14 +10,36 @@ import pandas as pd
 #
 #------------------------------------------------------------------------------
 
-ID_JOIN = 'osm_id' # osm_id per Pisa, id per Brindisi?
 freqs = [f'{freq}' for freq in [63, 125, 250, 500, 1000, 2000, 4000, 8000]]
+vehicle_types = ['f1', 'f2', 'f3', 'f4']
+vehicle_type_dtype = pd.CategoricalDtype(vehicle_types)
+band_dtype = 'float32' if USE_FLOAT32 else 'float64'
 
 f1_coeff = 1.0 # f1: light vehicles
 f2_coeff = 2.0 # f2: medium-heavy vehicles
 f3_coeff = 0.0 # f3: heavy vehicles (not present in urban streets)
 f4_coeff = 0.5 # f4: powered two-wheelers vehicles
 
+# Columns read from the input snapshots and the raw noise attenuation matrix
+# (see `read_file`), when `USE_SCHEMAS` is set. The other columns are not
+# needed by the pipeline.
+input_schema = {
+    ID_JOIN: 'int32',
+    'highway': 'category',
+    'daytime': 'category',
+    'distance': 'float64',
+    'travel_time': 'float64',
+    'speed': 'float64',
+}
+attenuation_matrix_schema = {
+    'Ricevitore': 'int32',
+    'Sorgente': 'int32',
+    'ora intervallo': 'category',
+    'X/m': 'float64',
+    'Y/m': 'float64',
+    **{f'{f}Hz dB(A)': band_dtype for f in freqs},
+}
+
 
 #------------------------------------------------------------------------------
 #
@@ -56,12 +79,15 @@ def preprocess_street_params(
     for k in coeffs:
         df[k] = df[k] * coeffs[k] / weight_sum # TODO: check if this line is correct
 
-    # Melt the DataFrame
+    # Melt the DataFrame (stacked scenarios keep their key, see `scenarios.py`)
     id_vars = ['highway', 'capacity', 'free_speed', 'daytime', 'alpha', 'beta']
+    id_vars += ['scenario'] if 'scenario' in df.columns else []
     value_vars = list(coeffs.keys())
 
-    return pd.melt(df, id_vars=id_vars, value_vars=value_vars,
-                   var_name='vehicle_type', value_name='value')
+    melted = pd.melt(df, id_vars=id_vars, value_vars=value_vars,
+                     var_name='vehicle_type', value_name='value')
+    melted['vehicle_type'] = melted['vehicle_type'].astype(vehicle_type_dtype)
+    return melted
 
 @timer
 def preprocess_freq_coeffs(
@@ -97,7 +123,8 @@ def preproces_attenuation_matrix(
     - Renames metadata columns 'Ricevitore', 'Sorgente', and 'ora intervallo'
       into 'receiver', 'id' or 'id_osm', and 'vehicle_type'.  
     - Maps (Ld, Le, Lx, and Ln) columns (they were used as workaround to store
-      standardized Vehicle Types codes) into (f1, f2, f3, f4).
+      standardized Vehicle Types codes) into (f1, f2, f3, f4), stored as
+      a categorical with `vehicle_type_dtype`.
 
     Args:
         df (pd.DataFrame): DataFrame with raw noise attenuation data.
@@ -120,9 +147,138 @@ def preproces_attenuation_matrix(
         'Lx': 'f3',  # f3: Heavy Vehicles (not present in urban streets)
         'Ln': 'f4'   # f4: Powered Two-Wheelers Vehicles
     }
-    df['vehicle_type'] = df['vehicle_type'].replace(l2f)
+    if isinstance(df['vehicle_type'].dtype, pd.CategoricalDtype):
+        # Rename the categories instead of replacing every value
+        df['vehicle_type'] = df['vehicle_type'].cat.rename_categories(lambda c: l2f.get(c, c))
+    else:
+        df['vehicle_type'] = df['vehicle_type'].replace(l2f)
+    df['vehicle_type'] = df['vehicle_type'].astype(vehicle_type_dtype)
     return df
 
+@timer
+def compile_attenuation_matrix(
+    df: pd.DataFrame
+) -> np.ndarray:
+    """
+    Packs a preprocessed noise attenuation matrix into a numeric array that
+    can be stored with `write_npy_file` and memory-mapped at startup.
+
+    - Columns are stored one after the other, as the fields of a single
+      record, so that every column is a contiguous array of the memory map.
+    - Rows are sorted by receiver, so the matrix can be streamed in chunks.
+    - 'vehicle_type' labels are stored as integer codes into `vehicle_types`.
+    - 'receiver', ID_JOIN, coordinates and frequency columns keep their numeric
+      dtype. Non-numeric columns are dropped.
+
+    Args:
+        df (pd.DataFrame): Output of `preproces_attenuation_matrix`.
+
+    Returns:
+        np.ndarray: Structured array of one record, with one field per column.
+    """
+    df = df.sort_values('receiver', kind='stable')
+    codes = pd.Categorical(df['vehicle_type'], categories=vehicle_types).codes
+    if (codes < 0).any():
+        raise ValueError("Unknown vehicle types in the noise attenuation matrix.")
+
+    columns = {}
+    for col in df.columns:
+        if col == 'vehicle_type':
+            columns[col] = codes.astype(np.int8)
+        elif pd.api.types.is_numeric_dtype(df[col]):
+            columns[col] = df[col].to_numpy()
+        else:
+            logging.warning(f"Dropping non-numeric column '{col}' from the noise attenuation matrix.")
+    return pack_compiled_matrix(columns)
+
+def pack_compiled_matrix(
+    columns: dict
+) -> np.ndarray:
+    """
+    Packs the columns (name -> array of the same length) of a compiled matrix
+    into the single record stored by `write_npy_file`.
+    """
+    records = np.empty(1, dtype=[(col, values.dtype, values.shape) for col, values in columns.items()])
+    for col, values in columns.items():
+        records[col][0] = values
+    return records
+
+def compiled_matrix_columns(
+    records: np.ndarray,
+    start: int = 0,
+    stop: int = None
+) -> dict:
+    """
+    Rows [`start`, `stop`) of the columns of the compiled matrix `records`,
+    as views: nothing is read from a memory map until it is used.
+    """
+    return {col: records[col][0, start:stop] for col in records.dtype.names}
+
+@timer
+def load_compiled_attenuation_matrix(
+    records: np.ndarray,
+    start: int = 0,
+    stop: int = None
+) -> pd.DataFrame:
+    """
+    Rebuilds the preprocessed noise attenuation matrix (rows [`start`,
+    `stop`)) from the array produced by `compile_attenuation_matrix`
+    (usually memory-mapped with `read_npy_file`). No further preprocessing
+    is needed.
+
+    The frame keeps one block per column on the arrays of `records`, so a
+    memory-mapped matrix is neither copied nor read when it is loaded, and
+    its pages are shared through the OS page cache by every process.
+
+    Args:
+        records (np.ndarray): Compiled matrix.
+
+    Returns:
+        pd.DataFrame: Noise attenuation matrix, as `preproces_attenuation_matrix` returns it.
+    """
+    data = compiled_matrix_columns(records, start, stop)
+    data['vehicle_type'] = pd.Categorical.from_codes(data['vehicle_type'], categories=vehicle_types)
+    return pd.DataFrame(data, copy=False)
+
+
+def chunk_rows_for_budget(
+    memory_budget_mb: float,
+    num_columns: int
+) -> int:
+    """
+    Number of attenuation matrix rows per chunk that keeps the join with the
+    emission table (of `num_columns` columns) and its intermediate copies
+    within `memory_budget_mb`.
+    """
+    # Every merged row holds the matrix and the emission columns (8 bytes each),
+    # and the attenuation stage keeps about 4 copies of it alive at once.
+    bytes_per_row = 8 * (num_columns + len(freqs) + 4) * 4
+    return max(1, int(memory_budget_mb * 2**20 // bytes_per_row))
+
+# Matrix formats `iter_attenuation_matrix` can read in chunks
+chunked_matrix_formats = ['.csv', '.parquet', '.npy']
+
+def iter_attenuation_matrix(
+    filename: str,
+    chunk_rows: int
+):
+    """
+    Reads the noise attenuation matrix `filename` in chunks of `chunk_rows`
+    rows and yields them preprocessed. CSV files are read incrementally,
+    Parquet files by record batches and compiled npy matrices by slicing the
+    memory map.
+    """
+    if filename.endswith('.npy'):
+        records = read_npy_file(filename)
+        num_rows = len(records['receiver'][0])
+        for start in range(0, num_rows, chunk_rows):
+            yield load_compiled_attenuation_matrix(records, start, start + chunk_rows)
+        return
+
+    schema = attenuation_matrix_schema if USE_SCHEMAS else None
+    for chunk in iter_file_chunks(filename, chunk_rows, schema):
+        yield preproces_attenuation_matrix(chunk)
+
 
 #------------------------------------------------------------------------------
 #
@@ -144,12 +300,19 @@ def equivalent_flows(
     - Multiplies flow by vehicle-type weights ('value').
     - Adds result as 'num_vehicles' (integer).
 
+    When both DataFrames have a 'scenario' column (stacked scenarios, see
+    `scenarios.py`), rows are matched within the same scenario.
+
     Args:
         df (pd.DataFrame): DataFrame with traffic data (must include 'highway','daytime', 'distance', 'travel_time').
         street_params_df (pd.DataFrame): DataFrame with corresponding street parameters.
     """
+    keys = ['highway', 'daytime']
+    if 'scenario' in df.columns and 'scenario' in street_params_df.columns:
+        keys.append('scenario')
+
     # Merge in-place using index alignment (adds columns to df)
-    merged = df.merge(street_params_df, on=['highway', 'daytime'], how='left', sort=False, copy=False)
+    merged = df.merge(street_params_df, on=keys, how='left', sort=False, copy=False)
 
     # Compute free-speed travel time
     merged['travel_freespeed'] = merged['distance'] / merged['free_speed']
@@ -170,6 +333,25 @@ def equivalent_flows(
     ], inplace=True)
     return merged
 
+def freq_coeffs_array(
+    coeff_freq_df: pd.DataFrame
+) -> tuple[pd.Index, np.ndarray]:
+    """
+    Packs the preprocessed frequency coefficients into a dense float array.
+
+    Args:
+        coeff_freq_df (pd.DataFrame): Output of `preprocess_freq_coeffs`, one row
+                                      per vehicle type and a list [Ar, Br, Ap, Bp]
+                                      in each frequency column.
+
+    Returns:
+        tuple[pd.Index, np.ndarray]: The vehicle types and the coefficients array
+                                     with shape [vehicle_type, freq, 4].
+    """
+    vehicle_types = pd.Index(coeff_freq_df['vehicle_type'])
+    coeffs = np.array([[row[f] for f in freqs] for _, row in coeff_freq_df.iterrows()], dtype=float)
+    return vehicle_types, coeffs.reshape(len(vehicle_types), len(freqs), 4)
+
 def compute_LwR(Ar, Br, speed):
     return Ar + Br * np.log10(speed / 70)
 
@@ -180,41 +362,107 @@ def compute_Lwim(LwR, LwP):
     return 10 * np.log10(10**(LwR / 10) + 10**(LwP / 10))
 
 def compute_Lw(Ar, Br, Ap, Bp, num_vehicles, speed):
-    if num_vehicles <= 0:
-        return 0
-    LwR = compute_LwR(Ar, Br, speed)
-    LwP = compute_LwP(Ap, Bp, speed)
-    Lwim = compute_Lwim(LwR, LwP)
-    return Lwim + 10 * np.log10(num_vehicles / (1000 * speed))
+    # Works on scalars as well as on whole (broadcastable) arrays: rows without
+    # vehicles are masked to 0 instead of being skipped.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        LwR = compute_LwR(Ar, Br, speed)
+        LwP = compute_LwP(Ap, Bp, speed)
+        Lwim = compute_Lwim(LwR, LwP)
+        Lw = Lwim + 10 * np.log10(num_vehicles / (1000 * speed))
+    return np.where(num_vehicles > 0, Lw, 0.0)
+
+class EmissionTable(NamedTuple):
+    vehicle_types: pd.Index  # [n_vehicle_types] vehicle types with coefficients
+    levels: np.ndarray       # [n_vehicle_types, max_speed + 1, n_freqs] Lwim + A-weighting (dB)
+
+
+@timer
+def build_emission_table(
+    coeff_freq_df: pd.DataFrame,
+    curve_A_df: pd.DataFrame,
+    max_speed: int = EMISSION_MAX_SPEED
+) -> EmissionTable:
+    """
+    Precomputes the emission of a single vehicle (Lwim) plus the A-weighting
+    for every vehicle type, frequency band and integer speed in
+    [0, `max_speed`] km/h, so that `sound_pressure_levels` only has to gather
+    it for the (integer) speeds collected by `collect_data`.
+
+    Args:
+        coeff_freq_df (pd.DataFrame): Output of `preprocess_freq_coeffs`.
+        curve_A_df (pd.DataFrame): A-weighting correction values, one row, with each frequency band.
+        max_speed (int): Highest tabulated speed (km/h).
+
+    Returns:
+        EmissionTable: The lookup table.
+    """
+    vehicle_types, coeffs = freq_coeffs_array(coeff_freq_df)
+
+    # Shape [vehicle_type, 1, freq, 4] -> four [vehicle_type, 1, freq] arrays
+    Ar, Br, Ap, Bp = np.moveaxis(coeffs[:, None], -1, 0)
+    speed = np.arange(max_speed + 1, dtype=float)[None, :, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Lwim = compute_Lwim(compute_LwR(Ar, Br, speed), compute_LwP(Ap, Bp, speed))
+    return EmissionTable(vehicle_types, Lwim + curve_A_df[freqs].to_numpy(dtype=float)[0])
 
 @timer
 def sound_pressure_levels(
     df: pd.DataFrame,
     coeff_freq_df: pd.DataFrame,
-    curve_A_df: pd.DataFrame
+    curve_A_df: pd.DataFrame,
+    emission_table: EmissionTable = None
 ) -> pd.DataFrame:
     """
     Computes weighted Sound Power Levels (SPLs) for each row and frequency band.
 
+    Lwim plus the A-weighting is gathered per row from `emission_table` for
+    integer speeds within its range, and computed from the coefficients for
+    the other speeds; then the number of vehicles term is added to all
+    frequency bands at once. Rows whose vehicle type has no coefficients are
+    dropped.
+
     Args:
         df (pd.DataFrame): Contains 'vehicle_type', 'speed', 'num_vehicles', and location data.
         coeff_freq_df (pd.DataFrame): Maps each vehicle type to coefficients for each frequency band.
                                       Each frequency column is a list of 4 coefficients: [Ar, Br, Ap, Bp].
         curve_A_df (pd.DataFrame): A-weighting correction values, one row, with each frequency band.
+        emission_table (EmissionTable): Output of `build_emission_table`, built
+                                        on the fly when not given.
 
     Returns:
         pd.DataFrame: Same structure as `df`, with SPLs per frequency and A-weighting applied.
     """
-
-    merged = df.merge(coeff_freq_df, on='vehicle_type')
-
-    for f in freqs:
-        merged[f] = merged.apply(lambda x: compute_Lw(x[f][0], x[f][1], x[f][2], x[f][3], x['num_vehicles'], x['speed']), axis=1) + curve_A_df[f].values[0]
-
-    merged.drop(columns=[
+    if emission_table is None:
+        emission_table = build_emission_table(coeff_freq_df, curve_A_df)
+
+    idx = emission_table.vehicle_types.get_indexer(df['vehicle_type'])
+    mask = idx >= 0
+    result = df.loc[mask].reset_index(drop=True)
+    idx = idx[mask]
+
+    num_vehicles = result['num_vehicles'].to_numpy(dtype=float)[:, None]
+    speed = result['speed'].to_numpy(dtype=float)
+    curve_A = curve_A_df[freqs].to_numpy(dtype=float)[0]
+
+    tabulated = (speed >= 0) & (speed < emission_table.levels.shape[1]) & (speed == np.floor(speed))
+    LwimA = np.empty((len(result), len(freqs)))
+    LwimA[tabulated] = emission_table.levels[idx[tabulated], speed[tabulated].astype(int)]
+    if not tabulated.all():
+        _, coeffs = freq_coeffs_array(coeff_freq_df)
+        Ar, Br, Ap, Bp = np.moveaxis(coeffs[idx[~tabulated]], -1, 0)
+        other_speed = speed[~tabulated, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            LwimA[~tabulated] = compute_Lwim(compute_LwR(Ar, Br, other_speed), compute_LwP(Ap, Bp, other_speed)) + curve_A
+
+    # Rows without vehicles only get the A-weighting, as in `compute_Lw`
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Lw = LwimA + 10 * np.log10(num_vehicles / (1000 * speed[:, None]))
+    result[freqs] = np.where(num_vehicles > 0, Lw, curve_A).astype(band_dtype)
+    result.drop(columns=[
         'speed', 'num_vehicles'
     ], inplace=True)
-    return merged
+    return result
 
 @timer
 def noise_attenuation(
@@ -227,6 +475,7 @@ def noise_attenuation(
 
     Merges the SPLs with the noise attenuation matrix based on Receiver ID and
     vehicle type, and adds attenuation values to the SPLs per frequency.
+    Only the join keys and the SPLs of `df` are carried through the merge.
 
     Args:
         df (pd.DataFrame): DataFrame containing SPL values per frequency.
@@ -235,54 +484,57 @@ def noise_attenuation(
     Returns:
         pd.DataFrame: Updated SPL DataFrame with attenuation applied.
     """
-    merged = df.merge(noise_attenuation_matrix_df, on=[ID_JOIN, 'vehicle_type'], suffixes=(None, '_r'))
+    keys = [ID_JOIN, 'vehicle_type']
+    merged = df[keys + freqs].merge(noise_attenuation_matrix_df, on=keys, suffixes=(None, '_r'))
 
     for f in freqs:
         merged[f] = merged[f].fillna(0) + merged[f'{f}_r'].fillna(0)
     
-    merged.drop(columns=[f'{f}_r' for f in freqs])
+    merged.drop(columns=[f'{f}_r' for f in freqs], inplace=True)
     return merged
 
 
+def db_to_power(db):
+    return 10.0 ** (db / 10.0)
+
+def power_to_db(power):
+    return 10.0 * np.log10(power)
+
 @timer
-def energetic_sum(
+def energetic_power_sum(
     df: pd.DataFrame
 ) -> pd.DataFrame:
     """
-    Computes the energetic sum of Sound Pressure Levels (SPLs) per receiver
-    across frequency bands.
-
-    Steps:
-    - Converts dB values to power.
-    - Aggregates power values per receiver using sum.
-    - Converts summed power back to dB (both per frequency and total).
-    - Preserves spatial coordinates ('X/m', 'Y/m') and returns one row per receiver.
+    First half of `energetic_sum`: clips and converts the SPLs of `df` to power
+    and sums them per receiver, without converting back to dB. Partial sums of
+    the same receiver can be added together.
 
     Args:
         df (pd.DataFrame): DataFrame with SPL values per frequency and metadata.
 
     Returns:
-        pd.DataFrame: Aggregated SPL per receiver with total dB and per-frequency dB values.
+        pd.DataFrame: Summed power per frequency, indexed by receiver, with 'X/m' and 'Y/m'.
     """
-    def db_to_power(db):
-        return 10.0 ** (db / 10.0)
-
-    def power_to_db(power):
-        return 10.0 * np.log10(power)
-    
     # Ensure no negative values before conversion
     df[freqs] = df[freqs].clip(lower=0)
 
-    # Convert from dB to power
-    df[freqs] = db_to_power(df[freqs])
+    # Convert from dB to power, summed in float64 even for float32 bands
+    df[freqs] = db_to_power(df[freqs].astype('float64'))
 
     # Aggregate by receiver
-    agg = df.groupby('receiver').agg({
+    return df.groupby('receiver').agg({
         'X/m': 'first',
         'Y/m': 'first',
         **{f: 'sum' for f in freqs}
     })
 
+def power_levels(
+    agg: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Second half of `energetic_sum`: converts the summed power per receiver
+    back to dB, per frequency and total.
+    """
     # Compute total SPL from summed power across all freqs
     agg['total_db'] = power_to_db(agg[freqs].sum(axis=1))
 
@@ -290,3 +542,71 @@ def energetic_sum(
     agg[freqs] = power_to_db(agg[freqs])
 
     return agg.reset_index()
+
+@timer
+def energetic_sum(
+    df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Computes the energetic sum of Sound Pressure Levels (SPLs) per receiver
+    across frequency bands.
+
+    Steps:
+    - Converts dB values to power.
+    - Aggregates power values per receiver using sum.
+    - Converts summed power back to dB (both per frequency and total).
+    - Preserves spatial coordinates ('X/m', 'Y/m') and returns one row per receiver.
+
+    Args:
+        df (pd.DataFrame): DataFrame with SPL values per frequency and metadata.
+
+    Returns:
+        pd.DataFrame: Aggregated SPL per receiver with total dB and per-frequency dB values.
+    """
+    return power_levels(energetic_power_sum(df))
+
+def stream_energetic_sum(
+    df: pd.DataFrame,
+    matrix_chunks
+):
+    """
+    Streaming version of `energetic_sum(noise_attenuation(df, matrix))` over
+    the noise attenuation matrix read in chunks (see `iter_attenuation_matrix`).
+
+    The matrix must be sorted by receiver: every chunk is joined with `df`
+    and summed in the power domain, the receivers that cannot appear in later
+    chunks are yielded, and only the partial sums of the last receiver are
+    carried over. Memory is bounded by the chunk size.
+
+    Args:
+        df (pd.DataFrame): Output of `sound_pressure_levels`.
+        matrix_chunks: Iterable of preprocessed attenuation matrix chunks.
+
+    Yields:
+        pd.DataFrame: Aggregated SPL of the finished receivers, as `energetic_sum` returns it.
+    """
+    carry = None
+    last_receiver = None
+
+    for chunk in matrix_chunks:
+        if chunk.empty:
+            continue
+        if last_receiver is not None and chunk['receiver'].min() < last_receiver:
+            raise ValueError("The noise attenuation matrix must be sorted by receiver to be processed in chunks.")
+        last_receiver = chunk['receiver'].max()
+
+        partial = energetic_power_sum(noise_attenuation(df, chunk))
+        if carry is not None and not carry.empty:
+            partial = pd.concat([carry, partial]).groupby(level=0).agg({
+                'X/m': 'first',
+                'Y/m': 'first',
+                **{f: 'sum' for f in freqs}
+            })
+
+        finished = partial.index < last_receiver
+        if finished.any():
+            yield power_levels(partial[finished])
+        carry = partial[~finished]
+
+    if carry is not None and not carry.empty:
+        yield power_levels(carry)
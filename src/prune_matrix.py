@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import argparse
+from process_functions import *
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Drop the (receiver, source) pairs of the Noise Attenuation Matrix that cannot change the levels measurably.")
+    parser.add_argument('-m', '--matrix',   required=True,  help="Noise Attenuation Matrix to prune (csv, json, parquet or compiled npy).")
+    parser.add_argument('-i', '--input',    required=True,  help="Snapshot listing the street class of every source (csv, as written by `collect_data`).")
+    parser.add_argument('-o', '--output',   required=True,  help="Pruned matrix (compiled with a .npy extension, raw columns otherwise).")
+    parser.add_argument('-x', '--fraction', required=False, help="Power that may be pruned per receiver and band, relative to its minimum total.", type=float, default=PRUNE_FRACTION)
+    parser.add_argument('--max-flow-ratio', required=False, help="Highest plausible volume/capacity ratio of a street.", type=float, default=PRUNE_MAX_FLOW_RATIO)
+    parser.add_argument('-r', '--report',   required=False, help="JSON file where the size reduction and the error bound are written.", default=None)
+    parser.add_argument('-f', '--force',    required=False, help="Force rewrite output file.", action='store_true')
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Error-bounded pruning
+#
+# Every row of the matrix contributes 10^(max(0, Lw + A)/10) per band to the
+# power of its receiver (see `noise_attenuation` and `energetic_power_sum`),
+# where Lw is the emission of its source and A the attenuation. Bounding Lw
+# over every speed in [1, `EMISSION_MAX_SPEED`] km/h and every flow between
+# zero and `max_flow_ratio` times the capacity of the street bounds each
+# contribution from both sides. The smallest contributions of a receiver are
+# dropped as long as their largest possible sum stays within `fraction` of
+# the smallest possible total of the receiver, in every band, so the levels
+# computed with the pruned matrix are lower by at most -10 log10(1 - fraction)
+# dB. Rows of vehicle types without coefficients never contribute and are
+# always dropped; rows of sources missing from the input are always kept.
+#
+# The bound holds for the parameters the matrix was pruned with, and
+# assumes that every snapshot has a row for every source of the input.
+#
+#------------------------------------------------------------------------------
+
+def worst_case_emissions(
+    input_df: pd.DataFrame,
+    street_params_df: pd.DataFrame,
+    emission_table: EmissionTable,
+    curve_A_df: pd.DataFrame,
+    max_flow_ratio: float = PRUNE_MAX_FLOW_RATIO
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Lowest and highest level per band (dB, as computed by
+    `sound_pressure_levels`) that every (source, vehicle type) can emit.
+
+    Args:
+        input_df (pd.DataFrame): Snapshot with the 'highway' of every source.
+        street_params_df (pd.DataFrame): Output of `preprocess_street_params`.
+        emission_table (EmissionTable): Output of `build_emission_table`.
+        curve_A_df (pd.DataFrame): A-weighting correction values.
+        max_flow_ratio (float): Highest plausible volume/capacity ratio.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The lowest and the highest levels,
+        indexed by (ID_JOIN, 'vehicle_type'), -inf where nothing is emitted.
+    """
+    curve_A = curve_A_df[freqs].to_numpy(dtype=float)[0]
+
+    # Emission of one vehicle per km, over the tabulated speeds but 0
+    speed = np.arange(1, emission_table.levels.shape[1], dtype=float)[None, :, None]
+    per_vehicle = emission_table.levels[:, 1:] - 10 * np.log10(1000 * speed)
+    per_vehicle = pd.DataFrame({
+        'vehicle_type': emission_table.vehicle_types.astype(str),
+        **{f'min_{f}': per_vehicle[:, :, i].min(axis=1) for i, f in enumerate(freqs)},
+        **{f'max_{f}': per_vehicle[:, :, i].max(axis=1) for i, f in enumerate(freqs)},
+    })
+
+    # Most vehicles of every street class and vehicle type, over the daytimes
+    flows = (street_params_df.assign(max_vehicles=np.floor(
+                 street_params_df['capacity'] * max_flow_ratio * street_params_df['value']))
+             .groupby(['highway', 'vehicle_type'], observed=True)['max_vehicles'].max().reset_index())
+    flows['vehicle_type'] = flows['vehicle_type'].astype(str)
+
+    sources = input_df[[ID_JOIN, 'highway']].drop_duplicates(ID_JOIN)
+    sources = sources.assign(highway=sources['highway'].astype(str))
+    pairs = (sources.merge(flows, on='highway').merge(per_vehicle, on='vehicle_type', how='left')
+             .set_index([ID_JOIN, 'vehicle_type']))
+
+    # Without vehicles a row only gets the A-weighting
+    emitting = (pairs['max_vehicles'] >= 1).to_numpy()[:, None]
+    with np.errstate(divide='ignore'):
+        flow = 10 * np.log10(pairs['max_vehicles'].to_numpy(dtype=float))[:, None]
+    low = np.where(emitting, np.minimum(curve_A, pairs[[f'min_{f}' for f in freqs]].to_numpy()), curve_A)
+    high = np.where(emitting, np.maximum(curve_A, pairs[[f'max_{f}' for f in freqs]].to_numpy() + flow), curve_A)
+
+    # Vehicle types without coefficients are dropped by `sound_pressure_levels`
+    no_coeffs = pairs['min_' + freqs[0]].isna().to_numpy()[:, None]
+    low = np.where(no_coeffs, -np.inf, low)
+    high = np.where(no_coeffs, -np.inf, high)
+    return (pd.DataFrame(low, index=pairs.index, columns=freqs),
+            pd.DataFrame(high, index=pairs.index, columns=freqs))
+
+def contribution_bounds(
+    matrix_df: pd.DataFrame,
+    low: pd.DataFrame,
+    high: pd.DataFrame
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Lowest and highest power per band that every row of `matrix_df` can add
+    to its receiver, given the emission bounds of `worst_case_emissions`.
+    Sources without bounds may add anything from nothing to infinity.
+    """
+    keys = pd.MultiIndex.from_arrays([matrix_df[ID_JOIN], matrix_df['vehicle_type'].astype(str)])
+    idx = high.index.get_indexer(keys)
+    known = (idx >= 0)[:, None]
+
+    attenuation = matrix_df[freqs].to_numpy(dtype=float)
+    attenuation = np.where(np.isnan(attenuation), 0.0, attenuation)
+    with np.errstate(invalid='ignore', over='ignore'):
+        p_min = db_to_power(np.clip(low.to_numpy()[idx] + attenuation, 0, None))
+        p_max = db_to_power(np.clip(high.to_numpy()[idx] + attenuation, 0, None))
+    # Rows without coefficients: -inf dB is clipped to 0 dB, but never summed
+    silent = np.isneginf(high.to_numpy()[idx]).all(axis=1)[:, None]
+    p_min = np.where(known, np.where(silent, 0.0, p_min), 0.0)
+    p_max = np.where(known, np.where(silent, 0.0, p_max), np.inf)
+    return p_min, p_max
+
+@timer
+def prune_attenuation_matrix(
+    matrix_df: pd.DataFrame,
+    low: pd.DataFrame,
+    high: pd.DataFrame,
+    fraction: float = PRUNE_FRACTION
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Drops the rows of `matrix_df` (output of `preproces_attenuation_matrix`)
+    whose largest possible power, summed per receiver, is within `fraction`
+    of the smallest possible power of the receiver in every band.
+
+    Returns:
+        tuple[pd.DataFrame, dict]: The kept rows, in their original order,
+        and a report with the size reduction and the guaranteed error bound.
+    """
+    p_min, p_max = contribution_bounds(matrix_df, low, high)
+    receivers = matrix_df['receiver'].to_numpy()
+
+    # Smallest possible total of every receiver, and of the receiver of every row
+    codes, uniques = pd.factorize(receivers)
+    receiver_min = np.zeros((len(uniques), len(freqs)))
+    np.add.at(receiver_min, codes, p_min)
+    total_min = receiver_min[codes]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(p_max > 0, p_max / total_min, 0.0).max(axis=1)
+
+    # Smallest shares first, as long as their sum fits in every band
+    order = np.lexsort((share, codes))
+    pruned = pd.DataFrame(p_max[order]).groupby(codes[order], sort=False).cumsum().to_numpy()
+    with np.errstate(invalid='ignore'):
+        fits = (pruned <= fraction * total_min[order]).all(axis=1)
+    drop = np.zeros(len(matrix_df), dtype=bool)
+    drop[order] = fits
+
+    # Pruned power of every receiver, relative to its smallest total
+    removed = np.zeros((len(uniques), len(freqs)))
+    np.add.at(removed, codes[drop], p_max[drop])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(removed > 0, removed / receiver_min, 0.0).max(initial=0.0)
+
+    kept = matrix_df[~drop]
+    report = {
+        'fraction': fraction,
+        'max_error_db': float(-power_to_db(1 - ratio)) + 0.0,
+        'bound_db': float(-power_to_db(1 - fraction)),
+        'rows': len(matrix_df),
+        'rows_kept': len(kept),
+        'rows_silent': int((p_max == 0).all(axis=1).sum()),
+        'receivers': len(uniques),
+        'bytes': int(matrix_df.memory_usage(deep=True).sum()),
+        'bytes_kept': int(kept.memory_usage(deep=True).sum()),
+    }
+    return kept, report
+
+def raw_attenuation_matrix(
+    df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Inverse of `preproces_attenuation_matrix`: original column names and
+    vehicle type labels.
+    """
+    f2l = {'f1': 'Ld', 'f2': 'Le', 'f3': 'Lx', 'f4': 'Ln'}
+    cols = {f'{f}': f'{f}Hz dB(A)' for f in freqs}
+    cols.update({
+        'receiver': 'Ricevitore',
+        ID_JOIN: 'Sorgente',
+        'vehicle_type': 'ora intervallo',
+    })
+    df = df.rename(columns=cols)
+    df['ora intervallo'] = df['ora intervallo'].astype(str).map(f2l)
+    return df
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("prune", now, debug=True)
+
+    args = parse_args()
+
+    if not os.path.isfile(args.input):
+        logging.error(f"The input file does not exist: {args.input}")
+        sys.exit(1)
+
+    if not os.path.isfile(args.matrix):
+        logging.error(f"The Noise Attenuation matrix does not exists: {args.matrix}")
+        sys.exit(2)
+
+    if os.path.exists(args.output) and not args.force:
+        logging.error(f"The output file already exists: {args.output}")
+        sys.exit(3)
+
+    if not 0 <= args.fraction < 1:
+        logging.error(f"The fraction must be in [0, 1): {args.fraction}")
+        sys.exit(4)
+
+    street_params_df = preprocess_street_params(read_file(street_params_filename, PARAMS_DIR))
+    freq_coeffs_df   = preprocess_freq_coeffs(read_file(freq_coeffs_filename, PARAMS_DIR))
+    curve_A_df       = read_file(curve_A_filename, PARAMS_DIR)
+    emission_table   = build_emission_table(freq_coeffs_df, curve_A_df)
+
+    if args.matrix.endswith('.npy'):
+        matrix_df = load_compiled_attenuation_matrix(read_npy_file(args.matrix))
+    else:
+        matrix_df = preproces_attenuation_matrix(read_file(args.matrix,
+                                                           schema=(attenuation_matrix_schema if USE_SCHEMAS else None)))
+
+    low, high = worst_case_emissions(read_file(args.input), street_params_df, emission_table, curve_A_df,
+                                     args.max_flow_ratio)
+    pruned_df, report = prune_attenuation_matrix(matrix_df, low, high, args.fraction)
+
+    with atomic_output(args.output) as tmp_filename:
+        if args.output.endswith('.npy'):
+            write_npy_file(compile_attenuation_matrix(pruned_df), tmp_filename)
+        elif args.output.endswith('.parquet'):
+            write_parquet_file(raw_attenuation_matrix(pruned_df), tmp_filename)
+        else:
+            write_csv_file(raw_attenuation_matrix(pruned_df), tmp_filename)
+
+    if args.report:
+        with atomic_output(args.report) as tmp_filename:
+            with open(tmp_filename, 'w') as f:
+                json.dump({'matrix': args.matrix, 'output': args.output, **report}, f, indent=1)
+
+    logging.info(f"Kept {report['rows_kept']} of {report['rows']} rows "
+                 f"({report['bytes_kept'] / 2**20:.1f} of {report['bytes'] / 2**20:.1f} MB, "
+                 f"{report['rows_silent']} never contribute); "
+                 f"levels are lower by at most {report['max_error_db']:.4f} dB "
+                 f"(bound {report['bound_db']:.4f} dB)")
@@ -0,0 +1,361 @@
+import os
+import sys
+import argparse
+import warnings
+from attenuation_operator import *
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Evaluate what-if and Monte Carlo scenarios of a snapshot in one batch.")
+    parser.add_argument('-i', '--input',        required=True,  help="Path to input CSV file.")
+    parser.add_argument('-m', '--matrix',       required=True,  help="Path to the Noise Attenuation Matrix (csv, json, parquet or compiled npy).")
+    parser.add_argument('-s', '--scenarios',    required=True,  help="JSON file with the list of scenarios (see `expand_scenarios`).")
+    parser.add_argument('-o', '--output',       required=True,  help="Name of output CSV file with the total level per receiver and scenario.")
+    parser.add_argument('-d', '--distribution', required=False, help="CSV file where the distribution of the levels per receiver is written.", default=None)
+    parser.add_argument('-f', '--force' ,       required=False, help="Force rewrite output files.", action='store_true')
+    parser.add_argument('--cache'       ,       required=False, help="Load the preprocessed parameters from the cache (`CACHE_DIR`), and store them in it.", action='store_true')
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Scenarios
+#
+# A scenario is a list of changes to the columns of the input snapshot and of
+# the raw street parameters. Every change is a dict with:
+#
+# - 'column': the column to change;
+# - 'scale' and 'offset': the column becomes `column * scale + offset`;
+# - 'sigma': the column is also multiplied by a log-normal factor, drawn per
+#   row, whose logarithm has standard deviation `sigma`;
+# - 'where': {column: [values]}, the rows to change (all rows by default).
+#
+# For example, "speeds drop 20% on all primary roads" is
+#
+#   {"name": "primary-slow", "input": [
+#       {"column": "speed", "scale": 0.8, "where": {"highway": ["primary"]}},
+#       {"column": "travel_time", "scale": 1.25, "where": {"highway": ["primary"]}}]}
+#
+# and 200 draws of the street parameters with 10% uncertainty are
+#
+#   {"name": "params", "samples": 200, "seed": 0, "street_params": [
+#       {"column": "alpha", "sigma": 0.1}, {"column": "capacity", "sigma": 0.1}]}
+#
+#------------------------------------------------------------------------------
+
+class Scenario(NamedTuple):
+    name: str
+    input: list = []           # changes to the input snapshot
+    street_params: list = []   # changes to the raw street parameters
+    seed: int = 0              # seed of the random factors
+
+
+def expand_scenarios(spec: list[dict]) -> list[Scenario]:
+    """
+    Builds the scenarios of a JSON specification: a list of {'name', 'input',
+    'street_params'} entries. Entries with 'samples': n are expanded into n
+    scenarios named "<name>-<i>", with seeds 'seed' + i.
+    """
+    scenarios = []
+    for entry in spec:
+        fields = {'input': entry.get('input', []), 'street_params': entry.get('street_params', [])}
+        samples = entry.get('samples')
+        if samples is None:
+            scenarios.append(Scenario(entry['name'], seed=entry.get('seed', 0), **fields))
+        else:
+            scenarios += [Scenario(f"{entry['name']}-{i}", seed=entry.get('seed', 0) + i, **fields) for i in range(samples)]
+
+    names = [s.name for s in scenarios]
+    if len(set(names)) < len(names):
+        raise ValueError("Scenario names must be unique.")
+    return scenarios
+
+def apply_changes(df: pd.DataFrame, changes: list[dict], rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Returns a copy of `df` with the `changes` of a scenario applied.
+    """
+    df = df.copy()
+    for change in changes:
+        column = change['column']
+        if column not in df.columns:
+            raise ValueError(f"Unknown column in scenario change: {column}")
+
+        mask = np.ones(len(df), dtype=bool)
+        for col, values in change.get('where', {}).items():
+            mask &= df[col].isin(values).to_numpy()
+
+        values = df.loc[mask, column].astype(float) * change.get('scale', 1.0) + change.get('offset', 0.0)
+        if change.get('sigma'):
+            values *= np.exp(rng.normal(0.0, change['sigma'], mask.sum()))
+        df[column] = df[column].astype(float)
+        df.loc[mask, column] = values
+    return df
+
+
+#------------------------------------------------------------------------------
+#
+# Batched evaluation
+#
+# Flows and emissions are computed per scenario (they only depend on the
+# street segments). The attenuation is shared in two ways:
+#
+# - the baseline (the snapshot without changes) is attenuated once, and a
+#   scenario that changes few sources only updates it with the non-zeros of
+#   those sources (see `IncrementalEnergeticSum`);
+# - the other scenarios are stacked and attenuated together, receiver block
+#   by receiver block, so the operator is read once per batch and the
+#   intermediate arrays stay small.
+#
+#------------------------------------------------------------------------------
+
+def attenuate_stacked(
+    op: AttenuationOperator,
+    powers: np.ndarray,
+    block_bytes: int = 2**20
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    `attenuate` for the per-source powers of several scenarios, stacked as
+    [n_sources, n_scenarios, n_freqs]. The non-zeros are processed in blocks
+    of receivers whose gathered values take about `block_bytes`.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The summed power per receiver
+        ([n_receivers, n_scenarios, n_freqs]) and which receivers got at
+        least one contribution ([n_receivers, n_scenarios]).
+    """
+    n_scenarios = powers.shape[1]
+    present = ~np.isnan(powers[:, :, 0])
+    powers = np.where(present[:, :, None], powers, 0.0)
+    weights = present.astype(float)[:, :, None]
+
+    power = np.empty((len(op.receivers), n_scenarios, len(freqs)))
+    received = np.empty((len(op.receivers), n_scenarios), dtype=bool)
+    nnz_per_receiver = max(1, len(op.cols) // max(1, len(op.receivers)))
+    block = max(1, int(block_bytes // (nnz_per_receiver * n_scenarios * len(freqs) * 8)))
+
+    for start in range(0, len(op.receivers), block):
+        stop = min(start + block, len(op.receivers))
+        a, b = op.indptr[start], op.indptr[stop]
+        cols = op.cols[a:b]
+        block_weights = weights[cols]
+
+        # Same clipping as `attenuate`: contributions are at least 1, or 0
+        # for the missing sources (whose powers are 0)
+        contrib = powers[cols]
+        contrib *= op.factors[a:b, None, :]
+        np.maximum(contrib, block_weights, out=contrib)
+
+        starts = op.indptr[start:stop] - a
+        power[start:stop] = np.add.reduceat(contrib, starts, axis=0)
+        received[start:stop] = np.add.reduceat(block_weights[:, :, 0], starts, axis=0) > 0
+    return power, received
+
+def total_levels(power: np.ndarray, received: np.ndarray) -> np.ndarray:
+    """
+    Total level (dB) from the summed power per band (last axis), NaN for the
+    receivers without contributions.
+    """
+    with np.errstate(divide='ignore'):
+        return np.where(received, power_to_db(power.sum(axis=-1)), np.nan)
+
+def stacked_source_powers(
+    op: AttenuationOperator,
+    df: pd.DataFrame,
+    n_scenarios: int
+) -> list[np.ndarray]:
+    """
+    `source_powers` of stacked scenarios: `df` is the output of
+    `sound_pressure_levels` with a 'scenario' column in [0, `n_scenarios`).
+
+    Returns:
+        list[np.ndarray]: One [n_sources, n_scenarios, n_freqs] power array per layer.
+    """
+    idx = op.sources.get_indexer(pd.MultiIndex.from_arrays(
+        [df[ID_JOIN], df['vehicle_type'].astype(str)]))
+    mask = idx >= 0
+
+    spl = df[freqs].to_numpy(dtype=float)[mask]
+    power = 10.0 ** (np.where(np.isnan(spl), 0.0, spl) / 10.0)
+    idx = idx[mask]
+    scenario = df['scenario'].to_numpy()[mask]
+
+    layer = pd.DataFrame({'idx': idx, 'scenario': scenario}).groupby(['scenario', 'idx']).cumcount().to_numpy()
+    layers = []
+    for k in range(layer.max() + 1 if len(layer) else 1):
+        P = np.full((len(op.sources), n_scenarios, len(freqs)), np.nan)
+        P[idx[layer == k], scenario[layer == k]] = power[layer == k]
+        layers.append(P)
+    return layers
+
+
+class ScenarioEngine:
+    """
+    Evaluates scenarios of a snapshot through `equivalent_flows`,
+    `sound_pressure_levels` and the sparse attenuation operator.
+
+    Scenarios are evaluated in batches whose stacked powers fit
+    `memory_budget_mb`: the inputs and street parameters of the batch are
+    stacked with a 'scenario' key and go through the flows and the emission
+    at once. Scenarios changing at most `max_changed_fraction` of the sources
+    are then derived from the baseline, the others attenuated together (the
+    update by source costs about 5 times more per non-zero).
+    """
+    def __init__(self, op: AttenuationOperator, street_params_raw: pd.DataFrame,
+                 freq_coeffs_df: pd.DataFrame, curve_A_df: pd.DataFrame,
+                 emission_table: EmissionTable = None,
+                 memory_budget_mb: float = SCENARIO_BATCH_MB,
+                 max_changed_fraction: float = 0.15):
+        self.op = op
+        self.street_params_raw = street_params_raw
+        self.freq_coeffs_df = freq_coeffs_df
+        self.curve_A_df = curve_A_df
+        self.emission_table = emission_table if emission_table is not None else build_emission_table(freq_coeffs_df, curve_A_df)
+        self.baseline = IncrementalEnergeticSum(op, max_changed_fraction=max_changed_fraction)
+
+        # Stacked source powers and per-receiver sums of every scenario of a batch
+        bytes_per_scenario = (2 * len(op.sources) + len(op.receivers)) * len(freqs) * 8
+        self.batch_size = max(1, int(memory_budget_mb * 2**20 // max(1, bytes_per_scenario)))
+
+    def batch_powers(self, df: pd.DataFrame, scenarios: list[Scenario]) -> list[np.ndarray]:
+        """
+        Per-source powers of `scenarios` (see `stacked_source_powers`).
+        """
+        inputs, street_params = [], []
+        for j, scenario in enumerate(scenarios):
+            rng = np.random.default_rng(scenario.seed)
+            inputs.append(apply_changes(df, scenario.input, rng).assign(scenario=j))
+            street_params.append(apply_changes(self.street_params_raw, scenario.street_params, rng).assign(scenario=j))
+
+        street_params_df = preprocess_street_params(pd.concat(street_params, ignore_index=True))
+        flows_df = equivalent_flows(pd.concat(inputs, ignore_index=True), street_params_df)
+        spl_df = sound_pressure_levels(flows_df, self.freq_coeffs_df, self.curve_A_df, self.emission_table)
+        return stacked_source_powers(self.op, spl_df, len(scenarios))
+
+    def from_baseline(self, powers: np.ndarray) -> np.ndarray | None:
+        """
+        Total level per receiver of the scenario with the given per-source
+        powers, derived from the baseline; None when too many sources changed.
+        """
+        changed = self.baseline.changed_sources(powers)
+        if len(changed) > self.baseline.max_changed_fraction * len(self.op.sources):
+            return None
+        power, count = self.baseline.power.copy(), self.baseline.count.copy()
+        if len(changed):
+            self.baseline.add_changes(powers, changed, power, count)
+        return total_levels(power, count > 0)
+
+    def attenuate_batch(self, layers: list[np.ndarray]) -> np.ndarray:
+        """
+        Total level per receiver of a batch of scenarios, from their stacked
+        per-source powers.
+
+        Returns:
+            np.ndarray: [n_receivers, n_scenarios] levels (dB), NaN for the
+            receivers without contributions.
+        """
+        power, received = attenuate_stacked(self.op, layers[0])
+        for P in layers[1:]:
+            layer_power, layer_received = attenuate_stacked(self.op, P)
+            power += layer_power
+            received |= layer_received
+        return total_levels(power, received)
+
+    @timer
+    def evaluate(self, df: pd.DataFrame, scenarios: list[Scenario]) -> pd.DataFrame:
+        """
+        Evaluates the `scenarios` of the snapshot `df` (read with
+        `input_schema`).
+
+        Returns:
+            pd.DataFrame: 'receiver', 'X/m', 'Y/m' and the total level (dB)
+            of every scenario, in a column named after it.
+        """
+        levels = np.full((len(self.op.receivers), len(scenarios)), np.nan)
+
+        baseline = self.batch_powers(df, [Scenario('baseline')])
+        if len(baseline) == 1:
+            # Repeated sources cannot be tracked one by one
+            self.baseline.powers = baseline[0][:, 0]
+            self.baseline.recompute(self.baseline.powers)
+
+        num_derived = 0
+        for start in range(0, len(scenarios), self.batch_size):
+            layers = self.batch_powers(df, scenarios[start:start + self.batch_size])
+
+            pending = []
+            for j in range(layers[0].shape[1]):
+                derived = self.from_baseline(layers[0][:, j]) if len(baseline) == len(layers) == 1 else None
+                if derived is None:
+                    pending.append(j)
+                else:
+                    levels[:, start + j] = derived
+                    num_derived += 1
+            if pending:
+                levels[:, [start + j for j in pending]] = self.attenuate_batch([P[:, pending] for P in layers])
+        logging.debug(f"Evaluated {len(scenarios)} scenarios, {num_derived} derived from the baseline")
+
+        maps = pd.DataFrame({
+            'receiver': self.op.receivers,
+            'X/m': self.op.coords[:, 0],
+            'Y/m': self.op.coords[:, 1],
+        })
+        return pd.concat([maps, pd.DataFrame(levels, columns=[s.name for s in scenarios])], axis=1)
+
+
+def scenario_distribution(maps: pd.DataFrame, names: list[str],
+                          percentiles: tuple = (5, 50, 95)) -> pd.DataFrame:
+    """
+    Mean, standard deviation and percentiles of the total level (dB) of every
+    receiver over the scenarios `names` of `maps` (output of `evaluate`).
+    """
+    levels = maps[names].to_numpy(dtype=float)
+    dist = maps[['receiver', 'X/m', 'Y/m']].copy()
+    with warnings.catch_warnings():
+        # Receivers without contributions in any scenario
+        warnings.simplefilter('ignore', RuntimeWarning)
+        dist['mean'] = np.nanmean(levels, axis=1)
+        dist['std'] = np.nanstd(levels, axis=1)
+        for p, values in zip(percentiles, np.nanpercentile(levels, percentiles, axis=1)):
+            dist[f'p{p:02d}'] = values
+    return dist
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("scenarios", now, debug=True)
+
+    args = parse_args()
+
+    if not os.path.isfile(args.matrix):
+        logging.error(f"The Noise Attenuation matrix does not exists: {args.matrix}")
+        sys.exit(2)
+    if not os.path.isfile(args.input):
+        logging.error(f"The input file does not exist: {args.input}")
+        sys.exit(1)
+    for filename in (args.output, args.distribution):
+        if filename and os.path.isfile(filename) and not args.force:
+            logging.error(f"The file {filename} already exists! Use `--force` to overwrite it.")
+            sys.exit(3)
+
+    with open(args.scenarios) as f:
+        scenarios = expand_scenarios(json.load(f))
+
+    import process
+    process.attenuation_matrix_filename = args.matrix
+    process.use_sparse = True
+    process.use_cache = args.cache or USE_CACHE
+    process.load_parameters()
+
+    engine = ScenarioEngine(process.attenuation_operator, read_file(street_params_filename, PARAMS_DIR),
+                            process.freq_coeffs_df, process.curve_A_df, process.emission_table)
+    maps = engine.evaluate(read_file(args.input, schema=(input_schema if USE_SCHEMAS else None)), scenarios)
+    logging.info(f"Evaluated {len(scenarios)} scenarios in batches of {engine.batch_size}")
+
+    with atomic_output(args.output) as tmp_filename:
+        write_csv_file(maps, tmp_filename)
+    if args.distribution:
+        with atomic_output(args.distribution) as tmp_filename:
+            write_csv_file(scenario_distribution(maps, [s.name for s in scenarios]), tmp_filename)
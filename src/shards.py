@@ -0,0 +1,281 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import hashlib
+import subprocess
+from writers import *
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Split the Noise Attenuation Matrix into receiver shards, and merge the results of the shards.")
+    parser.add_argument('-s', '--split',  required=False, help="Noise Attenuation Matrix to split (csv, json, parquet or compiled npy).", default=None)
+    parser.add_argument('-n', '--num-shards', required=False, help="Number of shards of `--split`.", type=int, default=2)
+    parser.add_argument('-d', '--dir',    required=True,  help="Directory of the shards and of their manifest.")
+    parser.add_argument('--merge',        required=False, help="Merge the shard results matching `--input` into `--output`.", action='store_true')
+    parser.add_argument('--run',          required=False, help="Process the snapshot `--input` with one local process per shard, then merge into `--output`.", action='store_true')
+    parser.add_argument('-i', '--input',  required=False, help="Shard results (glob pattern) with `--merge`, snapshot with `--run`.", default=None)
+    parser.add_argument('-o', '--output', required=False, help="Merged result file.", default=None)
+    parser.add_argument('-f', '--force',  required=False, help="Force rewrite output file.", action='store_true')
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Sharding
+#
+# The compiled matrix (sorted by receiver) is split into shards of
+# contiguous receivers with about the same number of rows, written as
+# compiled npy files next to a manifest with their receiver ranges and
+# digests. `process.py --shard k/N` processes a snapshot against shard k
+# only, on any host, and writes next to its result a record of the shard,
+# the snapshot and the result. The merge checks the records against the
+# manifest and concatenates the results in shard order, which gives the
+# rows of `energetic_sum` over the whole matrix, in the same order.
+#
+#------------------------------------------------------------------------------
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def sha256_file(filename: str) -> str:
+    """
+    SHA-256 of the content of `filename`, always read again: the records
+    check the shards and the results themselves, not their size and time.
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def shard_filename(shard: int, num_shards: int) -> str:
+    return f"shard-{shard}-of-{num_shards}.npy"
+
+def shard_record_filename(output_filename: str) -> str:
+    """
+    Record written next to the result of a shard.
+    """
+    return f"{output_filename}.shard.json"
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parse a "k/N" shard specification (1 <= k <= N).
+    """
+    shard, num_shards = (int(v) for v in value.split('/'))
+    if not 1 <= shard <= num_shards:
+        raise ValueError(f"Invalid shard: {value}")
+    return shard, num_shards
+
+def read_shard_manifest(shards_dir: str) -> dict:
+    with open(os.path.join(shards_dir, MANIFEST_FILENAME)) as f:
+        return json.load(f)
+
+@timer
+def split_attenuation_matrix(records: np.ndarray, num_shards: int, shards_dir: str, matrix_filename: str) -> dict:
+    """
+    Writes the compiled matrix `records` (see `compile_attenuation_matrix`)
+    as `num_shards` shards of contiguous receivers to `shards_dir`, with
+    their manifest. Shards that would be empty (receivers with more rows
+    than a shard) are dropped, so there may be fewer shards.
+
+    Raises:
+        ValueError: When there are more shards than receivers.
+
+    Returns:
+        dict: The manifest.
+    """
+    receivers = compiled_matrix_columns(records)['receiver']
+    num_rows = len(receivers)
+    num_receivers = len(np.unique(receivers))
+    if not 1 <= num_shards <= num_receivers:
+        raise ValueError(f"Cannot split {num_receivers} receivers into {num_shards} shards")
+
+    targets = np.linspace(0, num_rows, num_shards + 1).astype(np.int64)[1:-1]
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(receivers, receivers[targets], side='left'), [num_rows]]))
+    if len(bounds) - 1 < num_shards:
+        logging.warning(f"Dropped {num_shards - len(bounds) + 1} empty shards")
+        num_shards = len(bounds) - 1
+
+    shards = []
+    for k, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]), start=1):
+        filename = os.path.join(shards_dir, shard_filename(k, num_shards))
+        with atomic_output(filename) as tmp_filename:
+            write_npy_file(pack_compiled_matrix(compiled_matrix_columns(records, start, stop)), tmp_filename)
+        shard_receivers = receivers[start:stop]
+        shards.append({
+            'shard': k,
+            'filename': os.path.basename(filename),
+            'first_receiver': int(shard_receivers[0]),
+            'last_receiver': int(shard_receivers[-1]),
+            'receivers': int(len(np.unique(shard_receivers))),
+            'rows': int(stop - start),
+            'sha256': sha256_file(filename),
+        })
+
+    manifest = {
+        'matrix': os.path.basename(matrix_filename),
+        'matrix_sha256': sha256_file(matrix_filename),
+        'num_shards': num_shards,
+        'receivers': num_receivers,
+        'rows': num_rows,
+        'created': datetime.now(),
+        'shards': shards,
+    }
+    with atomic_output(os.path.join(shards_dir, MANIFEST_FILENAME)) as tmp_filename:
+        with open(tmp_filename, 'w') as f:
+            json.dump(manifest, f, indent=1, default=str)
+    return manifest
+
+def shard_matrix_filename(shards_dir: str, shard: int, num_shards: int) -> str:
+    """
+    Matrix of shard `shard` of the manifest in `shards_dir`, which must have
+    `num_shards` shards.
+    """
+    manifest = read_shard_manifest(shards_dir)
+    if manifest['num_shards'] != num_shards:
+        raise ValueError(f"The manifest in {shards_dir} has {manifest['num_shards']} shards, not {num_shards}")
+    return os.path.join(shards_dir, manifest['shards'][shard - 1]['filename'])
+
+def write_shard_record(output_filename: str, shards_dir: str, shard: int, num_shards: int, input_filename: str):
+    """
+    Writes the record of the result `output_filename` of shard `shard`.
+    """
+    record = {
+        'shard': shard,
+        'num_shards': num_shards,
+        'shard_sha256': sha256_file(shard_matrix_filename(shards_dir, shard, num_shards)),
+        'snapshot': os.path.basename(input_filename),
+        'snapshot_sha256': sha256_file(input_filename),
+        'output': os.path.basename(output_filename),
+        'output_sha256': sha256_file(output_filename),
+        'host': os.uname().nodename if hasattr(os, 'uname') else None,
+        'written': datetime.now(),
+    }
+    with atomic_output(shard_record_filename(output_filename)) as tmp_filename:
+        with open(tmp_filename, 'w') as f:
+            json.dump(record, f, indent=1, default=str)
+
+@timer
+def merge_shard_results(manifest: dict, output_filenames: list[str]) -> pd.DataFrame:
+    """
+    Checks the results of the shards `output_filenames` (in any order)
+    against `manifest`, and concatenates them in shard order.
+
+    Raises:
+        ValueError: When a shard is missing or duplicated, or a result does
+                    not match the manifest, its record or the other results.
+    """
+    records = {}
+    for filename in output_filenames:
+        if not os.path.isfile(shard_record_filename(filename)):
+            raise ValueError(f"No shard record for {filename}")
+        with open(shard_record_filename(filename)) as f:
+            record = json.load(f)
+        if record['shard'] in records:
+            raise ValueError(f"Shard {record['shard']} found twice: {records[record['shard']][0]} and {filename}")
+        records[record['shard']] = (filename, record)
+
+    num_shards = manifest['num_shards']
+    missing = sorted(set(range(1, num_shards + 1)) - set(records))
+    if missing:
+        raise ValueError(f"Missing shards: {missing}")
+    snapshots = {record['snapshot_sha256'] for _, record in records.values()}
+    if len(snapshots) > 1:
+        raise ValueError("The shards processed different snapshots")
+
+    results = []
+    for shard in manifest['shards']:
+        filename, record = records[shard['shard']]
+        if record['num_shards'] != num_shards or record['shard_sha256'] != shard['sha256']:
+            raise ValueError(f"{filename} was not computed with shard {shard['shard']} of the manifest")
+        if sha256_file(filename) != record['output_sha256']:
+            raise ValueError(f"{filename} was modified after shard {shard['shard']} wrote it")
+
+        df = read_file(filename)
+        if len(df) > shard['receivers'] or (len(df) and not (
+                df['receiver'].min() >= shard['first_receiver'] and df['receiver'].max() <= shard['last_receiver'])):
+            raise ValueError(f"{filename} has receivers outside shard {shard['shard']}")
+        results.append(df[result_columns])
+
+    return pd.concat(results, ignore_index=True)
+
+def run_local_shards(shards_dir: str, input_filename: str, output_filename: str) -> list[str]:
+    """
+    Processes `input_filename` with one local `process.py --shard` process
+    per shard of `shards_dir`, all at once.
+
+    Returns:
+        list[str]: The results of the shards.
+    """
+    num_shards = read_shard_manifest(shards_dir)['num_shards']
+    base, ext = os.path.splitext(output_filename)
+    outputs = [f"{base}.shard-{k}-of-{num_shards}{ext}" for k in range(1, num_shards + 1)]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process.py')
+
+    processes = [subprocess.Popen([sys.executable, script, '-i', input_filename, '-m', shards_dir, '-o', output,
+                                   '--shard', f"{k}/{num_shards}", '-f'])
+                 for k, output in enumerate(outputs, start=1)]
+    failed = [k for k, p in enumerate(processes, start=1) if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed")
+    return outputs
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("shards", now, debug=True)
+
+    args = parse_args()
+
+    if args.split:
+        if not os.path.isfile(args.split):
+            logging.error(f"The Noise Attenuation matrix does not exists: {args.split}")
+            sys.exit(2)
+        os.makedirs(args.dir, exist_ok=True)
+
+        if args.split.endswith('.npy'):
+            records = read_npy_file(args.split)
+        else:
+            matrix_df = read_file(args.split, schema=(attenuation_matrix_schema if USE_SCHEMAS else None))
+            records = compile_attenuation_matrix(preproces_attenuation_matrix(matrix_df))
+        try:
+            manifest = split_attenuation_matrix(records, args.num_shards, args.dir, args.split)
+        except ValueError as e:
+            logging.error(f"Split failed: {e}")
+            sys.exit(4)
+        logging.info(f"Split {manifest['rows']} rows of {manifest['receivers']} receivers into "
+                     f"{manifest['num_shards']} shards in {args.dir}")
+
+    if args.merge or args.run:
+        if not os.path.isfile(os.path.join(args.dir, MANIFEST_FILENAME)):
+            logging.error(f"No shard manifest in {args.dir}")
+            sys.exit(2)
+
+        if not args.input or (args.run and not os.path.isfile(args.input)):
+            logging.error(f"The input does not exist: {args.input}")
+            sys.exit(1)
+
+        if not args.output or (os.path.exists(args.output) and not args.force):
+            logging.error(f"The output file is missing or already exists: {args.output}")
+            sys.exit(3)
+
+        try:
+            if args.run:
+                outputs = run_local_shards(args.dir, args.input, args.output)
+            else:
+                # The records written next to the results match the same patterns
+                outputs = sorted(f for f in glob.glob(args.input) if not f.endswith('.shard.json'))
+            merged_df = merge_shard_results(read_shard_manifest(args.dir), outputs)
+        except (ValueError, RuntimeError) as e:
+            logging.error(f"Merge failed: {e}")
+            sys.exit(4)
+
+        with atomic_output(args.output) as tmp_filename:
+            with ResultWriter(tmp_filename, result_format(args.output)) as writer:
+                writer.write(merged_df)
+        logging.info(f"Merged {len(outputs)} shards into {args.output} ({len(merged_df)} receivers)")
@@ -0,0 +1,202 @@
+import os
+import sys
+import argparse
+from process_functions import *
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Compute the levels of a snapshot for a subset of the receivers only.")
+    parser.add_argument('-i', '--input',     required=True,  help="Path to input CSV file.")
+    parser.add_argument('-m', '--matrix',    required=True,  help="Path to the Noise Attenuation Matrix (csv, json, parquet or compiled npy).")
+    parser.add_argument('-o', '--output',    required=True,  help="Name of output file.")
+    parser.add_argument('-f', '--force',     required=False, help="Force rewrite output file.", action='store_true')
+    parser.add_argument('--bbox',            required=False, help="Bounding box 'xmin,ymin,xmax,ymax' (m).", default=None)
+    parser.add_argument('--polygon',         required=False, help="Polygon 'x1 y1,x2 y2,...' (m).", default=None)
+    parser.add_argument('--receivers',       required=False, help="Comma-separated receiver ids.", default=None)
+    parser.add_argument('--cache',           required=False, help="Load the preprocessed parameters from the cache (`CACHE_DIR`), and store them in it.", action='store_true')
+    return parser.parse_args()
+
+
+#------------------------------------------------------------------------------
+#
+# Spatial queries
+#
+# The matrix is kept sorted by receiver, so the rows of every receiver are a
+# contiguous range. Receivers are indexed by the cell of `cell_size` m that
+# contains them, sorted by (column, row) of the cell, so that the receivers
+# of a column of cells of a bounding box are a contiguous range as well. A
+# query only gathers the rows of the selected receivers, and computes the
+# emissions of the sources they hear.
+#
+#------------------------------------------------------------------------------
+
+def points_in_polygon(x: np.ndarray, y: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """
+    Whether every (x, y) point is inside `polygon` ([n, 2] vertices), by the
+    even-odd rule.
+    """
+    inside = np.zeros(len(x), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+class SpatialQuery:
+    """
+    Computes `energetic_sum` for the receivers inside a bounding box or a
+    polygon, or for a list of receivers, from the rows of the matrix of
+    those receivers and the snapshot rows of the sources they hear.
+    """
+    def __init__(self, matrix_df: pd.DataFrame, street_params_df: pd.DataFrame,
+                 freq_coeffs_df: pd.DataFrame, curve_A_df: pd.DataFrame,
+                 emission_table: EmissionTable = None, cell_size: float = QUERY_CELL_SIZE):
+        if not matrix_df['receiver'].is_monotonic_increasing:
+            matrix_df = matrix_df.sort_values('receiver', kind='stable').reset_index(drop=True)
+        self.matrix_df = matrix_df
+        self.street_params_df = street_params_df
+        self.freq_coeffs_df = freq_coeffs_df
+        self.curve_A_df = curve_A_df
+        self.emission_table = emission_table if emission_table is not None else build_emission_table(freq_coeffs_df, curve_A_df)
+        self.cell_size = cell_size
+
+        # Rows [starts[i], stops[i]) of every receiver
+        receivers = matrix_df['receiver'].to_numpy()
+        self.receivers, self.starts = np.unique(receivers, return_index=True)
+        self.stops = np.append(self.starts[1:], len(receivers))
+        self.x = matrix_df['X/m'].to_numpy(dtype=float)[self.starts]
+        self.y = matrix_df['Y/m'].to_numpy(dtype=float)[self.starts]
+
+        # Receivers sorted by cell
+        cx = np.floor(self.x / cell_size).astype(np.int64)
+        cy = np.floor(self.y / cell_size).astype(np.int64)
+        self.order = np.lexsort((cy, cx))
+        self.cell_x = cx[self.order]
+        self.cell_y = cy[self.order]
+        logging.info(f"Indexed {len(self.receivers)} receivers in cells of {cell_size} m")
+
+    def in_bbox(self, xmin: float, ymin: float, xmax: float, ymax: float) -> np.ndarray:
+        """
+        Positions (into `receivers`) of the receivers inside the bounding box.
+        """
+        cx0, cx1 = np.floor(np.array([xmin, xmax]) / self.cell_size).astype(np.int64)
+        cy0, cy1 = np.floor(np.array([ymin, ymax]) / self.cell_size).astype(np.int64)
+        lo, hi = np.searchsorted(self.cell_x, cx0, 'left'), np.searchsorted(self.cell_x, cx1, 'right')
+        candidates = []
+        for cx in np.unique(self.cell_x[lo:hi]):
+            a, b = np.searchsorted(self.cell_x, cx, 'left'), np.searchsorted(self.cell_x, cx, 'right')
+            a, b = a + np.searchsorted(self.cell_y[a:b], cy0, 'left'), a + np.searchsorted(self.cell_y[a:b], cy1, 'right')
+            candidates.append(self.order[a:b])
+        positions = np.sort(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+        inside = ((self.x[positions] >= xmin) & (self.x[positions] <= xmax)
+                  & (self.y[positions] >= ymin) & (self.y[positions] <= ymax))
+        return positions[inside]
+
+    def in_polygon(self, polygon) -> np.ndarray:
+        """
+        Positions of the receivers inside `polygon` ([n, 2] vertices).
+        """
+        polygon = np.asarray(polygon, dtype=float)
+        (xmin, ymin), (xmax, ymax) = polygon.min(axis=0), polygon.max(axis=0)
+        positions = self.in_bbox(xmin, ymin, xmax, ymax)
+        return positions[points_in_polygon(self.x[positions], self.y[positions], polygon)]
+
+    def with_ids(self, receivers) -> np.ndarray:
+        """
+        Positions of the `receivers` ids that are in the matrix.
+        """
+        receivers = np.unique(np.asarray(receivers))
+        positions = np.searchsorted(self.receivers, receivers)
+        found = positions < len(self.receivers)
+        found[found] = self.receivers[positions[found]] == receivers[found]
+        return positions[found]
+
+    def rows(self, positions: np.ndarray) -> pd.DataFrame:
+        """
+        Rows of the matrix of the receivers at `positions`.
+        """
+        lengths = self.stops[positions] - self.starts[positions]
+        offsets = np.repeat(self.starts[positions] - np.cumsum(lengths) + lengths, lengths)
+        return self.matrix_df.iloc[offsets + np.arange(lengths.sum())]
+
+    @timer
+    def energetic_sum(self, data_df: pd.DataFrame, positions: np.ndarray) -> pd.DataFrame:
+        """
+        `energetic_sum` of the snapshot `data_df` (as read by `read_file`) for
+        the receivers at `positions`.
+
+        Returns:
+            pd.DataFrame: Aggregated SPL per receiver with total dB and per-frequency dB values.
+        """
+        matrix_df = self.rows(positions)
+        if matrix_df.empty:
+            return pd.DataFrame(columns=['receiver', 'X/m', 'Y/m', *freqs, 'total_db'])
+
+        data_df = data_df[data_df[ID_JOIN].isin(matrix_df[ID_JOIN].unique())]
+        equivalent_flows_df      = equivalent_flows(data_df, self.street_params_df)
+        sound_pressure_levels_df = sound_pressure_levels(equivalent_flows_df, self.freq_coeffs_df, self.curve_A_df,
+                                                         self.emission_table)
+        return energetic_sum(noise_attenuation(sound_pressure_levels_df, matrix_df))
+
+    def query(self, data_df: pd.DataFrame, bbox: tuple = None, polygon=None, receivers=None) -> pd.DataFrame:
+        """
+        Levels of the receivers inside `bbox` (xmin, ymin, xmax, ymax), inside
+        `polygon`, or with the ids `receivers`, whichever is given.
+        """
+        if bbox is not None:
+            positions = self.in_bbox(*bbox)
+        elif polygon is not None:
+            positions = self.in_polygon(polygon)
+        elif receivers is not None:
+            positions = self.with_ids(receivers)
+        else:
+            raise ValueError("One of `bbox`, `polygon` or `receivers` must be given.")
+        return self.energetic_sum(data_df, positions)
+
+
+if __name__ == "__main__":
+    now = datetime.now()
+    setup_logging("query", now, debug=True)
+
+    args = parse_args()
+
+    if not os.path.isfile(args.input):
+        logging.error(f"The input file does not exist: {args.input}")
+        sys.exit(1)
+
+    if not os.path.isfile(args.matrix):
+        logging.error(f"The Noise Attenuation matrix does not exists: {args.matrix}")
+        sys.exit(2)
+
+    if os.path.exists(args.output) and not args.force:
+        logging.error(f"The output file already exists: {args.output}")
+        sys.exit(3)
+
+    if sum(arg is not None for arg in (args.bbox, args.polygon, args.receivers)) != 1:
+        logging.error("Exactly one of `--bbox`, `--polygon` or `--receivers` must be given.")
+        sys.exit(4)
+
+    import process
+    process.attenuation_matrix_filename = args.matrix
+    process.use_cache = args.cache or USE_CACHE
+    process.load_parameters()
+    spatial_query = SpatialQuery(process.attenuation_matrix_df, process.street_params_df, process.freq_coeffs_df,
+                                 process.curve_A_df, process.emission_table)
+
+    data_df = read_file(args.input, schema=(input_schema if USE_SCHEMAS else None))
+    if args.bbox:
+        result_df = spatial_query.query(data_df, bbox=[float(v) for v in args.bbox.split(',')])
+    elif args.polygon:
+        polygon = [[float(v) for v in point.split()] for point in args.polygon.split(',')]
+        result_df = spatial_query.query(data_df, polygon=polygon)
+    else:
+        result_df = spatial_query.query(data_df, receivers=[int(v) for v in args.receivers.split(',')])
+
+    with atomic_output(args.output) as tmp_filename:
+        write_csv_file(result_df, tmp_filename)
+    logging.info(f"Computed {len(result_df)} receivers")
@@ -0,0 +1,140 @@
+import os
+import glob
+from process_functions import *
+
+
+#------------------------------------------------------------------------------
+#
+# Tiled output
+#
+# Receivers are partitioned into square tiles of `TILE_SIZE` m by their
+# 'X/m'/'Y/m' coordinates. Every tile is published as a Parquet file under
+# `<root>/tiles/`, and rewritten only when the level of one of its receivers
+# moved by more than the threshold since the version last published, or when
+# receivers were added or removed. For every snapshot, a manifest listing the
+# changed tiles is written under `<root>/manifests/`, so that consumers only
+# ingest those.
+#
+#------------------------------------------------------------------------------
+
+level_columns = freqs + ['total_db']
+
+
+def tile_names(x: np.ndarray, y: np.ndarray, tile_size: float = TILE_SIZE) -> np.ndarray:
+    """
+    Name ("<column>_<row>") of the tile of every (x, y) point.
+    """
+    ix = np.floor(np.asarray(x, dtype=float) / tile_size).astype(np.int64)
+    iy = np.floor(np.asarray(y, dtype=float) / tile_size).astype(np.int64)
+    return (pd.Series(ix).astype(str) + '_' + pd.Series(iy).astype(str)).to_numpy()
+
+def tile_manifest_filename(root: str, input_filename: str) -> str:
+    """
+    Manifest of the snapshot `input_filename` published to `root`.
+    """
+    name = os.path.splitext(os.path.basename(input_filename))[0]
+    return os.path.join(root, 'manifests', f"{name}.json")
+
+
+class TilePublisher:
+    """
+    Publishes the output of `energetic_sum` as spatial tiles under `root`,
+    rewriting only the tiles whose receivers changed by more than
+    `threshold` dB in any band or in 'total_db'.
+
+    Changes are measured against the last published version of every
+    receiver, not the previous snapshot, so that slow drifts are published
+    as soon as they add up to the threshold. The published levels are read
+    back from `root` at startup, so consecutive runs share the same state.
+    Snapshots must be published in chronological order, by one process.
+    """
+    def __init__(self, root: str, tile_size: float = TILE_SIZE, threshold: float = TILE_THRESHOLD_DB):
+        self.root = root
+        self.tiles_dir = os.path.join(root, 'tiles')
+        self.tile_size = tile_size
+        self.threshold = threshold
+        os.makedirs(self.tiles_dir, exist_ok=True)
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+        self.levels = self.load_levels()
+
+    def tile_filename(self, tile: str) -> str:
+        return os.path.join(self.tiles_dir, f"{tile}.parquet")
+
+    def load_levels(self) -> pd.DataFrame:
+        """
+        Published levels per receiver, with the name of their tile.
+        """
+        published = []
+        for filename in sorted(glob.glob(os.path.join(self.tiles_dir, '*.parquet'))):
+            df = read_parquet_file(filename)
+            df['tile'] = os.path.splitext(os.path.basename(filename))[0]
+            published.append(df)
+        if not published:
+            return pd.DataFrame(columns=['X/m', 'Y/m', *level_columns, 'tile'],
+                                index=pd.Index([], name='receiver'))
+        return pd.concat(published).set_index('receiver')
+
+    def changed_tiles(self, levels: pd.DataFrame) -> set[str]:
+        """
+        Tiles with a receiver that is new, moved to another tile, removed, or
+        whose level moved by more than `threshold` since it was published.
+        """
+        prev = self.levels.reindex(levels.index)
+        new_values = levels[level_columns].to_numpy(dtype=float)
+        old_values = prev[level_columns].to_numpy(dtype=float)
+        with np.errstate(invalid='ignore'):
+            moved = (np.abs(new_values - old_values) > self.threshold) | (np.isnan(new_values) != np.isnan(old_values))
+        changed = moved.any(axis=1) | (prev['tile'].to_numpy() != levels['tile'].to_numpy())
+
+        removed = self.levels.index.difference(levels.index)
+        return (set(levels['tile'].to_numpy()[changed])
+                | set(prev['tile'][changed].dropna())
+                | set(self.levels.loc[removed, 'tile']))
+
+    @timer
+    def publish(self, df: pd.DataFrame, manifest_filename: str) -> dict:
+        """
+        Publishes the tiles of `df` (output of `energetic_sum`) that changed,
+        removes the tiles left without receivers, and writes the manifest of
+        the snapshot to `manifest_filename`.
+
+        Returns:
+            dict: The manifest.
+        """
+        levels = df.set_index('receiver').sort_index()
+        levels['tile'] = tile_names(levels['X/m'], levels['Y/m'], self.tile_size)
+
+        changed = self.changed_tiles(levels)
+        present = set(levels['tile'])
+        updated = levels[levels['tile'].isin(changed)]
+
+        bytes_written = 0
+        for tile, tile_df in updated.groupby('tile', sort=True):
+            filename = self.tile_filename(tile)
+            with atomic_output(filename) as tmp_filename:
+                write_parquet_file(tile_df.drop(columns='tile').reset_index(), tmp_filename)
+            bytes_written += os.path.getsize(filename)
+        removed = sorted(changed - present)
+        for tile in removed:
+            if os.path.isfile(self.tile_filename(tile)):
+                os.remove(self.tile_filename(tile))
+
+        self.levels = pd.concat([self.levels[~self.levels['tile'].isin(changed)], updated])
+
+        manifest = {
+            'snapshot': os.path.splitext(os.path.basename(manifest_filename))[0],
+            'published': datetime.now(),
+            'tile_size': self.tile_size,
+            'threshold_db': self.threshold,
+            'tiles': len(present),
+            'changed': sorted(changed & present),
+            'removed': removed,
+            'receivers_written': len(updated),
+            'bytes_written': bytes_written,
+        }
+        with atomic_output(manifest_filename) as tmp_filename:
+            with open(tmp_filename, 'w') as f:
+                json.dump(manifest, f, indent=1, default=str)
+
+        logging.debug(f"Published {len(manifest['changed'])} of {len(present)} tiles, removed {len(removed)}")
+        return manifest
@@ -1,10 +1,25 @@
 from config import *
 import os
 import csv
+import json
 import logging
 import time
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 
 #------------------------------------------------------------------------------
@@ -16,6 +31,21 @@ import pandas as pd
 def generate_filename_timestamp(now: datetime) -> str:
     return now.strftime("%Y%m%d-%H%M-%A")
 
+def parse_filename_timestamp(filename: str) -> datetime:
+    """
+    Inverse of `generate_filename_timestamp`: extract the timestamp from a
+    filename like "pisa-20241107-1200-Thursday.csv".
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    date, hour = name.split('-')[-3:-1]
+    return datetime.strptime(f"{date}{hour}", "%Y%m%d%H%M")
+
+def daytime_label(hour: int) -> str:
+    """
+    Return the period ('day', 'evening', 'night') of the given hour.
+    """
+    return ('day' if 6 <= hour < 20 else 'evening' if 20 <= hour < 22 else 'night')
+
 def generate_log_filename(name: str, now: datetime) -> str:
     """
     Generate a log filename with format:
@@ -79,17 +109,151 @@ def debug_info(print_info=PRINT_INFO, dump=DUMP_RESULTS):
 
 
 def timer(func):
+    """
+    Log the wall time of `func` and record its metrics (see `record_metrics`).
+    Stages listed in `profiled_stages` run under cProfile.
+    """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        global total_time
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        elapsed_time_ms = (end_time - start_time) * 1000
+        max_rss_before = max_rss_bytes()
+        cpu_start_time = time.process_time()
+        start_time = time.perf_counter()
+        if func.__name__ in profiled_stages:
+            result = profile_call(func, *args, **kwargs)
+        else:
+            result = func(*args, **kwargs)
+        elapsed_time_ms = (time.perf_counter() - start_time) * 1000
+        cpu_time_ms = (time.process_time() - cpu_start_time) * 1000
+        max_rss_after = max_rss_bytes()
+
         logging.debug(f"{elapsed_time_ms:10.3f} ms : {func.__name__}")
+        record_metrics(func.__name__, {
+            'wall_ms': round(elapsed_time_ms, 3),
+            'cpu_ms': round(cpu_time_ms, 3),
+            'max_rss_bytes': max_rss_after,
+            'max_rss_growth_bytes': (max_rss_after - max_rss_before) if max_rss_before is not None else None,
+            'rows_in': count_rows(*args, *kwargs.values()),
+            'rows_out': count_rows(result),
+        })
         return result
     return wrapper
 
 
+#------------------------------------------------------------------------------
+#
+# Metrics functions
+#
+#------------------------------------------------------------------------------
+
+metrics_labels   = {'run': None, 'snapshot': None}
+metrics_records  = []    # records not yet written to the JSON lines file
+metrics_totals   = {}    # stage -> running totals, for the Prometheus textfile
+metrics_files    = {'jsonl': None, 'prometheus': None}
+profiled_stages  = set(filter(None, os.getenv('OUTFIT_PROFILE', '').split(',')))
+profiler_lock    = threading.Lock()   # held while a stage runs under cProfile
+
+def max_rss_bytes():
+    """
+    High-water mark of the RSS of the process since it started: a stage only
+    raises it when it uses more memory than any stage before.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def count_rows(*objects):
+    rows = [len(o) for o in objects if isinstance(o, (pd.DataFrame, np.ndarray))]
+    return sum(rows) if rows else None
+
+def configure_metrics(jsonl_filename=None, prometheus_filename=None, run=None):
+    """
+    Set where `flush_metrics` exports the metrics, and the run label.
+    """
+    metrics_files['jsonl'] = jsonl_filename
+    metrics_files['prometheus'] = prometheus_filename
+    metrics_labels['run'] = run
+
+def set_metrics_labels(**labels):
+    metrics_labels.update(labels)
+
+def enable_profiling(stages):
+    """
+    Run the given stages (function names) under cProfile from now on; each
+    call is dumped to `PROFILE_DIR`. An empty list switches profiling off.
+    The initial stages can be set with the OUTFIT_PROFILE environment variable.
+    """
+    profiled_stages.clear()
+    profiled_stages.update(stages)
+
+def profile_call(func, *args, **kwargs):
+    # Only one profiler can be active at once: stages nested in a profiled
+    # stage (or running in another thread meanwhile) are part of its profile
+    if not profiler_lock.acquire(blocking=False):
+        return func(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler_lock.release()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        label = metrics_labels['snapshot'] or metrics_labels['run'] or os.getpid()
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{func.__name__}-{os.path.basename(str(label))}-{time.time_ns()}.prof"))
+
+def record_metrics(stage, values):
+    """
+    Store the metrics of one call of `stage`, labelled with the current run
+    and snapshot.
+    """
+    if metrics_files['jsonl']:
+        metrics_records.append({'timestamp': time.time(), **metrics_labels, 'stage': stage, **values})
+
+    totals = metrics_totals.setdefault(stage, {'calls': 0, 'wall_ms': 0.0, 'cpu_ms': 0.0})
+    totals['calls'] += 1
+    totals['wall_ms'] += values['wall_ms']
+    totals['cpu_ms'] += values['cpu_ms']
+    totals['last'] = values
+
+def flush_metrics():
+    """
+    Append the pending records to the JSON lines file and rewrite the
+    Prometheus textfile, if configured.
+    """
+    records = metrics_records[:]
+    metrics_records.clear()
+
+    if metrics_files['jsonl'] and records:
+        with open(metrics_files['jsonl'], 'a') as f:
+            f.write(''.join(json.dumps(r, default=str) + '\n' for r in records))
+
+    if metrics_files['prometheus']:
+        with atomic_output(metrics_files['prometheus']) as tmp_filename:
+            with open(tmp_filename, 'w') as f:
+                f.write(prometheus_metrics())
+
+def prometheus_metrics() -> str:
+    """
+    Format the running totals in the Prometheus text exposition format.
+    """
+    metrics = [
+        ('outfit_stage_calls_total', 'counter', 'Number of calls of the stage.', lambda t: t['calls']),
+        ('outfit_stage_wall_seconds_total', 'counter', 'Wall time spent in the stage.', lambda t: t['wall_ms'] / 1000),
+        ('outfit_stage_cpu_seconds_total', 'counter', 'CPU time spent in the stage.', lambda t: t['cpu_ms'] / 1000),
+        ('outfit_stage_last_wall_seconds', 'gauge', 'Wall time of the last call of the stage.', lambda t: t['last']['wall_ms'] / 1000),
+        ('outfit_stage_last_max_rss_bytes', 'gauge', 'Process peak RSS (high-water mark) after the last call of the stage.', lambda t: t['last']['max_rss_bytes']),
+        ('outfit_stage_last_max_rss_growth_bytes', 'gauge', 'Growth of the process peak RSS during the last call of the stage.', lambda t: t['last']['max_rss_growth_bytes']),
+        ('outfit_stage_last_rows_in', 'gauge', 'Input rows of the last call of the stage.', lambda t: t['last']['rows_in']),
+        ('outfit_stage_last_rows_out', 'gauge', 'Output rows of the last call of the stage.', lambda t: t['last']['rows_out']),
+    ]
+    lines = []
+    for name, kind, help, value in metrics:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        for stage, totals in sorted(metrics_totals.items()):
+            if value(totals) is not None:
+                lines.append(f'{name}{{stage="{stage}"}} {value(totals)}')
+    return '\n'.join(lines) + '\n'
+
+
 #------------------------------------------------------------------------------
 #
 # File I/O functions
@@ -100,40 +264,140 @@ def replace_extension(filename, new_ext):
     _, ext = os.path.splitext(filename)
     return filename.replace(ext, new_ext)
 
+@contextmanager
+def atomic_output(filename):
+    """
+    Yield a temporary filename next to `filename` and move it over `filename`
+    once the block completes, so readers never see a partially written file.
+    """
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        yield tmp_filename
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def apply_schema(df, schema):
+    """
+    Keep only the columns of `schema` (column -> dtype) and cast them.
+    """
+    return df[list(schema)].astype(schema)
+
 @timer
-def read_json_file(filename):
-    return pd.read_json(filename)
+def read_json_file(filename, schema=None):
+    df = pd.read_json(filename)
+    return apply_schema(df, schema) if schema else df
 
 
 @timer
-def read_csv_file(filename):
+def read_csv_file(filename, schema=None):
+    # Only the columns of `schema` are parsed, directly into their dtypes
+    kwargs = {'usecols': list(schema), 'dtype': schema} if schema else {}
     if USE_PYARROW:
-        return pd.read_csv(filename, engine="pyarrow")
-    return pd.read_csv(filename)
+        return pd.read_csv(filename, engine="pyarrow", **kwargs)
+    return pd.read_csv(filename, **kwargs)
 
 
 @timer
-def read_parquet_file(filename):
+def read_parquet_file(filename, schema=None):
+    columns = list(schema) if schema else None
     if USE_PYARROW:
-        return pd.read_parquet(filename, engine="pyarrow")
-    return pd.read_parquet(filename)
+        df = pd.read_parquet(filename, engine="pyarrow", columns=columns)
+    else:
+        df = pd.read_parquet(filename, columns=columns)
+    return df.astype(schema) if schema else df
+
+
+@timer
+def read_arrow_file(filename, schema=None):
+    # Arrow IPC files are memory-mapped
+    with pa.memory_map(filename) as source:
+        table = ipc.open_file(source).read_all()
+    df = table.select(list(schema)).to_pandas() if schema else table.to_pandas()
+    return df.astype(schema) if schema else df
+
+
+@timer
+def read_npy_file(filename):
+    # Memory-mapped: pages are loaded lazily and shared through the OS page cache
+    return np.load(filename, mmap_mode='r')
+
+
+def dataset_partitioning():
+    return ds.partitioning(pa.schema([(c, pa.string()) for c in DATASET_PARTITIONING]), flavor='hive')
+
+
+@timer
+def read_dataset(path, schema=None, start=None, end=None, ids=None):
+    """
+    Query the partitioned snapshot dataset `path` (see `converter.py
+    --dataset`) for the snapshots taken in [`start`, `end`) and the segments
+    whose ID_JOIN is in `ids`. Filters are pushed down to the partitions and
+    the Parquet row groups, so only the matching data is read.
+    """
+    conditions = []
+    if start is not None:
+        conditions += [ds.field('date') >= start.strftime('%Y-%m-%d'), ds.field('datetime') >= start]
+    if end is not None:
+        conditions += [ds.field('date') <= end.strftime('%Y-%m-%d'), ds.field('datetime') < end]
+    if ids is not None:
+        conditions.append(ds.field(ID_JOIN).isin(list(ids)))
 
+    dataset = ds.dataset(path, format='parquet', partitioning=dataset_partitioning())
+    table = dataset.to_table(columns=list(schema) if schema else None,
+                             filter=functools.reduce(lambda a, b: a & b, conditions) if conditions else None)
+    if 'datetime' in table.column_names:
+        table = table.sort_by('datetime')
+    df = table.to_pandas()
+    return df.astype(schema) if schema else df
 
-def read_file(filename, base_dir=None):
+
+def read_file(filename, base_dir=None, schema=None, start=None, end=None, ids=None):
+    """
+    Read a json, csv, parquet or Arrow IPC file, or query a snapshot dataset directory
+    (see `read_dataset` for `start`, `end` and `ids`). With `schema`
+    (column -> dtype), only those columns are returned, with those dtypes.
+    """
     filepath = os.path.join(base_dir, filename) if base_dir else filename
-    
+
+    if os.path.isdir(filepath):
+        return read_dataset(filepath, schema, start, end, ids)
+    if start is not None or end is not None or ids is not None:
+        raise ValueError("Time and id filters are only supported on datasets")
+
     if filename.endswith('.json'):
-        return read_json_file(filepath)
+        return read_json_file(filepath, schema)
     elif filename.endswith('.csv'):
-        return read_csv_file(filepath)
+        return read_csv_file(filepath, schema)
     elif filename.endswith('.parquet'):
-        return read_parquet_file(filepath)
+        return read_parquet_file(filepath, schema)
+    elif filename.endswith('.arrow'):
+        return read_arrow_file(filepath, schema)
     raise ValueError("Unknown file format")
 
 
+def iter_file_chunks(filename, chunk_rows, schema=None):
+    """
+    Yield the content of a csv or parquet file as DataFrames of at most
+    `chunk_rows` rows, without loading the whole file. See `read_file` for
+    `schema`.
+    """
+    if filename.endswith('.csv'):
+        kwargs = {'usecols': list(schema), 'dtype': schema} if schema else {}
+        yield from pd.read_csv(filename, chunksize=chunk_rows, **kwargs)
+    elif filename.endswith('.parquet'):
+        columns = list(schema) if schema else None
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas().astype(schema) if schema else batch.to_pandas()
+    else:
+        raise ValueError("Unsupported file format for chunked reading")
+
+
 @timer
-def write_csv_file(df, filename):
-    df.to_csv(filename, index=False, quoting=csv.QUOTE_STRINGS)
+def write_csv_file(df, filename, append=False):
+    df.to_csv(filename, index=False, quoting=csv.QUOTE_STRINGS,
+              mode=('a' if append else 'w'), header=not append)
 
 @timer
 def write_json_file(df, filename):
@@ -142,3 +406,18 @@ def write_json_file(df, filename):
 @timer
 def write_parquet_file(df, filename):
     df.to_parquet(filename, index=False)
+
+@timer
+def write_dataset(table, path, basename_template):
+    """
+    Add the Arrow `table` to the partitioned dataset `path`, as new files
+    named after `basename_template` in every partition.
+    """
+    ds.write_dataset(table, path, format='parquet', partitioning=dataset_partitioning(),
+                     basename_template=basename_template, existing_data_behavior='overwrite_or_ignore')
+
+@timer
+def write_npy_file(array, filename):
+    # Through a file object, so that no '.npy' extension is appended
+    with open(filename, 'wb') as f:
+        np.save(f, array)
@@ -0,0 +1,126 @@
+import os
+from process_functions import *
+
+
+#------------------------------------------------------------------------------
+#
+# Result writers
+#
+# The output of `energetic_sum` is written as csv, Parquet or Arrow IPC, in
+# one or more chunks (see `process_data_chunked`). Binary formats store the
+# bands without formatting them as text, optionally as float32. Results of
+# many snapshots can also be appended to one Parquet dataset, one file per
+# snapshot with a 'snapshot_time' column, partitioned by date.
+#
+#------------------------------------------------------------------------------
+
+result_formats = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow'}
+result_columns = ['receiver', 'X/m', 'Y/m', *freqs, 'total_db']
+
+
+def result_format(filename: str, default: str = RESULT_FORMAT) -> str:
+    """
+    Format of the result file `filename`, from its extension.
+    """
+    return result_formats.get(os.path.splitext(filename)[1], default)
+
+def result_extension(format: str) -> str:
+    return {format: ext for ext, format in result_formats.items()}[format]
+
+
+class ResultWriter:
+    """
+    Writes the output of `energetic_sum` to `filename` as csv, Parquet or
+    Arrow IPC, in as many chunks as `write` is called. With `float32`, the
+    bands are stored as float32 (csv keeps the text of the float64 values).
+    With `snapshot_time`, every row gets it in a 'snapshot_time' column.
+
+    Use it as a context manager: the file is complete once it is closed.
+    """
+    def __init__(self, filename: str, format: str = None, float32: bool = False, snapshot_time: datetime = None):
+        self.filename = filename
+        self.format = format or result_format(filename)
+        self.float32 = float32
+        self.snapshot_time = snapshot_time
+        self.writer = None
+        self.rows = 0
+
+    def table(self, df: pd.DataFrame) -> pa.Table:
+        df = df[result_columns]
+        if self.float32:
+            df = df.astype({c: 'float32' for c in freqs + ['total_db']})
+        if self.snapshot_time is not None:
+            df = df.assign(snapshot_time=pd.Timestamp(self.snapshot_time))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    @timer
+    def write(self, df: pd.DataFrame):
+        if self.format == 'csv':
+            if self.snapshot_time is not None:
+                df = df.assign(snapshot_time=self.snapshot_time)
+            write_csv_file(df, self.filename, append=self.writer is not None)
+            self.writer = True
+        else:
+            table = self.table(df)
+            if self.writer is None:
+                if self.format == 'parquet':
+                    self.writer = pq.ParquetWriter(self.filename, table.schema)
+                else:
+                    self.writer = ipc.new_file(self.filename, table.schema)
+            self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is None:
+            # No receivers: an empty file with the columns
+            self.write(pd.DataFrame(columns=result_columns).astype(
+                {c: 'float64' for c in result_columns if c != 'receiver'} | {'receiver': 'int64'}))
+        if self.writer is not True:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.writer not in (None, True):
+            self.writer.close()
+
+
+class ResultDataset:
+    """
+    Appends the results of every snapshot to the Parquet dataset `root`, as
+    `<root>/date=<YYYY-MM-DD>/<snapshot>.parquet`. Every file is written
+    atomically, so readers of the dataset never see a partial snapshot.
+    """
+    def __init__(self, root: str, float32: bool = False):
+        self.root = root
+        self.float32 = float32
+        os.makedirs(root, exist_ok=True)
+
+    def filename(self, input_filename: str) -> str:
+        """
+        File of the snapshot `input_filename` in the dataset.
+        """
+        snapshot_time = self.snapshot_time(input_filename)
+        name = os.path.splitext(os.path.basename(input_filename))[0]
+        return os.path.join(self.root, f"date={snapshot_time:%Y-%m-%d}", f"{name}.parquet")
+
+    @staticmethod
+    def snapshot_time(input_filename: str) -> datetime:
+        """
+        Time of the snapshot, from its name or else from its modification time.
+        """
+        try:
+            return parse_filename_timestamp(input_filename)
+        except ValueError:
+            return datetime.fromtimestamp(os.path.getmtime(input_filename))
+
+    def writer(self, input_filename: str, filename: str) -> ResultWriter:
+        """
+        Writer of the snapshot `input_filename` to `filename` (a temporary
+        file, see `atomic_output`, moved to `self.filename(input_filename)`).
+        """
+        os.makedirs(os.path.dirname(self.filename(input_filename)), exist_ok=True)
+        return ResultWriter(filename, 'parquet', self.float32, self.snapshot_time(input_filename))